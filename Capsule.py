@@ -1,14 +1,12 @@
 """ tensorMONK's :: Capsule Network                                         """
 
 from __future__ import print_function, division
-import sys
 import timeit
 import os
 import argparse
-import numpy as np
 import torch
 import core
-from core.NeuralEssentials import DataSets, MakeModel, VisPlots, SaveModel
+from core.NeuralEssentials import DataSets, MakeModel, VisPlots, Trainer
 
 # DistributedDataParallel 
 import torch.utils.data
@@ -34,6 +32,8 @@ def parse_args():
 
     parser.add_argument("-I", "--ignore_trained", action="store_true")
     parser.add_argument("--local_rank", default=0, type=int)
+    parser.add_argument("--accumulate", type=int, default=1)
+    parser.add_argument("--sync_every", type=int, default=50)
 
     return parser.parse_args()
 
@@ -82,75 +82,28 @@ def trainMONK():
     else:
         raise NotImplementedError
 
-    # Usual training
+    def capsule_loss(Model, tensor, targets):
+        features, rec_tensor, rec_loss = \
+            Model.netEmbedding((tensor, targets))
+        margin_loss, (top1, top5) = Model.netLoss((features, targets))
+        return margin_loss + 0.0005*rec_loss/features.size(0), (top1, top5)
+
+    def show_weights(trainer):
+        # weight visualization
+        if trainer.Model.meterIterations % 50 == 0 and args.local_rank == 0:
+            visplots.show_weights(trainer.Model.netEmbedding.state_dict(),
+                                  png_name=file_name)
+
+    # Usual training -- DistributedSampler.set_epoch is done by Trainer
+    Model.is_cuda = True
     t1 = timeit.default_timer()
-    for epoch in range(args.Epochs):
-        train_sampler.set_epoch(epoch)
-        Timer = timeit.default_timer()
-        Model.netEmbedding.train()
-        Model.netLoss.train()
-        for i, (tensor, targets) in enumerate(trData):
-            Model.meterIterations += 1
-
-            # forward pass and parameter update
-            Model.netEmbedding.zero_grad()
-            Model.netLoss.zero_grad()
-            features, rec_tensor, rec_loss = \
-                Model.netEmbedding((tensor, targets))
-            margin_loss, (top1, top5) = Model.netLoss((features, targets))
-            loss = margin_loss + 0.0005*rec_loss/features.size(0)
-            loss.backward()
-            Optimizer.step()
-
-            # weight visualization
-            if i % 50 == 0 and args.local_rank == 0:
-                visplots.show_weights(Model.netEmbedding.state_dict(),
-                                      png_name=file_name)
-
-            # updating all meters
-            Model.meterTop1.append(float(top1.cpu().data.numpy()))
-            Model.meterTop5.append(float(top5.cpu().data.numpy()))
-            Model.meterLoss.append(float(loss.cpu().data.numpy()))
-
-            Model.meterSpeed.append(int(float(args.BSZ) /
-                                         (timeit.default_timer()-Timer)))
-            Timer = timeit.default_timer()
-            if args.local_rank == 0:
-                print("... {:6d} :: ".format(Model.meterIterations) +
-                   "Cost {:2.3f} :: ".format(Model.meterLoss[-1]) +
-                   "Top1/Top5 - {:3.2f}/{:3.2f}".format(Model.meterTop1[-1],
-                                                        Model.meterTop5[-1],) +
-                   " :: {:4d} I/S    ".format(Model.meterSpeed[-1]), end="\r")
-                sys.stdout.flush()
-
-        # save every epoch and print the average of epoch
-        mean_loss = np.mean(Model.meterLoss[-i:])
-        mean_top1 = np.mean(Model.meterTop1[-i:])
-        mean_top5 = np.mean(Model.meterTop5[-i:])
-        mean_speed = int(np.mean(Model.meterSpeed[-i:]))
-        if args.local_rank == 0:
-            print("... {:6d} :: ".format(Model.meterIterations) +
-                  "Cost {:2.3f} :: ".format(mean_loss) +
-                  "Top1/Top5 - {:3.2f}/{:3.2f}".format(mean_top1, mean_top5) +
-                  " :: {:4d} I/S    ".format(mean_speed))
-        # save model
-        SaveModel(Model)
-
-        test_top1, test_top5 = [], []
-        Model.netEmbedding.eval()
-        Model.netLoss.eval()
-        for i, (tensor, targets) in enumerate(teData):
-            features, rec_tensor, rec_loss = \
-                Model.netEmbedding((tensor, targets))
-            margin_loss, (top1, top5) = Model.netLoss((features, targets))
-            test_top1.append(float(top1.cpu().data.numpy()))
-            test_top5.append(float(top5.cpu().data.numpy()))
-        if args.local_rank == 0:
-            print("... Test accuracy - {:3.2f}/{:3.2f}".format(np.mean(test_top1),
-                                                               np.mean(test_top5)))
-    Model.netEmbedding.train()
-    Model.netLoss.train()
-    Timer = timeit.default_timer()
+    Trainer(Model, Optimizer, trData, teData,
+            epochs=args.Epochs,
+            accumulate=args.accumulate,
+            sync_every=args.sync_every,
+            loss_fn=capsule_loss,
+            on_iteration=show_weights,
+            show=args.local_rank == 0).fit()
 
     print("\nDone with training")
     print(timeit.default_timer() - t1)
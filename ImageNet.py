@@ -1,12 +1,8 @@
 """ tensorMONK's :: ImageNet                                                 """
 
 from __future__ import print_function, division
-import sys
-import timeit
 import argparse
-import numpy as np
 import torch
-from torch.autograd import Variable
 from core import *
 import torch.optim as neural_optimizer
 # ============================================================================ #
@@ -19,7 +15,8 @@ def train():
     embedding_net, embedding_net_kwargs = NeuralArchitectures.Models(args.Architecture.lower())
 
     train_loader, n_labels = NeuralEssentials.FolderITTR(args.trainDataPath,
-        args.BSZ, tensor_size, args.cpus, functions=[], random_flip=True)
+        args.BSZ, tensor_size, args.cpus, functions=[], random_flip=True,
+        resumable=True)
     test_loader, n_labels = NeuralEssentials.FolderITTR(args.testDataPath,
         args.BSZ, tensor_size, args.cpus, functions=[], random_flip=False)
 
@@ -38,58 +35,10 @@ def train():
     else:
         raise NotImplementedError
 
-    # Usual training
-    for _ in range(args.Epochs):
-        timer = timeit.default_timer()
-        Model.netEmbedding.train()
-        Model.netLoss.train()
-        max_i = 1000
-        for i, (tensor, targets) in enumerate(train_loader):
-            Model.meterIterations += 1
-
-            # forward pass and parameter update
-            Model.netEmbedding.zero_grad()
-            Model.netLoss.zero_grad()
-            features = Model.netEmbedding(Variable(tensor))
-            loss, (top1, top5) = Model.netLoss((features, Variable(targets)))
-            # loss = margin_loss / features.size(0)
-            loss.backward()
-            optimizer.step()
-
-            # updating all meters
-            Model.meterTop1.append(float(top1.cpu().data.numpy()))
-            Model.meterTop5.append(float(top5.cpu().data.numpy()))
-            Model.meterLoss.append(float(loss.cpu().data.numpy()))
-
-            Model.meterSpeed.append(int(float(args.BSZ)/(timeit.default_timer()-timer)))
-            timer = timeit.default_timer()
-
-            print("... {:6d} :: Cost {:2.3f} :: Top1/Top5 - {:3.2f}/{:3.2f} :: {:4d} I/S         ".format(
-                  Model.meterIterations, Model.meterLoss[-1], Model.meterTop1[-1],
-                  Model.meterTop5[-1], Model.meterSpeed[-1]), end="\r")
-            sys.stdout.flush()
-            max_i = i
-
-        # save every epoch and print the average of epoch
-        print("... {:6d} :: Cost {:1.3f} :: Top1/Top5 - {:3.2f}/{:3.2f} :: {:4d} I/S     ".format(Model.meterIterations,
-              np.mean(Model.meterLoss[-max_i:]), np.mean(Model.meterTop1[-max_i:]),
-              np.mean(Model.meterTop5[-max_i:]), int(np.mean(Model.meterSpeed[-max_i:]))))
-        NeuralEssentials.SaveModel(Model)
-
-        test_top1, test_top5 = [], []
-        Model.netEmbedding.eval()
-        Model.netLoss.eval()
-        for i, (tensor, targets) in enumerate(test_loader):
-            Model.netEmbedding.zero_grad()
-            Model.netLoss.zero_grad()
-            features = Model.netEmbedding(Variable(tensor))
-            loss, (top1, top5) = Model.netLoss((features, Variable(targets)))
-
-            test_top1.append(float(top1.cpu().data.numpy()))
-            test_top5.append(float(top5.cpu().data.numpy()))
-        print("... Test accuracy - {:3.2f}/{:3.2f} ".format(np.mean(test_top1), np.mean(test_top5)))
-        Model.netEmbedding.train()
-        Model.netLoss.train()
+    # Usual training -- saves and tests every epoch
+    NeuralEssentials.Trainer(Model, optimizer, train_loader, test_loader,
+                             epochs=args.Epochs, accumulate=args.accumulate,
+                             sync_every=args.sync_every).fit()
 
     print("\nDone with training")
     return Model
@@ -122,6 +71,8 @@ def parse_args():
     parser.add_argument("--trainDataPath", type=str,  default="./data/ImageNet/train")
     parser.add_argument("--testDataPath", type=str,  default="./data/ImageNet/validation")
     parser.add_argument("-I", "--ignore_trained", action="store_true")
+    parser.add_argument("--accumulate", type=int,  default=1)
+    parser.add_argument("--sync_every", type=int,  default=50)
 
     return parser.parse_args()
 
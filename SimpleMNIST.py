@@ -1,13 +1,10 @@
 """ tensorMONK's :: SimpleMNIST (MNIST/FashionMNIST)                        """
 
 from __future__ import print_function, division
-import sys
-import timeit
 import argparse
-import numpy as np
 import torch
 import core
-from core.NeuralEssentials import DataSets, MakeModel, VisPlots, SaveModel
+from core.NeuralEssentials import DataSets, MakeModel, VisPlots, Trainer
 
 
 def parse_args():
@@ -33,6 +30,8 @@ def parse_args():
     parser.add_argument("--cpus", type=int,  default=6)
 
     parser.add_argument("-I", "--ignore_trained", action="store_true")
+    parser.add_argument("--accumulate", type=int, default=1)
+    parser.add_argument("--sync_every", type=int, default=50)
 
     return parser.parse_args()
 
@@ -42,7 +41,8 @@ def train():
     """
     args = parse_args()
     trData, vaData, teData, n_labels, tensor_size = \
-        DataSets(args.dataset, data_path="../data", n_samples=args.BSZ)
+        DataSets(args.dataset, data_path="../data", n_samples=args.BSZ,
+                 in_memory=True)
 
     file_name = "./models/" + args.Architecture.lower()
     visplots = VisPlots(file_name.split("/")[-1].split(".")[0])
@@ -68,72 +68,20 @@ def train():
     else:
         raise NotImplementedError
 
-    # Usual training
-    for _ in range(args.Epochs):
-        Timer = timeit.default_timer()
-
-        Model.netEmbedding.train()
-        Model.netLoss.train()
-
-        for i, (tensor, targets) in enumerate(trData):
-            Model.meterIterations += 1
-
-            # forward pass and parameter update
-            Model.netEmbedding.zero_grad()
-            Model.netLoss.zero_grad()
-            features = Model.netEmbedding(tensor)
-            loss, (top1, top5) = Model.netLoss((features, targets))
-            loss.backward()
-            Optimizer.step()
-
-            # updating all meters
-            Model.meterTop1.append(float(top1.cpu().data.numpy()))
-            Model.meterTop5.append(float(top5.cpu().data.numpy()))
-            Model.meterLoss.append(float(loss.cpu().data.numpy()))
-            Model.meterSpeed.append(int(float(args.BSZ) /
-                                        (timeit.default_timer()-Timer)))
-            Timer = timeit.default_timer()
-
-            # weight visualization
-            if i % 50 == 0:
-                visplots.show_weights(Model.netEmbedding.state_dict(),
-                                      png_name=file_name)
-
-            print("... {:6d} :: ".format(Model.meterIterations) +
-                  "Cost {:2.3f} :: ".format(Model.meterLoss[-1]) +
-                  "Top1/Top5 - {:3.2f}/{:3.2f}".format(Model.meterTop1[-1],
-                                                       Model.meterTop5[-1],) +
-                  " :: {:4d} I/S    ".format(Model.meterSpeed[-1]), end="\r")
-            sys.stdout.flush()
-
-        # save every epoch and print the average of epoch
-        mean_loss = np.mean(Model.meterLoss[-i:])
-        mean_top1 = np.mean(Model.meterTop1[-i:])
-        mean_top5 = np.mean(Model.meterTop5[-i:])
-        mean_speed = int(np.mean(Model.meterSpeed[-i:]))
-        print("... {:6d} :: ".format(Model.meterIterations) +
-              "Cost {:2.3f} :: ".format(mean_loss) +
-              "Top1/Top5 - {:3.2f}/{:3.2f}".format(mean_top1, mean_top5) +
-              " :: {:4d} I/S    ".format(mean_speed))
-        # save model
-        SaveModel(Model)
-
-        test_top1, test_top5 = [], []
-        Model.netEmbedding.eval()
-        Model.netLoss.eval()
-        for i, (tensor, targets) in enumerate(teData):
-            Model.netEmbedding.zero_grad()
-            Model.netLoss.zero_grad()
-            features = Model.netEmbedding(tensor)
-            loss, (top1, top5) = Model.netLoss((features, targets))
-
-            test_top1.append(float(top1.cpu().data.numpy()))
-            test_top5.append(float(top5.cpu().data.numpy()))
-        print("... Test accuracy - {:3.2f}/{:3.2f}".format(np.mean(test_top1),
-                                                           np.mean(test_top5)))
-        Model.netEmbedding.train()
-        Model.netLoss.train()
-        Timer = timeit.default_timer()
+    def show_weights(trainer):
+        # weight visualization
+        if trainer.Model.meterIterations % 50 == 0:
+            visplots.show_weights(trainer.Model.netEmbedding.state_dict(),
+                                  png_name=file_name)
+
+    # Usual training -- saves and tests every epoch
+    Trainer(Model, Optimizer, trData, teData,
+            epochs=args.Epochs,
+            batch_size=args.BSZ,
+            cpus=args.cpus,
+            accumulate=args.accumulate,
+            sync_every=args.sync_every,
+            on_iteration=show_weights).fit()
 
     print("\nDone with training")
 
@@ -12,6 +12,11 @@ from ..NeuralLayers import Convolution, ResidualComplex, PrimaryCapsule, \
 class CapsuleNet(nn.Module):
     """
         Implemented https://arxiv.org/pdf/1710.09829.pdf for MNIST
+
+        routing_chunks -- splits the primary capsules into chunks during
+            routing to reduce the peak memory on larger images/batches
+        routing_tolerance -- when > 0, routing stops early during inference
+            once coupling coefficients converge (see RoutingCapsule)
     """
     def __init__(self,
                  tensor_size=(6, 1, 28, 28),
@@ -20,6 +25,8 @@ class CapsuleNet(nn.Module):
                  primary_capsule_length=32,
                  routing_capsule_length=16,
                  routing_iterations=3,
+                 routing_chunks=1,
+                 routing_tolerance=0.,
                  replicate_paper=True,
                  *args, **kwargs):
         super(CapsuleNet, self).__init__()
@@ -61,7 +68,9 @@ class CapsuleNet(nn.Module):
         self.Routing = RoutingCapsule(self.Primary.tensor_size,
                                       n_capsules=n_labels,
                                       capsule_length=routing_capsule_length,
-                                      iterations=routing_iterations)
+                                      iterations=routing_iterations,
+                                      chunks=routing_chunks,
+                                      tolerance=routing_tolerance)
 
         print("Routing capsule output size :: ", self.Routing.tensor_size)
         self.Reconstruction = \
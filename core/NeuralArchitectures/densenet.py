@@ -4,10 +4,15 @@ import os
 import wget
 import torch
 from ..NeuralLayers import Convolution, DenseBlock, Linear
-from ..utils import ImageNetNorm
+from ..utils import ImageNorm
+from ..NeuralEssentials.checkpoint import cached_tensors
 
 
-def map_pretrained(state_dict, type):
+def map_pretrained(state_dict, type, channels=3):
+    r""" Updates the state_dict with pretrained weights. The converted
+    weights are cached per (type, channels) in models folder
+    (ex: d121-c3-lNone.flat), and are loaded (memory-mapped) when available.
+    """
     # no fully connected
     if type == "d121":
         url = "https://download.pytorch.org/models/densenet121-a639ec97.pth"
@@ -19,9 +24,16 @@ def map_pretrained(state_dict, type):
         print(" ... pretrained weights are not avaiable for {}".format(type))
         return state_dict
 
+    path = ".../models" if os.path.isdir(".../models") else "./models"
+    cache = os.path.join(path, "{}-c{}-lNone.flat".format(type, channels))
+    state_dict.update(cached_tensors(cache, lambda: convert(
+        state_dict, os.path.join(path, url.split("/")[-1]), url)))
+    return state_dict
+
+
+def convert(state_dict, filename, url):
+    r""" Pretrained weights (from url) mapped to keys of state_dict. """
     # download is not in models
-    filename = os.path.join(".../models" if os.path.isdir(".../models") else
-                            "./models", url.split("/")[-1])
     if not os.path.isfile(filename):
         print(" ... downloading pretrained")
         wget.download(url, filename)
@@ -71,13 +83,14 @@ def map_pretrained(state_dict, type):
             pairs += [(x, tmp + "." + x.split(".")[-1])]
             assert tmp + "." + x.split(".")[-1] in prestate_dict.keys()
 
-    # update the state_dict
+    # pretrained weights of matching size
+    mapped = {}
     for x, y in pairs:
         if state_dict[x].size() == prestate_dict[y].size():
-            state_dict[x] = prestate_dict[y]
+            mapped[x] = prestate_dict[y]
 
     del prestate_dict
-    return state_dict
+    return mapped
 
 
 class DenseNet(torch.nn.Sequential):
@@ -110,6 +123,7 @@ class DenseNet(torch.nn.Sequential):
         n_embedding: when not None and > 0, adds a linear layer to the network
             and returns a torch.Tensor of shape (None, n_embedding)
         pretrained: downloads and updates the weights with pretrained weights
+            (inputs are normalized by ImageNorm, can be uint8 NHWC batches)
     """
     def __init__(self,
                  tensor_size=(6, 3, 224, 224),
@@ -132,8 +146,8 @@ class DenseNet(torch.nn.Sequential):
 
         self.pretrained = pretrained
         if self.pretrained:
-            assert tensor_size[1] == 3, \
-                "DenseNet: tensor_size[1] == 3 is required for pretrained"
+            assert tensor_size[1] == 1 or tensor_size[1] == 3, \
+                "DenseNet: rgb/grey image is required for pretrained"
             activation, normalization, pre_nm = "relu", "batch", True
             groups, weight_nm, equalized, shift = 1, False, False, False
 
@@ -159,7 +173,9 @@ class DenseNet(torch.nn.Sequential):
             print("""DenseNet: Initial convolution strides changed from 2 to 1,
                 as min(tensor_size[2], tensor_size[3]) <  64""")
         if pretrained:
-            self.add_module("ImageNetNorm", ImageNetNorm())
+            # uint8/float input to normalized rgb (grey is converted)
+            self.add_module("ImageNorm", ImageNorm(tensor_size))
+            tensor_size = self.ImageNorm.tensor_size
 
         kwargs = {"activation": activation, "normalization": normalization,
                   "weight_nm": weight_nm, "equalized": equalized,
@@ -216,14 +232,15 @@ class DenseNet(torch.nn.Sequential):
 
     def load_pretrained(self):
         if self.in_tensor_size[1] == 1 or self.in_tensor_size[1] == 3:
-            self.load_state_dict(map_pretrained(self.state_dict(), self.type))
+            self.load_state_dict(map_pretrained(self.state_dict(),
+                                                self.type, 3))
         else:
             print(" ... pretrained not available")
             self.pretrained = False
 
 
 # from core.NeuralLayers import Convolution, DenseBlock, Linear
-# from core.utils import ImageNetNorm
+# from core.utils import ImageNorm
 # tensor_size = (1, 3, 224, 224)
 # tensor = torch.rand(*tensor_size)
 # test = DenseNet(tensor_size, "d121", pretrained=True)
@@ -75,7 +75,7 @@ class FeatureNet(nn.Module):
         return y3, x3, torch.tanh(merge)
 
 class FeatureCapNet(nn.Module):
-    def __init__(self, tensor_size, *args,**kwargs):
+    def __init__(self, tensor_size, routing_tolerance=0., *args,**kwargs):
         super(FeatureCapNet,self).__init__()
         self.FeatureNET = nn.Sequential()
         normalization = "batch"
@@ -100,7 +100,8 @@ class FeatureCapNet(nn.Module):
 
         self.RoutingCapsule = RoutingCapsule(self.PrimaryCapsule.tensor_size,
                                              n_capsules=n_labels, capsule_length=routing_capsule_length,
-                                             iterations=routing_iterations)
+                                             iterations=routing_iterations,
+                                             tolerance=routing_tolerance)
         self.tensor_size = self.RoutingCapsule.tensor_size
 
     def forward(self, tensor):
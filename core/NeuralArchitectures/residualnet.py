@@ -6,11 +6,16 @@ import torch
 import torch.nn as nn
 from ..NeuralLayers import Convolution, ResidualOriginal, ResidualComplex,\
     ResidualNeXt, SEResidualComplex, SEResidualNeXt
-from ..utils import ImageNetNorm
+from ..utils import ImageNorm
+from ..NeuralEssentials.checkpoint import cached_tensors
 # =========================================================================== #
 
 
-def map_pretrained(state_dict, type):
+def map_pretrained(state_dict, type, channels=3, n_layers=None):
+    r""" Updates the state_dict with pretrained weights. The converted
+    weights are cached per (type, channels, n_layers) in models folder
+    (ex: r18-c3-lNone.flat), and are loaded (memory-mapped) when available.
+    """
     # no fully connected
     if type == "r18":
         url = r'https://download.pytorch.org/models/resnet18-5c106cde.pth'
@@ -26,9 +31,17 @@ def map_pretrained(state_dict, type):
         print(" ... pretrained weights are not avaiable for {}".format(type))
         return state_dict
 
+    path = ".../models" if os.path.isdir(".../models") else "./models"
+    cache = os.path.join(path, "{}-c{}-l{}.flat".format(type, channels,
+                                                         n_layers))
+    state_dict.update(cached_tensors(cache, lambda: convert(
+        state_dict, os.path.join(path, url.split("/")[-1]), url)))
+    return state_dict
+
+
+def convert(state_dict, filename, url):
+    r""" Pretrained weights (from url) mapped to keys of state_dict. """
     # download is not in models
-    filename = os.path.join(".../models" if os.path.isdir(".../models") else
-                            "./models", url.split("/")[-1])
     if not os.path.isfile(filename):
         print(" ... downloading pretrained")
         wget.download(url, filename)
@@ -54,13 +67,15 @@ def map_pretrained(state_dict, type):
     for x, y in zip(_labels, _prelabels):
         pairs.append((x, y.replace(y.split(".")[-1], x.split(".")[-1])))
 
-    # update the state_dict
+    # pretrained weights of matching size
+    mapped = {}
     for x, y in pairs:
-        if state_dict[x].size() == prestate_dict[y].size():
-            state_dict[x] = prestate_dict[y]
+        if y in prestate_dict and \
+                state_dict[x].size() == prestate_dict[y].size():
+            mapped[x] = prestate_dict[y]
 
     del prestate_dict
-    return state_dict
+    return mapped
 
 
 class ResidualNet(nn.Sequential):
@@ -112,6 +127,7 @@ class ResidualNet(nn.Sequential):
         n_layers: used along with pretrained, to select first n layers (not
             including InitialConvolution) of any residual network
         pretrained: downloads and updates the weights with pretrained weights
+            (inputs are normalized by ImageNorm, can be uint8 NHWC batches)
     """
 
     def __init__(self,
@@ -145,6 +161,7 @@ class ResidualNet(nn.Sequential):
             groups, weight_nm, equalized, shift = 1, False, False, False
         self.model_type = type
         self.in_tensor_size = tensor_size
+        self.n_layers = n_layers if pretrained else None
 
         if type in ("r18", "r34"):
             BaseBlock = ResidualOriginal
@@ -188,8 +205,10 @@ class ResidualNet(nn.Sequential):
                                [(2048, 2)] + [(2048, 1)]*2
 
         if pretrained:
-            print("ImageNetNorm = ON")
-            self.add_module("ImageNetNorm", ImageNetNorm())
+            print("ImageNorm = ON")
+            # uint8/float input to normalized rgb (grey is converted)
+            self.add_module("ImageNorm", ImageNorm(tensor_size))
+            tensor_size = self.ImageNorm.tensor_size
         else:
             n_layers = None
         print("Input", tensor_size)
@@ -245,7 +264,8 @@ class ResidualNet(nn.Sequential):
     def load_pretrained(self):
         if self.in_tensor_size[1] == 1 or self.in_tensor_size[1] == 3:
             self.load_state_dict(map_pretrained(self.state_dict(),
-                                                self.model_type))
+                                                self.model_type, 3,
+                                                self.n_layers))
         else:
             print(" ... pretrained not available")
             self.pretrained = False
@@ -253,7 +273,7 @@ class ResidualNet(nn.Sequential):
 
 # from core.NeuralLayers import ResidualOriginal, ResidualComplex,\
 #     ResidualNeXt, SEResidualComplex, SEResidualNeXt, Convolution
-# from core.utils import ImageNetNorm
+# from core.utils import ImageNorm
 # tensor_size = (1, 3, 224, 224)
 # tensor = torch.rand(*tensor_size)
 # test = ResidualNet(tensor_size, "r18", pretrained=True, n_layers=4)
@@ -1,16 +1,35 @@
 """ TensorMONK's :: NeuralEssentials                                        """
 
 __all__ = ["MakeModel", "SaveModel", "LoadModel",
-           "DataSets", "FolderITTR",
+           "DataSets", "TensorLoader", "FolderITTR",
            "MakeGIF", "VisPlots",
-           "Transforms", "FewPerLabel"]
+           "Transforms", "FewPerLabel", "HardNegativeSampler",
+           "Meters", "MeterBuffer", "MetricsLog", "read_metrics",
+           "Trainer", "Prefetcher", "CheckpointWriter", "save_flat",
+           "load_flat", "ResumableSampler", "Preemption",
+           "PackFolder", "PackedFolderITTR", "WriteShards", "TarShardITTR",
+           "PKBatchSampler", "Manifest", "read_image",
+           "ImageCache", "RingLoader", "AutoTune", "model_step"]
 
 from .makemodel import MakeModel, SaveModel, LoadModel
-from .datasets import DataSets
+from .datasets import DataSets, TensorLoader
 from .folderittr import FolderITTR
 from .visuals import MakeGIF, VisPlots
 from .transforms import Transforms
 from .fewperlabel import FewPerLabel
+from .hardnegativesampler import HardNegativeSampler
+from .pksampler import PKBatchSampler
+from .manifest import Manifest
+from .decoding import read_image
+from .imagecache import ImageCache
+from .ringloader import RingLoader
+from .meters import Meters, MeterBuffer, MetricsLog, read_metrics
+from .trainer import Trainer, Prefetcher
+from .checkpoint import CheckpointWriter, save_flat, load_flat
+from .resumable import ResumableSampler, Preemption
+from .packedfolder import PackFolder, PackedFolderITTR
+from .tarshards import WriteShards, TarShardITTR
+from .autotune import AutoTune, model_step
 
 
 del makemodel
@@ -19,3 +38,16 @@ del folderittr
 del visuals
 del transforms
 del fewperlabel
+del hardnegativesampler
+del pksampler
+del manifest
+del decoding
+del imagecache
+del ringloader
+del meters
+del trainer
+del checkpoint
+del resumable
+del packedfolder
+del tarshards
+del autotune
@@ -0,0 +1,311 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import json
+import socket
+import timeit
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from .resumable import ResumableSampler
+from .trainer import to_device, default_loss
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def host_profile():
+    r""" Key of the machine -- host name, cpus available and gpus. """
+    gpu = "cpu"
+    if torch.cuda.is_available():
+        gpu = "{}x{}".format(torch.cuda.get_device_name(0),
+                             torch.cuda.device_count()).replace(" ", "_")
+    return "{}-{}cpus-{}".format(socket.gethostname(), available_cpus(), gpu)
+
+
+def model_step(Model, loss_fn=None):
+    r""" Training step of a Model (MakeModel) for AutoTune -- forward and
+    backward of loss_fn (default = netLoss((netEmbedding(tensor), targets)),
+    the gradients are discarded (parameters are not updated, batch
+    normalization statistics are -- AutoTune restores the state_dict and
+    mode of nets after the trials). """
+    loss_fn = default_loss if loss_fn is None else loss_fn
+    nets = [getattr(Model, x) for x in ("netEmbedding", "netLoss")
+            if getattr(Model, x, None) is not None]
+
+    def step(tensor, targets):
+        for net in nets:
+            net.train()
+        loss, _ = loss_fn(Model, tensor, targets)
+        loss.backward()
+        for net in nets:
+            net.zero_grad(set_to_none=True)
+    step.nets = nets
+    return step
+
+
+class AutoTune:
+    r"""Tunes the DataLoader of a dataset for a machine -- num_workers,
+    prefetch_factor, pin_memory and batch_size are picked from short measured
+    trials of the pipeline (load, augment, collate and transfer to device)
+    running along with the training step of the model, and saved (json) per
+    host profile (host name, cpus and gpus) and name. Later, the saved config
+    of the host is used without trials (unless retune is True).
+
+    For every batch size, the step time of the model is measured on a
+    device resident batch. Workers are increased (0, 1, 2, 4, ...) till the
+    time per iteration is within tolerance of the step time (the model is
+    saturated) or two more worker counts do not help, then prefetch_factor
+    and pin_memory (cuda) are tried for the selected workers. A change must
+    be faster by more than tolerance, hence, the fewest workers and smallest
+    prefetch are kept. The smallest batch size within tolerance of the most
+    samples/s is selected. The state_dict and mode of the nets of step
+    (model_step) are restored after the trials.
+
+    Args:
+        data: Dataset or DataLoader (its dataset and collate_fn are used,
+            Ex: FolderITTR's loader)
+        file_name: full path + name of the json of configs,
+            Ex: ./models/autotune.json
+        step: callable(tensor, targets) on the device (Ex: model_step(Model)),
+            default = None (pipeline only)
+        name: name of the config (Ex: "imagenet-r50"), default = "default"
+        batch_sizes: candidate batch sizes, default = (32, )
+        workers: candidate num_workers, default = 0, 1, 2, 4, ... (cpus)
+        prefetch_factors: candidate prefetch_factor, default = (2, 4)
+        device: device of step, default = cuda when available else cpu
+        n_batches: batches measured per trial, default = 16
+        tolerance: relative difference considered same, default = 0.05
+        retune: runs the trials when a config is available, default = False
+        show: prints trials, default = True
+
+    Attributes:
+        config: dict of batch_size, num_workers, prefetch_factor,
+            pin_memory, samples_per_second, step_time and iteration_time
+        trials: results of all the trials (empty when config is loaded)
+
+    Ex:
+        data, n_labels = NeuralEssentials.FolderITTR("../data/train", 32,
+                                                     (1, 3, 224, 224))
+        Model = NeuralEssentials.MakeModel(...)
+        tune = NeuralEssentials.AutoTune(
+            data, "./models/autotune.json",
+            NeuralEssentials.model_step(Model),
+            name="train-r18", batch_sizes=(32, 64))
+        Trainer(Model, optimizer, tune.loader()).fit()
+    """
+    def __init__(self,
+                 data,
+                 file_name: str,
+                 step=None,
+                 name: str = "default",
+                 batch_sizes=(32, ),
+                 workers=None,
+                 prefetch_factors=(2, 4),
+                 device=None,
+                 n_batches: int = 16,
+                 tolerance: float = 0.05,
+                 retune: bool = False,
+                 show: bool = True):
+        if isinstance(data, DataLoader):
+            self.collate_fn = data.collate_fn
+            data = data.dataset
+        else:
+            self.collate_fn = getattr(data, "collate", None)
+        self.dataset = data
+        self.file_name = file_name
+        self.step = step
+        self.key = "{}@{}".format(name, host_profile())
+        self.batch_sizes = sorted(batch_sizes)
+        if workers is None:
+            cpus, workers = available_cpus(), [0]
+            while workers[-1] < cpus:
+                workers.append(min(cpus, max(1, workers[-1] * 2)))
+        self.workers = sorted(workers)
+        self.prefetch_factors = sorted(prefetch_factors)
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.n_batches = max(2, n_batches)
+        self.tolerance = tolerance
+        self.show = show
+        self.trials = []
+
+        self.config = None if retune else self.load()
+        if self.config is None:
+            self.config = self.tune()
+            self.save()
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        with open(self.file_name) as f:
+            return json.load(f).get(self.key)
+
+    def save(self):
+        configs = {}
+        if os.path.isfile(self.file_name):
+            with open(self.file_name) as f:
+                configs = json.load(f)
+        configs[self.key] = self.config
+        folder = os.path.dirname(os.path.abspath(self.file_name))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp = self.file_name + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(configs, f, indent=2, sort_keys=True)
+        os.replace(temp, self.file_name)
+
+    def sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def step_time(self, batch_size):
+        r""" Seconds per step on a device resident batch. """
+        if self.step is None:
+            return 0.
+        loader = DataLoader(self.dataset, batch_size, shuffle=True,
+                            collate_fn=self.collate_fn, drop_last=True)
+        tensor, targets = to_device(next(iter(loader)), self.device)
+        for _ in range(2):  # warm up
+            self.step(tensor, targets)
+        self.sync()
+        start = timeit.default_timer()
+        for _ in range(self.n_batches):
+            self.step(tensor, targets)
+        self.sync()
+        return (timeit.default_timer() - start) / self.n_batches
+
+    def trial(self, batch_size, num_workers, prefetch_factor, pin_memory):
+        r""" Seconds per iteration (next batch, transfer and step). Batches
+        in the prefetch queue when the workers start are not measured (they
+        are loaded and transferred without step). """
+        loader = DataLoader(self.dataset, batch_size, shuffle=True,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor if num_workers
+                            else None, pin_memory=pin_memory,
+                            collate_fn=self.collate_fn, drop_last=True)
+        n_warm = 1 + num_workers * prefetch_factor
+        n = min(self.n_batches, len(loader) - n_warm)
+        assert n > 0, "AutoTune: dataset is too small for the trials"
+        batches = iter(loader)
+        for _ in range(n_warm):
+            to_device(next(batches), self.device)
+        self.sync()
+        start = timeit.default_timer()
+        for _ in range(n):
+            batch = to_device(next(batches), self.device,
+                              non_blocking=pin_memory)
+            if self.step is not None:
+                self.step(*batch)
+        self.sync()
+        seconds = (timeit.default_timer() - start) / n
+        del batches
+        result = {"batch_size": batch_size, "num_workers": num_workers,
+                  "prefetch_factor": prefetch_factor,
+                  "pin_memory": pin_memory, "iteration_time": seconds,
+                  "samples_per_second": batch_size / seconds}
+        self.trials.append(result)
+        if self.show:
+            print(" ... batch_size {batch_size:4d} workers {num_workers:3d} "
+                  "prefetch {prefetch_factor} pin {pin_memory:d} -- "
+                  "{samples_per_second:9.1f} samples/s".format(**result))
+        return result
+
+    def within(self, seconds, reference):
+        return seconds <= reference * (1 + self.tolerance)
+
+    def tune_batch_size(self, batch_size):
+        step_time = self.step_time(batch_size)
+        pin = self.device.type == "cuda"
+        prefetch = self.prefetch_factors[0]
+        best, misses = None, 0
+        for num_workers in self.workers:
+            result = self.trial(batch_size, num_workers, prefetch, pin)
+            if best is None or result["iteration_time"] * \
+                    (1 + self.tolerance) < best["iteration_time"]:
+                best, misses = result, 0
+            else:
+                misses += 1
+                if misses == 2:
+                    break  # more workers do not help
+            if self.within(best["iteration_time"], step_time):
+                break  # saturated
+        if best["num_workers"] > 0:
+            options = [(x, pin) for x in self.prefetch_factors[1:]]
+            if pin:
+                options += [(x, False) for x in self.prefetch_factors]
+            for prefetch, pin_memory in options:
+                result = self.trial(batch_size, best["num_workers"],
+                                    prefetch, pin_memory)
+                if result["iteration_time"] * (1 + self.tolerance) < \
+                        best["iteration_time"]:
+                    best = result
+        return dict(best, step_time=step_time)
+
+    def tune(self):
+        if self.show:
+            print(" ... AutoTune " + self.key)
+        # trials must not change the model (Ex: batch normalization stats)
+        nets = getattr(self.step, "nets", [])
+        states = [({k: v.detach().clone() for k, v in
+                    net.state_dict().items()}, net.training) for net in nets]
+        try:
+            results = [self.tune_batch_size(x) for x in self.batch_sizes]
+        finally:
+            for net, (state, training) in zip(nets, states):
+                net.load_state_dict(state)
+                net.train(training)
+        fastest = max(x["samples_per_second"] for x in results)
+        # smallest batch within tolerance of the fastest
+        for result in results:
+            if result["samples_per_second"] * (1 + self.tolerance) >= \
+                    fastest:
+                return result
+
+    def loader(self, shuffle=True, sampler=None, drop_last=None):
+        r""" DataLoader of the config (ResumableSampler when sampler is
+        None). """
+        config = self.config
+        workers = config["num_workers"]
+        if sampler is None:
+            sampler = ResumableSampler(self.dataset, shuffle)
+        if drop_last is None:
+            drop_last = shuffle
+        prefetch = config["prefetch_factor"] if workers else None
+        return DataLoader(self.dataset, config["batch_size"], sampler=sampler,
+                          num_workers=workers, prefetch_factor=prefetch,
+                          pin_memory=config["pin_memory"],
+                          collate_fn=self.collate_fn,
+                          persistent_workers=workers > 0, drop_last=drop_last)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tunes the FolderITTR "
+                                     "pipeline of an image folder (without "
+                                     "a model)")
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("file_name", type=str, help="json of configs")
+    parser.add_argument("--name", type=str, default="default")
+    parser.add_argument("--height", type=int, default=224)
+    parser.add_argument("--width", type=int, default=224)
+    parser.add_argument("--channels", type=int, default=3, choices=[1, 3])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32])
+    parser.add_argument("--uint8", action="store_true")
+    parser.add_argument("--retune", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # python -m core.NeuralEssentials.autotune ../data/train \
+    #     ./models/autotune.json --batch_sizes 32 64
+    from .folderittr import FolderITTR
+    args = parse_args()
+    data, _ = FolderITTR(args.data_path, args.batch_sizes[0],
+                         (1, args.channels, args.height, args.width), 0,
+                         uint8=args.uint8)
+    print(AutoTune(data, args.file_name, name=args.name,
+                   batch_sizes=args.batch_sizes, retune=args.retune).config)
@@ -0,0 +1,245 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import json
+import hashlib
+import shutil
+import struct
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+ALIGNMENT = 64
+
+
+def flatten(data, prefix=""):
+    r""" Nested dicts to a dict of "/" separated keys. """
+    flat = {}
+    for k, v in data.items():
+        if isinstance(v, dict) and len(v):
+            flat.update(flatten(v, prefix + str(k) + "/"))
+        else:
+            flat[prefix + str(k)] = v
+    return flat
+
+
+def unflatten(flat):
+    data = {}
+    for k, v in flat.items():
+        keys = k.split("/")
+        node = data
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = v
+    return data
+
+
+def save_flat(data, f, half=False, checksum=False):
+    r""" Writes (nested dicts of) tensors to a file object in a flat format:
+    8 bytes (little endian) of header length, a json header and the raw data
+    of every tensor aligned to 64 bytes. The header has dtype, shape and
+    offset (from the start of data) of every tensor, and the other values
+    (int, float, str, list, ...) as is. When half is True, float tensors are
+    stored as float16, half can also be a tuple of key prefixes (Ex:
+    ("netEmbedding/", )) to store only their float tensors as float16.
+    When checksum is True, sha256 of the data is added to
+    the header (verified by load_flat(..., verify=True)).
+    """
+    flat = flatten(data)
+    prefixes = tuple(half) if isinstance(half, (list, tuple)) else None
+    tensors, values, offset = {}, {}, 0
+    for k, v in flat.items():
+        if not isinstance(v, torch.Tensor):
+            values[k] = v
+            continue
+        v = v.detach().cpu()
+        if half and v.is_floating_point() and \
+                (prefixes is None or k.startswith(prefixes)):
+            v = v.half()
+        nbytes = v.numel() * v.element_size()
+        tensors[k] = {"dtype": str(v.dtype).split(".")[-1],
+                      "shape": list(v.shape),
+                      "offset": offset, "nbytes": nbytes}
+        flat[k] = v
+        offset += (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    def chunks():
+        position = 0
+        for k, meta in tensors.items():
+            yield b"\0" * (meta["offset"] - position)
+            if meta["nbytes"]:
+                yield flat[k].contiguous().view(-1).view(torch.uint8).numpy()
+            position = meta["offset"] + meta["nbytes"]
+
+    header = {"tensors": tensors, "values": values}
+    if checksum:
+        sha256 = hashlib.sha256()
+        for chunk in chunks():
+            sha256.update(chunk)
+        header["sha256"] = sha256.hexdigest()
+    header = json.dumps(header).encode()
+    header += b" " * ((- len(header) - 8) % ALIGNMENT)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for chunk in chunks():
+        f.write(chunk)
+
+
+def load_flat(file_name, prefixes=None, verify=False):
+    r""" Memory-maps a file from save_flat (copy-on-write, no copies are
+    made till the tensors are modified or moved) and returns the nested
+    dicts. When prefixes (list of str) is given, only the keys that start
+    with any of the prefixes are loaded (Ex: ["netEmbedding"]). When verify
+    is True, raises ValueError if the sha256 of data is missing or does not
+    match (reads all the data).
+    """
+    with open(file_name, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(length).decode())
+    start = 8 + length
+    memory = np.memmap(file_name, np.uint8, "c") \
+        if os.path.getsize(file_name) > start else None
+    if verify:
+        sha256 = hashlib.sha256(b"" if memory is None else memory[start:])
+        if header.get("sha256") != sha256.hexdigest():
+            raise ValueError("load_flat: checksum mismatch in " + file_name)
+
+    def requested(k):
+        return prefixes is None or any(k.startswith(p) for p in prefixes)
+
+    flat = {k: v for k, v in header["values"].items() if requested(k)}
+    for k, meta in header["tensors"].items():
+        if not requested(k):
+            continue
+        dtype = getattr(torch, meta["dtype"])
+        if meta["nbytes"] == 0:
+            flat[k] = torch.empty(meta["shape"], dtype=dtype)
+            continue
+        flat[k] = torch.frombuffer(memory, dtype=dtype,
+                                   count=meta["nbytes"] //
+                                   torch.empty(0, dtype=dtype).element_size(),
+                                   offset=start + meta["offset"]
+                                   ).view(meta["shape"])
+    return unflatten(flat)
+
+
+def cached_tensors(file_name, convert):
+    r""" Returns the dict of tensors in file_name (load_flat, verified with
+    sha256), else, computes convert() (dict of tensors) and saves it to
+    file_name with a checksum (atomic rename). """
+    if os.path.isfile(file_name):
+        try:
+            return load_flat(file_name, verify=True)
+        except (ValueError, OSError, KeyError, struct.error):
+            print(" ... ignoring invalid cache {}".format(file_name))
+    data = convert()
+    temp = file_name + ".tmp"
+    with open(temp, "wb") as f:
+        save_flat(data, f, checksum=True)
+    os.replace(temp, file_name)
+    return data
+
+
+class CheckpointWriter:
+    r"""Saves checkpoints without stalling training. save() snapshots the
+    tensors into reused (pinned, when cuda is available) cpu buffers and
+    returns, the serialization is done in a background thread. Every file is
+    written to file_name + ".tmp" and atomically renamed, older checkpoints
+    are rotated to file_name.1, ..., file_name.(keep-1).
+
+    Only one save is in flight -- a save waits for the previous write to
+    finish (the buffers are reused), that wait and the snapshot is the
+    latency seen by training (latency), while write_time is the time taken
+    by the background thread.
+
+    Args:
+        keep: number of checkpoints retained, default = 1
+
+    Ex:
+        writer = CheckpointWriter(keep=3)
+        writer.save({"netEmbedding": net.state_dict()}, "./models/net.t7")
+        writer.wait()
+    """
+    def __init__(self, keep: int = 1):
+        self.keep = max(1, keep)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.buffers = {}
+        self.latency, self.write_time = 0., 0.
+
+    def snapshot(self, data, key=""):
+        r""" Copies tensors (in nested dicts/lists) to cpu buffers. """
+        if isinstance(data, torch.Tensor):
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != data.shape or \
+                    buffer.dtype != data.dtype:
+                buffer = torch.empty(data.shape, dtype=data.dtype,
+                                     pin_memory=data.is_cuda)
+                self.buffers[key] = buffer
+            buffer.copy_(data.detach(), non_blocking=data.is_cuda)
+            return buffer
+        if isinstance(data, dict):
+            snapshot = type(data)((k, self.snapshot(v, key + "/" + str(k)))
+                                  for k, v in data.items())
+            if hasattr(data, "_metadata"):  # state_dict versions
+                snapshot._metadata = data._metadata
+            return snapshot
+        if isinstance(data, (list, tuple)):
+            return type(data)(self.snapshot(v, key + "/" + str(i))
+                              for i, v in enumerate(data))
+        return data
+
+    def save(self, data, file_name, blocking=False, serialize=None):
+        r""" Snapshots data and writes it to file_name in the background
+        (blocking=True waits for the write). serialize(data, file_object)
+        writes the file, default = torch.save. """
+        start = timeit.default_timer()
+        self.wait()
+        data = self.snapshot(data)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.future = self.executor.submit(self.write, data, file_name,
+                                           serialize or torch.save)
+        if blocking:
+            self.wait()
+        self.latency = timeit.default_timer() - start
+        return self.latency
+
+    def write(self, data, file_name, serialize):
+        start = timeit.default_timer()
+        temp = file_name + ".tmp"
+        with open(temp, "wb") as f:
+            serialize(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        rotate(file_name, self.keep)
+        os.replace(temp, file_name)
+        self.write_time = timeit.default_timer() - start
+
+    def wait(self):
+        r""" Waits for the write in flight, raises its exception if any. """
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def rotate(file_name, keep):
+    r""" file_name.(i-1) -> file_name.i, and file_name is linked (or copied)
+    to file_name.1 -- file_name exists till it is replaced. """
+    if keep < 2 or not os.path.isfile(file_name):
+        return
+    for i in range(keep - 1, 1, -1):
+        if os.path.isfile(file_name + "." + str(i - 1)):
+            os.replace(file_name + "." + str(i - 1), file_name + "." + str(i))
+    if os.path.isfile(file_name + ".1"):
+        os.remove(file_name + ".1")
+    try:
+        os.link(file_name, file_name + ".1")
+    except OSError:
+        shutil.copyfile(file_name, file_name + ".1")
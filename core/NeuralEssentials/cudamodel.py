@@ -2,6 +2,7 @@
 
 import torch
 import torch.nn as nn
+from ..utils import ImageNorm
 
 
 class CudaModel(torch.nn.Module):
@@ -27,20 +28,25 @@ class CudaModel(torch.nn.Module):
 
     def check_precision_device(self, inputs):
         r"""Converts the inputs to float or half using parameter precision and
-        to cuda if is_cuda.
+        to cuda if is_cuda. uint8 inputs of networks with ImageNorm are moved
+        as uint8 (converted and normalized on the device by ImageNorm).
         """
         if not hasattr(self, "precision"):
             for p in self.parameters():
                 break
             self.precision = p.dtype if "p" in locals() else torch.float32
+            self.keep_uint8 = any(isinstance(x, ImageNorm)
+                                  for x in self.NET46.modules())
+        keep = (torch.long, torch.uint8) if self.keep_uint8 else \
+            (torch.long, )
         if type(inputs) in [list, tuple]:
-            inputs = [x if x.dtype == torch.long else x.type(self.precision)
+            inputs = [x if x.dtype in keep else x.type(self.precision)
                       for x in inputs]
             if self.is_cuda:
                 inputs = [x.cuda() for x in inputs]
             return inputs
         else:
-            if not (inputs.dtype == torch.long):
+            if inputs.dtype not in keep:
                 inputs = inputs.type(self.precision)
             if self.is_cuda:
                 inputs = inputs.cuda()
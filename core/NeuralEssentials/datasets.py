@@ -1,12 +1,105 @@
 """ TensorMONK's :: NeuralEssentials                                        """
 
 import os
+import numpy as np
+import torch
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import multiprocessing
 from torchvision import datasets
 from torchvision.transforms import RandomApply, ColorJitter, \
     RandomResizedCrop, RandomRotation, Compose, ToTensor, Normalize, \
     RandomHorizontalFlip
+from .transforms import Transforms
+from .resumable import ResumableSampler
+from .ringloader import RingLoader
+
+
+class TensorLoader:
+    r"""Iterates batches of a dataset held in memory as a uint8 NCHW tensor
+    (no workers, no per sample conversion). The order of every epoch is from
+    sampler (ResumableSampler, shuffled with seed + epoch and resumable by
+    Trainer), a full pass moves to the next epoch. Every batch is indexed,
+    converted to float in the range [0, 1], resized to tensor_size (when
+    different), augmented (transforms, Ex: Transforms) and normalized with
+    mean and std. When dtype is torch.uint8, batches are returned as is
+    (uint8 NCHW) -- transforms and normalization are skipped.
+
+    Args:
+        tensor: uint8 tensor of shape (N, C, H, W)
+        targets: long tensor of labels
+        batch_size: samples per batch
+        shuffle: random order every epoch, default = True
+        drop_last: drops the last incomplete batch, default = False
+        transforms: callable on float batches (NCHW), default = None
+        mean, std: per channel normalization, default = None
+        tensor_size: BCHW of batches, default = None (tensor's size)
+        dtype: torch.float32 or torch.uint8, default = torch.float32
+        seed: default = 0
+    """
+    def __init__(self, tensor, targets, batch_size, shuffle=True,
+                 drop_last=False, transforms=None, mean=None, std=None,
+                 tensor_size=None, dtype=torch.float32, seed=0):
+        self.tensor = tensor
+        self.targets = targets
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.sampler = ResumableSampler(tensor.size(0), shuffle, seed)
+        self.transforms = transforms
+        self.mean = None if mean is None else \
+            torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = None if std is None else \
+            torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.size = None if tensor_size is None or \
+            tuple(tensor_size[2:]) == tuple(tensor.shape[2:]) else \
+            tuple(tensor_size[2:])
+        self.dtype = dtype
+
+    def __len__(self):
+        n = len(self.sampler)
+        return n // self.batch_size if self.drop_last else \
+            - (- n // self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        epoch = self.sampler.epoch
+        indices = self.sampler.indices()
+        if self.drop_last:
+            indices = indices[:len(self) * self.batch_size]
+        for idx in indices.split(self.batch_size):
+            tensor, targets = self.tensor[idx], self.targets[idx]
+            if self.dtype == torch.uint8:
+                yield tensor, targets
+                continue
+            tensor = tensor.float().div_(255)
+            if self.size is not None:
+                tensor = F.interpolate(tensor, size=self.size,
+                                       mode="bilinear", align_corners=False)
+            if self.transforms is not None:
+                tensor = self.transforms(tensor)
+            if self.mean is not None:
+                tensor = tensor.sub_(self.mean).div_(self.std)
+            yield tensor, targets
+        # a full pass -- next iteration is the next epoch (unless set_epoch
+        # or advance already moved the sampler, Ex: Trainer)
+        if self.sampler.epoch == epoch:
+            self.sampler.set_epoch(epoch + 1)
+
+
+def load_tensors(data):
+    r""" uint8 NCHW tensor and long tensor of labels of a torchvision
+    MNIST/FashionMNIST/CIFAR10/CIFAR100 dataset. """
+    tensor = data.data
+    if isinstance(tensor, np.ndarray):  # CIFAR -- NHWC
+        tensor = torch.from_numpy(tensor).permute(0, 3, 1, 2)
+    else:  # MNIST -- NHW
+        tensor = tensor.unsqueeze(1)
+    targets = data.targets
+    targets = targets.long() if isinstance(targets, torch.Tensor) else \
+        torch.tensor(targets, dtype=torch.long)
+    return tensor.contiguous(), targets
 
 
 def DataSets(dataset="MNIST",
@@ -14,7 +107,9 @@ def DataSets(dataset="MNIST",
              tensor_size=None,
              n_samples=64,
              cpus=multiprocessing.cpu_count(),
-             augment=False):
+             augment=False,
+             in_memory=False,
+             ring=False):
     r"""Train, validation and test dataset iterator for
     MNIST/FashionMNIST/CIFAR10/CIFAR100
 
@@ -27,7 +122,13 @@ def DataSets(dataset="MNIST",
         cpus (int, optional): numbers of cpus used by dataloader,
             default = cpu_count
         augment (bool, optional): when True, does color jitter, random crop
-            and random rotation
+            and random rotation (Transforms on batches when in_memory)
+        in_memory (bool/str, optional): when True, train and test data are
+            TensorLoader's of the whole split in memory (normalized batches,
+            no workers), "uint8" returns uint8 batches, default = False
+        ring (bool, optional): when True (and in_memory is False), train and
+            test data are RingLoader's (cpus workers write to shared batch
+            buffers), default = False
 
     Return:
         train data iterator, test data iterator and n_labels
@@ -72,6 +173,25 @@ def DataSets(dataset="MNIST",
         # TODO
         pass
 
+    if in_memory:
+        normalize = basics[-1]
+        kwargs = {"batch_size": n_samples, "tensor_size": tensor_size,
+                  "mean": normalize.mean, "std": normalize.std,
+                  "dtype": torch.uint8 if in_memory == "uint8" else
+                  torch.float32}
+        teData = TensorLoader(*load_tensors(loader(root=folder, train=False,
+                                                   download=True)),
+                              shuffle=False, **kwargs)
+        transforms = None
+        if augment:
+            transforms = Transforms(p_fliplr=0. if dataset in
+                                    ["mnist", "fashionmnist"] else .25)
+        trData = TensorLoader(*load_tensors(loader(root=folder, train=True,
+                                                   download=False)),
+                              shuffle=True, drop_last=True,
+                              transforms=transforms, **kwargs)
+        return trData, None, teData, n_labels, tensor_size
+
     # test data
     teData = loader(root=folder, train=False, download=True,
                     transform=Compose(basics))
@@ -95,6 +215,11 @@ def DataSets(dataset="MNIST",
                     transform=Compose(basics))
     #trData = DataLoader(trData, batch_size=n_samples,
     #                    shuffle=True, num_workers=cpus)
+    if ring:
+        teData = RingLoader(teData.dataset, n_samples, shuffle=False,
+                            workers=cpus)
+        trData = RingLoader(trData, n_samples, shuffle=True, workers=cpus,
+                            drop_last=True)
     return trData, vaData, teData, n_labels, tensor_size
 
 
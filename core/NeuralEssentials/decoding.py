@@ -0,0 +1,133 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import math
+import random
+import timeit
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image as ImPIL
+
+
+def random_crop_box(size, scale=(0.08, 1.), ratio=(3. / 4, 4. / 3),
+                    rng=random):
+    r""" Random box (left, upper, right, lower) of an image of size (w, h)
+    with an area in scale and aspect ratio in ratio (same as
+    RandomResizedCrop), center crop when no valid box is found in 10
+    attempts. """
+    w, h = size
+    area = w * h
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    for _ in range(10):
+        target = area * rng.uniform(*scale)
+        aspect = math.exp(rng.uniform(*log_ratio))
+        cw = int(round(math.sqrt(target * aspect)))
+        ch = int(round(math.sqrt(target / aspect)))
+        if 0 < cw <= w and 0 < ch <= h:
+            x, y = rng.randint(0, w - cw), rng.randint(0, h - ch)
+            return (x, y, x + cw, y + ch)
+    # fallback -- center crop within the ratio
+    if w / h < ratio[0]:
+        cw, ch = w, int(round(w / ratio[0]))
+    elif w / h > ratio[1]:
+        cw, ch = int(round(h * ratio[1])), h
+    else:
+        cw, ch = w, h
+    x, y = (w - cw) // 2, (h - ch) // 2
+    return (x, y, x + cw, y + ch)
+
+
+def read_image(file_name, tensor_size, crop=None, draft=True):
+    r""" Reads an image and resizes to tensor_size (BCHW). crop is None
+    (full image) or a function of image size (w, h) that returns a box
+    (Ex: random_crop_box), the box is cropped before resize. When draft is
+    True, JPEGs are decoded at a reduced scale (1/2, 1/4 or 1/8, DCT scaling)
+    when the box is at least twice as large as tensor_size. """
+    image = ImPIL.open(file_name)
+    w, h = tensor_size[3], tensor_size[2]
+    mode = "L" if tensor_size[1] == 1 else "RGB"
+    size = image.size
+    box = (0, 0) + size if crop is None else crop(size)
+    if draft and image.format == "JPEG":
+        scale = min((box[2] - box[0]) / w, (box[3] - box[1]) / h)
+        if scale >= 2:
+            image.draft(mode, (math.ceil(size[0] / scale),
+                               math.ceil(size[1] / scale)))
+            sx, sy = image.size[0] / size[0], image.size[1] / size[1]
+            box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image.resize((w, h), ImPIL.BILINEAR, box=box)
+
+
+class ThreadedItems:
+    r""" Mixin for datasets -- DataLoader (automatic batching) fetches a
+    batch with __getitems__, and the samples are loaded in a pool of
+    threads (per worker process, PIL releases the GIL while decoding and
+    resizing) when threads > 1. """
+    threads = 1
+
+    def __getitems__(self, indices):
+        if self.threads < 2 or len(indices) < 2:
+            return [self[i] for i in indices]
+        pool = getattr(self, "_pool", None)
+        if pool is None or pool[0] != os.getpid():
+            pool = (os.getpid(), ThreadPoolExecutor(self.threads))
+            self._pool = pool
+        return list(pool[1].map(self.__getitem__, indices))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_pool", None)
+        return state
+
+
+def benchmark(files, tensor_size=(1, 3, 224, 224), threads=1):
+    r""" Images/s per core to read files at tensor_size -- full decode +
+    resize, draft decode + resize and draft decode + random crop + resize.
+    """
+    methods = (("full decode", dict(draft=False)),
+               ("draft", dict(draft=True)),
+               ("draft + random crop", dict(draft=True,
+                                            crop=random_crop_box)))
+    results = {}
+    for name, kwargs in methods:
+        def read(file_name):
+            return read_image(file_name, tensor_size, **kwargs)
+        start = timeit.default_timer()
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(read, files))
+        else:
+            for x in files:
+                read(x)
+        results[name] = len(files) / (timeit.default_timer() - start) / \
+            threads
+        print(" ... {:<20} {:8.1f} images/s/core".format(name,
+                                                         results[name]))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of image "
+                                     "decoding (images/s per core)")
+    parser.add_argument("data_path", type=str,
+                        help="folder of images (or class folders)")
+    parser.add_argument("--height", type=int, default=224)
+    parser.add_argument("--width", type=int, default=224)
+    parser.add_argument("--n_images", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # python -m core.NeuralEssentials.decoding ../data/train --threads 4
+    args = parse_args()
+    files = []
+    for folder, _, names in os.walk(args.data_path):
+        files += [os.path.join(folder, x) for x in sorted(names)
+                  if x.lower().endswith((".jpg", ".jpeg", ".png"))]
+        if len(files) >= args.n_images:
+            break
+    benchmark(files[:args.n_images], (1, 3, args.height, args.width),
+              args.threads)
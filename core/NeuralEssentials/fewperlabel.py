@@ -1,15 +1,14 @@
 """ TensorMONK's :: NeuralEssentials                                        """
 
 import os
-from random import shuffle
-from functools import reduce
-from PIL import Image as ImPIL
+from functools import partial
 from tqdm import trange
 import numpy as np
 from torch.utils.data import Dataset
 from torchvision import transforms
-
-IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+from .manifest import Manifest, IMAGE_EXTENSIONS
+from .decoding import read_image, random_crop_box, ThreadedItems
+from .imagecache import ImageCache
 
 
 def list_images(folder):
@@ -20,104 +19,131 @@ def list_images(folder):
     return images
 
 
-class FewPerLabel(Dataset):
-    r"""Folder iterator to sample n consecutive samples per label. Batch size
-    must be equal a multiplier of n to get valid sets. On a dataset with 10
+class FewPerLabel(ThreadedItems, Dataset):
+    r"""Folder iterator to sample n consecutive samples per label, use along
+    with PKBatchSampler (or HardNegativeSampler) that composes batches of
+    P labels x n_consecutive (K) samples per label. On a dataset with 10
     labels, with n = 2, an example batch can yeild the following labels
     0 0 2 2 6 6 1 1 6 6
 
+    The dataset is stateless -- samples are indexed by a flat index (files
+    sorted by label, offsets[label] is the index of the first sample of
+    label), hence, safe with any number of DataLoader workers.
+
     Args:
         path: full path to folders, where each folder represents a class
         tensor_size: a list/tuple of tensor shape in BCHW Ex: (None, 3, 64, 64)
         n_consecutive: delivers n_consecutive samples per label, must be >= 2
-        process_image: None (reads and resizes to tensor_size) or function to
-                       read and modify
+                       (default K of the samplers)
+        process_image: None (reads and resizes to tensor_size, JPEGs are
+                       decoded at a reduced scale, see read_image) or
+                       function to read and modify
         augmentations: a list/tuple of functions to augment pil image
+        n_samples: samples per epoch used by the samplers, default = None
+                   (number of images)
+        manifest: full path + name of a Manifest of path (built when
+                  missing, rescans the changed folders), default = None
+                  (scans all the folders)
+        random_crop: random crop (scale and aspect ratio of
+                     RandomResizedCrop) before resize, used when
+                     process_image is None, default = False
+        threads: threads per worker to load the samples of a batch,
+                 default = 1
+        cache: ImageCache (or budget in bytes) of process_image outputs
+               shared across epochs and workers, default = None
+        context: multiprocessing context of the DataLoader workers, used
+                 when cache is a budget (see ImageCache), default = None
 
     Returns:
-        a torch.Tensor image with values in the range [0, 1] and
-        torch.LongTensor label
+        a torch.Tensor image with values in the range [0, 1] and label
     """
     def __init__(self, path, tensor_size, n_consecutive, process_image=None,
-                 augmentations=[], n_samples=int(1e6)):
+                 augmentations=[], n_samples=None, manifest=None,
+                 random_crop=False, threads=1, cache=None, context=None):
         # get all folders
         if isinstance(path, str):
             path = [path]
-        folders = []
-        for p in path:
-            for folder in next(os.walk(p))[1]:  # only immediate folders
-                folders.append(os.path.join(p, folder))
-        self.folders = sorted(folders)
-
-        # read all images -- creates a list of lists
-        self.dataset = []
-        self.n_per_label = []
-        for i in trange(len(self.folders), desc="CouplePerClass"):
-            images = list_images(folders[i])
-            if len(images) > 0:
-                self.dataset.append(images)
-                self.n_per_label.append(len(images))
-
-        # random list to pick labels and samples
-        self.n_labels = len(self.dataset)
+        if manifest is not None:
+            manifest = Manifest(path, manifest, image_folder=False)
+            self.folders = manifest.folders
+            self.files = manifest.files
+            self.n_per_label = manifest.n_per_label
+        else:
+            folders = []
+            for p in path:
+                for folder in next(os.walk(p))[1]:  # only immediate folders
+                    folders.append(os.path.join(p, folder))
+            self.folders = sorted(folders)
+
+            # read all images -- flat list of files sorted by label
+            self.files = []
+            self.n_per_label = []
+            for i in trange(len(self.folders), desc="CouplePerClass"):
+                images = list_images(self.folders[i])
+                if len(images) > 0:
+                    self.files += images
+                    self.n_per_label.append(len(images))
+            self.n_per_label = np.array(self.n_per_label, np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_per_label)))
+        self.labels = np.repeat(np.arange(len(self.n_per_label)),
+                                self.n_per_label)
+
+        self.n_labels = len(self.n_per_label)
         self.n_consecutive = n_consecutive
-        self.true_n_samples = np.sum(self.n_per_label)
-        self.random_labels = self.get_random_list(self.n_labels, None,
-                                                  self.n_consecutive)
+        self.true_n_samples = len(self.files)
+        self.n_samples = self.true_n_samples if n_samples is None else \
+            n_samples
 
         # process_image
         self.tensor_size = tensor_size
         if process_image is None:
-            def process_image(x):
-                x = ImPIL.open(x)
-                x = x.resize((tensor_size[3], tensor_size[2]), ImPIL.BILINEAR)
-                return x
+            process_image = partial(read_image, tensor_size=tensor_size,
+                                    crop=random_crop_box if random_crop
+                                    else None)
+        # uncached reader, used by HardNegativeSampler's background process
+        self.read = process_image
+        if isinstance(cache, int):
+            cache = ImageCache(cache, tensor_size, context)
+        if cache is not None:
+            assert not random_crop, \
+                "FewPerLabel: cache requires random_crop = False"
+            process_image = partial(cache.read, read=process_image)
         self.process_image = process_image
+        self.cache = cache
+        self.threads = threads
 
         # augmentations
         self.augmentations = augmentations
-        self.n_samples = n_samples
         self.to_tensor = transforms.ToTensor()
 
     def __len__(self):
-        return self.n_samples
+        return self.true_n_samples
 
     def __getitem__(self, idx):
-        label = self.random_labels.pop(0)
-        file_name = self.dataset[label][idx % self.n_per_label[label]]
-        image = self.process_image(file_name)
+        return self.load(idx), int(self.labels[idx])
 
-        for fn in self.augmentations:
-            image = fn(image)
+    def label_files(self, label):
+        return self.files[self.offsets[label]:self.offsets[label + 1]]
 
-        if self.tensor_size[1] == 1:
-            image = image.convert("L")
+    def load(self, idx, augment=True):
+        image = self.process_image(self.files[idx])
 
-        if len(self.random_labels) == 0:
-            # generates random order of labels
-            self.random_labels = self.get_random_list(self.n_labels, label,
-                                                      self.n_consecutive)
-        return self.to_tensor(image), label
+        if augment:
+            for fn in self.augmentations:
+                image = fn(image)
 
-    @staticmethod
-    def get_random_list(n_labels, last=None, n_consecutive=1):
-        random_labels = list(range(0, n_labels))
-        shuffle(random_labels)
-        if last is not None and last == random_labels[0]:
-            random_labels = random_labels[1:] + random_labels[:1]
-        if n_consecutive > 1:
-            random_labels = [[x] * n_consecutive for x in random_labels]
-            random_labels = reduce(lambda x, y: x + y, random_labels)
-        return random_labels
+        if self.tensor_size[1] == 1:
+            image = image.convert("L")
+        return self.to_tensor(image)
 
 
 # import core
 # import multiprocessing
 # trData = core.NeuralEssentials.FewPerLabel("../data/test_folders",
-#     (1, 3, 128, 128), 2, process_image=None,
-    # augmentations=[], n_samples=int(500))
+#     (1, 3, 128, 128), 2, process_image=None, augmentations=[])
+# sampler = core.NeuralEssentials.PKBatchSampler(trData, 8, 2)
 # trDataLoader = torch.utils.data.DataLoader(trData,
-#     batch_size=16, shuffle=True, num_workers=multiprocessing.cpu_count())
+#     batch_sampler=sampler, num_workers=multiprocessing.cpu_count())
 #
 # for x, y in trDataLoader:
 #     break
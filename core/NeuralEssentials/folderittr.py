@@ -1,30 +1,107 @@
 """ TensorMONK's :: NeuralEssentials                                        """
 
 import os
+from functools import partial
+import numpy as np
 import torch
 import torchvision.datasets as DataSET
 import torchvision.transforms as DataMods
 from random import random as rand01
 from PIL import Image as ImPIL
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+from .resumable import ResumableSampler
+from .manifest import Manifest, ManifestFolder
+from .decoding import read_image, random_crop_box, ThreadedItems
+from .imagecache import ImageCache
+from .ringloader import RingLoader
+
+
+class ThreadedImageFolder(ThreadedItems, DataSET.ImageFolder):
+    pass
+
+
+# module level (picklable for spawn workers)
+def random_flip_pil(x):
+    return x.transpose(ImPIL.FLIP_LEFT_RIGHT) if rand01() > .5 else x
+
+
+def resize_pil(x, tensor_size):
+    return x.resize((tensor_size[3], tensor_size[2]), ImPIL.BILINEAR)
+
+
+def pil_to_uint8(x):
+    return torch.from_numpy(np.array(x, np.uint8).reshape(
+        x.size[1], x.size[0], -1))
 
 
 def FolderITTR(data_path, BSZ,
                tensor_size=(6, 3, 28, 28),
                cpus=6,
                functions=[],
-               random_flip=True):
-
-    def flip(x):
-        return x.transpose(ImPIL.FLIP_LEFT_RIGHT) if rand01() > .5 else x
+               random_flip=True,
+               resumable=False,
+               manifest=None,
+               random_crop=False,
+               threads=1,
+               cache=None,
+               ring=False,
+               uint8=False,
+               context=None):
+    r"""ImageFolder data loader and number of labels. When resumable is True,
+    shuffling is done by ResumableSampler (DataLoader.sampler), its position
+    is saved and restored by Trainer. When manifest (full path + name of a
+    Manifest of data_path) is given, files are listed from the manifest
+    instead of scanning data_path.
 
-    def resize(x):
-        return x.resize((tensor_size[3], tensor_size[2]), ImPIL.BILINEAR)
+    Without functions, images are read by read_image -- JPEGs are decoded at
+    a reduced scale when tensor_size is much smaller, and random_crop (scale
+    and aspect ratio of RandomResizedCrop) is cropped before resize. threads
+    (> 1) loads the samples of a batch in a pool of threads per worker.
+    functions (on the full pil image, before resize) use a full decode.
+    cache (ImageCache or budget in bytes) shares decoded and resized images
+    across epochs and workers (requires no functions and random_crop).
+    context is the multiprocessing context of the workers and of the cache
+    when cache is a budget (Ex: "spawn"), default = None.
+    When ring is True, returns a RingLoader (workers write to shared batch
+    buffers) instead of a DataLoader. When uint8 is True, batches are uint8
+    BHWC (instead of float BCHW, normalized on the device by ImageNorm).
+    """
+    if isinstance(cache, int):
+        cache = ImageCache(cache, tensor_size, context)
+    assert cache is None or not (len(functions) or random_crop), \
+        "FolderITTR: cache requires functions = [] and random_crop = False"
 
-    mods = list(functions) + [resize, ] + ([flip, ] if random_flip else []) + \
-        [DataMods.ToTensor(), ]
-    data = DataSET.ImageFolder(data_path, DataMods.Compose(mods))
+    resize = partial(resize_pil, tensor_size=tensor_size)
+    flip = random_flip_pil
+    if len(functions):
+        loader = default_loader
+        mods = list(functions) + [resize, ]
+    else:
+        loader = partial(read_image, tensor_size=tensor_size,
+                         crop=random_crop_box if random_crop else None)
+        if cache is not None:
+            loader = partial(cache.read, read=loader)
+        mods = []
+    mods += ([flip, ] if random_flip else []) + \
+        [pil_to_uint8 if uint8 else DataMods.ToTensor(), ]
+    if manifest is not None:
+        data = ManifestFolder(Manifest(data_path, manifest, IMG_EXTENSIONS),
+                              DataMods.Compose(mods), loader, threads)
+        n_labels = len(data.classes)
+    else:
+        data = ThreadedImageFolder(data_path, DataMods.Compose(mods),
+                                   loader=loader)
+        data.threads = threads
+        n_labels = len(next(os.walk(data_path))[1])
+    if ring:  # always resumable
+        return (RingLoader(data, BSZ, workers=cpus, context=context),
+                n_labels)
+    sampler = ResumableSampler(data) if resumable else None
     data_loader = torch.utils.data.DataLoader(data, batch_size=BSZ,
-                                              shuffle=True, num_workers=cpus)
-    n_labels = len(next(os.walk(data_path))[1])
+                                              shuffle=sampler is None,
+                                              sampler=sampler,
+                                              num_workers=cpus,
+                                              multiprocessing_context=context
+                                              if cpus > 0 else None)
 
     return (data_loader, n_labels)
@@ -0,0 +1,305 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import copy
+import queue
+import signal
+import warnings
+import traceback
+from collections import deque
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.multiprocessing as mp
+from torch.utils.data import Sampler
+from torchvision import transforms
+
+
+def class_neighbors(network, files, process_image, tensor_size,
+                    n_neighbors):
+    r""" Embeds the samples of every label (files -- list of paths per
+    label) with network, and returns the n_neighbors nearest labels (cosine
+    similarity of label centroids) per label -- numpy.ndarray of shape
+    (n_labels, n_neighbors).
+    """
+    to_tensor = transforms.ToTensor()
+    network.eval()
+
+    centroids = []
+    with torch.no_grad():
+        for images in files:
+            tensor = []
+            for x in images:
+                image = process_image(x)
+                if tensor_size[1] == 1:
+                    image = image.convert("L")
+                tensor.append(to_tensor(image))
+            embedding = network(torch.stack(tensor, 0))
+            if isinstance(embedding, (list, tuple)):
+                embedding = embedding[0]
+            embedding = F.normalize(embedding.view(len(images), -1), p=2,
+                                    dim=1)
+            centroids.append(embedding.mean(0))
+    centroids = F.normalize(torch.stack(centroids, 0), p=2, dim=1)
+
+    # nearest labels (excluding self), in chunks of 1024 labels
+    n_neighbors = min(n_neighbors, centroids.size(0) - 1)
+    neighbors = []
+    for i, chunk in enumerate(centroids.split(1024, 0)):
+        similarity = chunk.mm(centroids.t())
+        own = torch.arange(chunk.size(0))
+        similarity[own, own + i * 1024] = - 2.
+        neighbors.append(similarity.topk(n_neighbors, 1)[1])
+    return torch.cat(neighbors, 0).numpy().astype(np.int64)
+
+
+def neighbors_worker(network, process_image, tensor_size, n_neighbors, cpus,
+                     tasks, results):
+    r""" Background process of HardNegativeSampler -- for every task
+    (state_dict of network, files per label), loads the weights and returns
+    (neighbors, error). """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # handled by the parent
+    torch.set_num_threads(cpus)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        state, files = task
+        try:
+            network.load_state_dict(state)
+            del state
+            results.put((class_neighbors(network, files, process_image,
+                                         tensor_size, n_neighbors), None))
+        except Exception:
+            results.put((None, traceback.format_exc()))
+
+
+class HardNegativeSampler(Sampler):
+    r"""Batch sampler for FewPerLabel that composes batches from mutually
+    confusable labels. Every refresh_every batches, n_representatives
+    random samples per label and a snapshot of the network's weights (on
+    cpu) are sent to a background process (started once, with a copy of
+    the network), which embeds the samples and computes the nearest labels
+    of every label centroid. Till the first refresh is done, labels are
+    random.
+
+    Trainer calls snapshot after every optimizer step, hence, the weights
+    are copied at a step boundary on the training thread (never in the
+    middle of an update). Without Trainer, the weights are copied by the
+    thread iterating the sampler when the refresh is due.
+
+    A batch has n_labels_per_batch (P) labels with n_consecutive (K) samples
+    each -- a random label and its nearest labels (and theirs, till P labels
+    are picked). The sampler runs in the main process and yields
+    FewPerLabel indices (offsets[label] + sample), hence, is safe to use with
+    any number of DataLoader workers.
+
+    Args:
+        dataset: FewPerLabel
+        network: embedding network (Ex: Model.netEmbedding)
+        n_labels_per_batch: P, number of labels per batch
+        n_consecutive: K, samples per label, default = dataset.n_consecutive
+        n_batches: batches per epoch, default = len(dataset) // (P*K)
+        refresh_every: batches between refresh of nearest labels,
+            default = 1000
+        n_representatives: samples per label to compute centroids,
+            default = 4
+        n_neighbors: nearest labels per label, default = P
+        seed: random seed, default = 0
+        cpus: threads used by the background process, default = 2
+
+    Ex:
+        sampler = HardNegativeSampler(trData, Model.netEmbedding, 16)
+        loader = DataLoader(trData, batch_sampler=sampler, num_workers=4)
+    """
+    def __init__(self,
+                 dataset,
+                 network,
+                 n_labels_per_batch: int,
+                 n_consecutive: int = None,
+                 n_batches: int = None,
+                 refresh_every: int = 1000,
+                 n_representatives: int = 4,
+                 n_neighbors: int = None,
+                 seed: int = 0,
+                 cpus: int = 2):
+        self.dataset = dataset
+        self.network = network
+        self.n_labels = dataset.n_labels
+        self.p = min(n_labels_per_batch, self.n_labels)
+        self.k = n_consecutive if n_consecutive is not None else \
+            dataset.n_consecutive
+        self.n_batches = n_batches if n_batches is not None else \
+            max(1, len(dataset) // (self.p * self.k))
+        self.refresh_every = refresh_every
+        self.n_representatives = n_representatives
+        self.n_neighbors = n_neighbors if n_neighbors is not None else self.p
+        self.seed = seed
+        self.cpus = cpus
+
+        self.rng = np.random.RandomState(seed)
+        self.n_per_label = np.array(dataset.n_per_label)
+        self.offsets = np.array(dataset.offsets)
+        self.neighbors = None
+        self.iteration = 0
+        self.process, self.tasks, self.results = None, None, None
+        self.pending = False  # a refresh is in progress
+        self.due = None  # files of a refresh waiting for snapshot
+        self.synced = False  # snapshot is called at step boundaries
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        for _ in range(self.n_batches):
+            if self.iteration % self.refresh_every == 0 and not self.pending:
+                files = self.representatives()
+                if self.synced:  # sent by snapshot
+                    self.due = files
+                else:
+                    self.refresh(files)
+            self.iteration += 1
+            self.update()
+            yield self.batch()
+
+    def batch(self):
+        if self.neighbors is None:
+            labels = self.rng.choice(self.n_labels, self.p, replace=False)
+        else:
+            labels, picked = [], np.zeros(self.n_labels, bool)
+            while len(labels) < self.p:
+                frontier = deque([self.rng.randint(self.n_labels)])
+                while len(frontier) and len(labels) < self.p:
+                    label = frontier.popleft()
+                    if picked[label]:
+                        continue
+                    picked[label] = True
+                    labels.append(label)
+                    frontier.extend(self.rng.permutation(
+                        self.neighbors[label]).tolist())
+            labels = np.array(labels)
+        samples = self.rng.randint(1 << 30, size=(self.p, self.k)) % \
+            self.n_per_label[labels].reshape(-1, 1)
+        return (self.offsets[labels].reshape(-1, 1) + samples).reshape(
+            -1).tolist()
+
+    def representatives(self):
+        r""" n_representatives random files per label. """
+        rng = np.random.RandomState((self.seed + self.iteration) % (1 << 32))
+        files = []
+        for offset, n in zip(self.offsets, self.n_per_label):
+            picks = rng.choice(n, min(n, self.n_representatives),
+                               replace=False)
+            files.append([self.dataset.files[offset + i] for i in picks])
+        return files
+
+    def start(self):
+        r""" Starts the background process with a copy of the network. """
+        self.close()
+        with torch.no_grad():
+            network = copy.deepcopy(self.network).cpu()
+        if hasattr(network, "is_cuda"):  # CudaModel
+            network.is_cuda = False
+        ctx = mp.get_context("spawn")
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.process = ctx.Process(
+            target=neighbors_worker,
+            args=(network,
+                  # the cache (lock of another context) is not shared
+                  getattr(self.dataset, "read", self.dataset.process_image),
+                  self.dataset.tensor_size, self.n_neighbors, self.cpus,
+                  self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def snapshot(self):
+        r""" Sends the due refresh with the current weights -- called at
+        step boundaries (Trainer, after optimizer.step). """
+        self.synced = True
+        files, self.due = self.due, None
+        if files is not None:
+            self.refresh(files)
+
+    def refresh(self, files=None):
+        r""" Sends the weights (state_dict on cpu) and files per label
+        (default = representatives) to the background process. """
+        if self.pending:  # previous refresh is in progress
+            return
+        if files is None:
+            files = self.representatives()
+        if self.process is None or not self.process.is_alive():
+            self.start()
+        with torch.no_grad():
+            state = {k: v.detach().to("cpu", copy=True)
+                     for k, v in self.network.state_dict().items()}
+        self.tasks.put((state, files))
+        self.pending = True
+
+    def update(self, block=False):
+        r""" Updates the nearest labels when the background process is done.
+        """
+        if not self.pending:
+            return
+        while True:
+            try:
+                neighbors, error = self.results.get(timeout=1 if block
+                                                    else 0)
+                break
+            except queue.Empty:
+                if self.process.is_alive():
+                    if block:
+                        continue
+                    return
+                try:  # finished between get and is_alive
+                    neighbors, error = self.results.get(timeout=1)
+                except queue.Empty:  # died, restarted on the next refresh
+                    neighbors, error = None, "exitcode = {}".format(
+                        self.process.exitcode)
+                    self.process.join()
+                    self.process = None
+                break
+        self.pending = False
+        if error is not None:
+            warnings.warn("HardNegativeSampler: refresh failed\n" + error)
+            return
+        self.neighbors = neighbors
+
+    def state_dict(self):
+        r""" Iteration, random state and nearest labels -- batches in flight
+        (prefetched by DataLoader) when saved are skipped on resume. """
+        state = self.rng.get_state()
+        return {"iteration": self.iteration,
+                "rng": {"keys": torch.from_numpy(state[1].astype(np.int64)),
+                        "pos": int(state[2])},
+                "neighbors": None if self.neighbors is None else
+                torch.from_numpy(self.neighbors)}
+
+    def load_state_dict(self, state):
+        self.iteration = int(state["iteration"])
+        keys = state["rng"]["keys"]
+        keys = keys.numpy() if isinstance(keys, torch.Tensor) else \
+            np.asarray(keys)
+        self.rng.set_state(("MT19937", keys.astype(np.uint32),
+                            int(state["rng"]["pos"]), 0, 0.))
+        neighbors = state["neighbors"]
+        self.neighbors = None if neighbors is None else \
+            np.asarray(neighbors.numpy() if isinstance(neighbors, torch.Tensor)
+                       else neighbors, np.int64)
+
+    def close(self):
+        if self.process is not None:
+            self.tasks.put(None)
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process, self.tasks, self.results = None, None, None
+        self.pending, self.due = False, None
+
+
+# import core
+# trData = core.NeuralEssentials.FewPerLabel("../data/test_folders",
+#     (1, 3, 128, 128), 4)
+# net = core.NeuralArchitectures.SimpleNet((1, 3, 128, 128))
+# sampler = HardNegativeSampler(trData, net, 8, refresh_every=100)
+# trDataLoader = torch.utils.data.DataLoader(trData, batch_sampler=sampler,
+#                                            num_workers=4)
+# for x, y in trDataLoader:
+#     break
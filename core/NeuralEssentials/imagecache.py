@@ -0,0 +1,139 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import hashlib
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image as ImPIL
+
+
+HITS, MISSES, EVICTIONS, CLOCK = range(4)
+
+
+def path_key(file_name):
+    r""" Non zero int64 hash of a path. """
+    key = int.from_bytes(hashlib.blake2b(file_name.encode(),
+                                         digest_size=8).digest(),
+                         "little", signed=True)
+    return key or 1
+
+
+class ImageCache:
+    r"""LRU cache of decoded and resized (tensor_size) uint8 images shared by
+    all the DataLoader workers. Images are stored in budget // image bytes
+    slots of a shared memory tensor, with a key (hash of path) and last use
+    per slot -- only the shared memory handles are passed to workers, never
+    the images. Slots are grouped in buckets of ways slots, a key maps to a
+    single bucket (key % buckets), hence, a lookup scans ways slots and the
+    least recently used slot of the bucket is replaced when the bucket is
+    full. Buckets are guarded by n_locks locks (bucket % n_locks), workers
+    accessing different buckets do not wait for each other, and images are
+    decoded outside the locks. stats() has hits, misses and evictions (of
+    all the workers).
+
+    Cache the deterministic part of loading (read and resize), random
+    augmentations are applied on the cached image.
+
+    Args:
+        budget: bytes of images, Ex: 8 * 1024**3
+        tensor_size: BCHW of images
+        context: multiprocessing context of the DataLoader workers
+            ("fork"/"spawn"/"forkserver"), default = None (default context)
+        ways: slots per bucket, default = 8
+        n_locks: number of locks, default = 64
+
+    Ex:
+        cache = ImageCache(8 * 1024**3, (1, 3, 224, 224))
+        loader, n_labels = FolderITTR(path, 32, (1, 3, 224, 224), cache=cache)
+        ...
+        print(cache.stats())
+    """
+    def __init__(self, budget: int, tensor_size, context: str = None,
+                 ways: int = 8, n_locks: int = 64):
+        self.shape = (tensor_size[2], tensor_size[3], tensor_size[1])
+        n_slots = max(1, int(budget) // int(np.prod(self.shape)))
+        self.ways = max(1, min(ways, n_slots))
+        self.n_buckets = n_slots // self.ways
+        self.n_slots = self.n_buckets * self.ways
+        self.images = torch.zeros((self.n_buckets, self.ways) + self.shape,
+                                  dtype=torch.uint8).share_memory_()
+        self.keys = torch.zeros(self.n_buckets, self.ways,
+                                dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(self.n_buckets, self.ways,
+                                     dtype=torch.int64).share_memory_()
+        context = mp.get_context(context)
+        self.locks = [context.Lock()
+                      for _ in range(max(1, min(n_locks, self.n_buckets)))]
+        # hits, misses, evictions and clock per lock
+        self.counters = torch.zeros(len(self.locks), 4,
+                                    dtype=torch.int64).share_memory_()
+
+    def bucket(self, file_name):
+        r""" key, bucket and lock of a path. """
+        key = path_key(file_name)
+        bucket = key % self.n_buckets
+        return key, bucket, bucket % len(self.locks)
+
+    def tick(self, lock):
+        self.counters[lock, CLOCK] += 1
+        return self.counters[lock, CLOCK]
+
+    def get(self, file_name):
+        r""" Copy of the cached image (numpy HWC uint8) or None. """
+        key, bucket, lock = self.bucket(file_name)
+        with self.locks[lock]:
+            way = (self.keys[bucket] == key).nonzero()
+            if way.numel() == 0:
+                self.counters[lock, MISSES] += 1
+                return None
+            way = way[0, 0]
+            self.last_used[bucket, way] = self.tick(lock)
+            self.counters[lock, HITS] += 1
+            return self.images[bucket, way].numpy().copy()
+
+    def put(self, file_name, image):
+        r""" Adds an image (numpy HWC/HW uint8 of tensor_size). """
+        image = torch.from_numpy(np.asarray(image, np.uint8).reshape(
+            self.shape))
+        key, bucket, lock = self.bucket(file_name)
+        with self.locks[lock]:
+            keys = self.keys[bucket]
+            if (keys == key).any():  # added by another worker
+                return
+            empty = (keys == 0).nonzero()
+            if empty.numel():
+                way = empty[0, 0]
+            else:
+                way = self.last_used[bucket].argmin()
+                self.counters[lock, EVICTIONS] += 1
+            self.images[bucket, way] = image
+            keys[way] = key
+            self.last_used[bucket, way] = self.tick(lock)
+
+    def read(self, file_name, read):
+        r""" Cached image as PIL image, else, read(file_name) is cached. """
+        image = self.get(file_name)
+        if image is None:
+            image = read(file_name)
+            self.put(file_name, np.asarray(image))
+            return image
+        return ImPIL.fromarray(image[..., 0] if self.shape[2] == 1 else image)
+
+    def stats(self):
+        hits, misses, evictions = self.counters[:, :3].sum(0).tolist()
+        used = int((self.keys != 0).sum())
+        return {"hits": hits, "misses": misses, "evictions": evictions,
+                "hit_rate": hits / max(1, hits + misses),
+                "slots": self.n_slots, "used": used,
+                "bytes": used * int(np.prod(self.shape))}
+
+    def clear(self):
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            self.keys.zero_()
+            self.last_used.zero_()
+            self.counters.zero_()
+        finally:
+            for lock in self.locks:
+                lock.release()
@@ -1,8 +1,12 @@
 """ TensorMONK's :: NeuralEssentials                                        """
 
 import os
+from functools import partial
 import torch
 from .cudamodel import CudaModel
+from .meters import MeterBuffer, MetricsLog
+from .checkpoint import CheckpointWriter, save_flat, load_flat
+from .resumable import rng_state, set_rng_state
 is_cuda = torch.cuda.is_available()
 
 
@@ -10,15 +14,37 @@ class BaseModel:
     netEmbedding = None
     netLoss = None
     netAdversarial = None
-    meterTop1 = []
-    meterTop5 = []
-    meterLoss = []
-    meterTeAC = []
-    meterSpeed = []
-    meterIterations = 0
     fileName = None
     isCUDA = False
 
+    def __init__(self, meter_size: int = 10000):
+        # meters retain the last meter_size values (full history is in
+        # metrics when available)
+        self.meterTop1 = MeterBuffer(meter_size)
+        self.meterTop5 = MeterBuffer(meter_size)
+        self.meterLoss = MeterBuffer(meter_size)
+        self.meterTeAC = MeterBuffer(meter_size)
+        self.meterSpeed = MeterBuffer(meter_size)
+        self.meterIterations = 0
+        self.metrics = None
+        self.checkpoint = None  # CheckpointWriter used by SaveModel
+        # objects with state_dict (Ex: optimizer) saved by SaveModel
+        self.resumables = {}
+        self.pending_states = {}  # loaded by LoadModel, waiting for register
+
+    def register(self, name, obj):
+        r""" Adds obj (with state_dict and load_state_dict, Ex: optimizer,
+        scheduler, sampler) to the checkpoints. When the loaded checkpoint has
+        a state for name, it is loaded to obj. """
+        self.resumables[name] = obj
+        if name in self.pending_states:
+            state = self.pending_states.pop(name)
+            if isinstance(obj, torch.optim.Optimizer):
+                # keys are str in .flat files
+                state["state"] = {int(k): v for k, v in
+                                  state["state"].items()}
+            obj.load_state_dict(state)
+
 
 def MakeModel(file_name,
               tensor_size,
@@ -30,7 +56,8 @@ def MakeModel(file_name,
               default_gpu: int = 0,
               gpus: int = 1,
               ignore_trained: bool = False,
-              old_weights: bool = False):
+              old_weights: bool = False,
+              meter_size: int = 10000):
     r"""Using BaseModel structure build CudaModel's for embedding_net and
     loss_net.
 
@@ -53,12 +80,20 @@ def MakeModel(file_name,
         ignore_trained: when True, ignores the trained model
         old_weights: converts old_weights from NeuralLayers.Linear and
             NeuralLayers.CenterLoss to new format, default = False
+        meter_size: values retained by every meter (MeterBuffer), full
+            history is appended to file_name + ".metrics" (MetricsLog,
+            moved to file_name + ".metrics.1" when the run is not resumed),
+            default = 10000
 
     Return:
         BaseModel with networks
     """
-    Model = BaseModel()
+    Model = BaseModel(meter_size)
     Model.file_name = file_name
+    resume = checkpoint_file(file_name) is not None and not ignore_trained
+    # a new run does not append to the history of the previous run
+    Model.metrics = MetricsLog(file_name[:-3] if file_name.endswith(".t7")
+                               else file_name, fresh=not resume)
 
     print("...... making PyTORCH model!")
     embedding_net_kwargs["tensor_size"] = tensor_size
@@ -72,11 +107,7 @@ def MakeModel(file_name,
     if loss_net is not None:
         Model.netLoss = CudaModel(is_cuda, gpus, loss_net, loss_net_kwargs)
 
-    file_name = Model.file_name
-    if not file_name.endswith(".t7"):
-        file_name += ".t7"
-
-    if os.path.isfile(file_name) and not ignore_trained:
+    if resume:
         print("...... loading pretrained Model!")
         Model = LoadModel(Model, old_weights)
 
@@ -110,34 +141,102 @@ def convert(state_dict):
     return new_state_dict
 
 
-def LoadModel(Model, old_weights):
-    r""" Loads the following from Model.file_name:
+def checkpoint_file(file_name):
+    r""" Latest of file_name.t7 and file_name.flat, None when neither exist.
+    """
+    if file_name.endswith(".t7") or file_name.endswith(".flat"):
+        file_name = os.path.splitext(file_name)[0]
+    files = [file_name + x for x in (".t7", ".flat")
+             if os.path.isfile(file_name + x)]
+    if len(files) == 0:
+        return None
+    return max(files, key=os.path.getmtime)
+
+
+def LoadModel(Model, old_weights=False, nets=None):
+    r""" Loads the following from Model.file_name (.t7 or .flat, the latest
+    when both are available):
         1. state_dict of any value whose key starts with "net" & value != None
-        2. values of keys that starts with "meter".
+        2. values of keys that starts with "meter" -- MeterBuffer's are
+        loaded from state_dict (or list from older checkpoints).
+        3. states of random number generators, and states of resumables
+        (Ex: optimizer), which are loaded on Model.register.
+    .flat files are memory-mapped, and the parameters share the mapped memory
+    (no copies) when the stored dtypes and devices are same as the
+    network's.
+
+    Args:
+        old_weights: converts old weights to new format, default = False
+        nets: list of nets to load (Ex: ["netEmbedding"]), default = None
+            (all, along with the training state)
     """
-    file_name = Model.file_name
-    if not file_name.endswith(".t7"):
-        file_name += ".t7"
-    dict_stuff = torch.load(file_name)
+    file_name = checkpoint_file(Model.file_name)
+    flat = file_name.endswith(".flat")
+    if flat:
+        dict_stuff = load_flat(file_name, None if nets is None else
+                               list(nets) + ["meter"])
+    else:
+        dict_stuff = torch.load(file_name)
 
     for x in dir(Model):
         if x.startswith("net") and getattr(Model, x) is not None:
+            if nets is not None and x not in nets:
+                continue
             if old_weights:
                 dict_stuff[x] = convert(dict_stuff[x])
-            eval("Model." + x + '.load_state_dict(dict_stuff["'+x+'"])')
-        if x.startswith("meter") and dict_stuff[x] is not None:
-            setattr(Model, x, dict_stuff[x])
+            net, state_dict = getattr(Model, x), dict_stuff[x]
+            current = net.state_dict()
+            # assign shares the mapped memory -- only when the parameters
+            # are on the same device (Ex: not for cuda models, the mapped
+            # tensors are copied to the existing parameters)
+            assign = flat and all(k in current and
+                                  current[k].dtype == v.dtype and
+                                  current[k].device == v.device
+                                  for k, v in state_dict.items())
+            net.load_state_dict(state_dict, assign=assign)
+        if x.startswith("meter") and dict_stuff.get(x) is not None:
+            if isinstance(getattr(Model, x), MeterBuffer):
+                getattr(Model, x).load_state_dict(dict_stuff[x])
+            else:
+                setattr(Model, x, dict_stuff[x])
+    if nets is None:  # training state
+        Model.pending_states = dict(dict_stuff.get("resumable", {}))
+        if "rng" in dict_stuff:
+            set_rng_state(dict_stuff["rng"])
     return Model
 
 
-def SaveModel(Model, remove_weight_nm=False):
+def SaveModel(Model, remove_weight_nm=False, async_save=False, keep=1,
+              flat=False, half=False):
     r""" Saves the following to Model.file_name:
         1. state_dict of any value whose key starts with "net" & value != None
-        2. values of keys that starts with "meter".
+        2. values of keys that starts with "meter" (state_dict of
+        MeterBuffer's).
+        3. state_dict of Model.resumables (Model.register, Ex: optimizer)
+        and states of random number generators, when resumables are
+        available.
+    The file is written to a temporary file and renamed (a crash never
+    leaves a partial Model.file_name) by Model.checkpoint (CheckpointWriter).
+
+    Args:
+        remove_weight_nm: removes weight normalization, default = False
+        async_save: when True, returns after a snapshot of the tensors, the
+            file is written in a background thread, default = False
+        keep: number of checkpoints retained (file.t7, file.t7.1, ...),
+            default = 1
+        flat: when True, saves to file.flat (save_flat) -- memory-mappable
+            by LoadModel, default = False
+        half: float tensors of networks (net*) are stored as float16 when
+            flat is True -- optimizer, rng and meters are kept at full
+            precision, default = False
+
+    Return:
+        latency (seconds) of the save as seen by the caller
     """
     file_name = Model.file_name
-    if not file_name.endswith(".t7"):
-        file_name += ".t7"
+    if file_name.endswith(".t7") or file_name.endswith(".flat"):
+        file_name = os.path.splitext(file_name)[0]
+    file_name += ".flat" if flat else ".t7"
     dict_stuff = {}
 
     for x in dir(Model):
@@ -148,11 +247,23 @@ def SaveModel(Model, remove_weight_nm=False):
                     if "weight_v" in name:
                         eval("torch.nn.utils.remove_weight_norm(net." +
                              name.rstrip(".weight_v") + ", 'weight')")
-            state_dict = net.state_dict()
-            for y in state_dict.keys():
-                state_dict[y] = state_dict[y].cpu()
-            dict_stuff.update({x: state_dict})
+            dict_stuff.update({x: net.state_dict()})
         if x.startswith("meter"):
-            dict_stuff.update({x: getattr(Model, x)})
+            meter = getattr(Model, x)
+            if isinstance(meter, MeterBuffer):
+                meter = meter.state_dict()
+            dict_stuff.update({x: meter})
+    if len(getattr(Model, "resumables", {})):
+        dict_stuff["resumable"] = {x: obj.state_dict() for x, obj in
+                                   Model.resumables.items()}
+        dict_stuff["rng"] = rng_state()
 
-    torch.save(dict_stuff, file_name)
+    if getattr(Model, "checkpoint", None) is None:
+        Model.checkpoint = CheckpointWriter(keep)
+    Model.checkpoint.keep = max(1, keep)
+    if half:  # only networks, resumables must be exact
+        half = tuple(x + "/" for x in dict_stuff if x.startswith("net"))
+    return Model.checkpoint.save(dict_stuff, file_name,
+                                 blocking=not async_save,
+                                 serialize=partial(save_flat, half=half)
+                                 if flat else None)
@@ -0,0 +1,254 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision.datasets.folder import default_loader
+from .checkpoint import save_flat, load_flat
+from .decoding import ThreadedItems
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def scan_folder(folder, extensions, recursive=True):
+    r""" Names of images (relative to folder) and (directory, mtime (ns))
+    of every directory scanned. When recursive is True, the order is same as
+    ImageFolder (sorted(os.walk(folder, followlinks=True)), sorted names),
+    else, only the images in folder. The mtime is read before the listing
+    (a change during the scan is seen by the next Manifest). """
+    listing = {}
+    pending = [folder]
+    while len(pending):
+        directory = pending.pop()
+        mtime = os.stat(directory).st_mtime_ns
+        files = []
+        with os.scandir(directory) as entries:
+            for x in entries:
+                if x.is_dir():
+                    if recursive:
+                        pending.append(x.path)
+                elif x.name.lower().endswith(extensions):
+                    files.append(x.name)
+        listing[directory] = (mtime, sorted(files))
+    names, dirs = [], []
+    for directory in sorted(listing):
+        mtime, files = listing[directory]
+        dirs.append((directory, mtime))
+        prefix = os.path.relpath(directory, folder)
+        names += files if prefix == "." else \
+            [os.path.join(prefix, x) for x in files]
+    return names, dirs
+
+
+class FileTable:
+    r""" Read-only list of file names backed by a string table -- utf-8
+    names (uint8 array) and offsets, file i is
+    folders[labels[i]]/names[offsets[i]:offsets[i+1]]. """
+    def __init__(self, folders, labels, names, offsets):
+        self.folders = folders
+        self.labels = labels
+        self.names = names
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        name = self.names[self.offsets[idx]:self.offsets[idx + 1]]
+        return os.path.join(self.folders[self.labels[idx]],
+                            name.tobytes().decode())
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Manifest:
+    r"""Cached index of an image folder (each folder represents a class) for
+    FewPerLabel and FolderITTR. The class folders are scanned in parallel
+    (cpus threads) and saved to file_name (save_flat) -- a string table of
+    file names, labels and the mtimes of root and every scanned directory.
+    Later, the manifest is memory-mapped (milliseconds), only the class
+    folders with a changed directory mtime (files added, removed or renamed)
+    are rescanned, and the manifest is updated when anything changed.
+
+    When image_folder is True, classes and samples are same as ImageFolder
+    -- labels are the index of the sorted (full path) class folders
+    (including the folders without images), and images are listed
+    recursively in the order of ImageFolder. Else (FewPerLabel), only the
+    images in the class folders (sorted by name) are listed and the folders
+    without images are dropped.
+
+    Args:
+        path: full path to folders (str or list of str)
+        file_name: full path + name of the manifest,
+            Ex: ../data/train.manifest
+        extensions: file extensions of images, default = IMAGE_EXTENSIONS
+        cpus: threads used to scan, default = 16
+        image_folder: same classes and samples as ImageFolder, default = True
+
+    Attributes:
+        folders: class folders (index is the label)
+        files: FileTable of the full paths of all the files (grouped by label)
+        labels: numpy array of labels
+        n_per_label, offsets: files per label and the index of the first file
+            of every label
+    """
+    def __init__(self, path, file_name, extensions=IMAGE_EXTENSIONS,
+                 cpus: int = 16, image_folder: bool = True):
+        self.roots = [path] if isinstance(path, str) else list(path)
+        self.roots = [os.path.abspath(x) for x in self.roots]
+        self.file_name = file_name
+        self.extensions = tuple(x.lower() for x in extensions)
+        self.cpus = cpus
+        self.image_folder = image_folder
+
+        cached = self.load()
+        if cached is None or not self.current(cached):
+            self.build(cached)
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        try:
+            data = load_flat(self.file_name)
+        except (ValueError, OSError, KeyError, struct.error):
+            return None
+        if data["roots"] != self.roots or \
+                tuple(data["extensions"]) != self.extensions or \
+                data.get("image_folder") != self.image_folder:
+            return None
+        return data
+
+    def current(self, data):
+        r""" Uses data when the mtimes of roots and directories are same. """
+        try:
+            roots = [os.stat(x).st_mtime_ns for x in self.roots]
+            dirs = [os.stat(x).st_mtime_ns for x in data["dirs"]]
+        except OSError:
+            return False
+        if roots != data["root_mtimes"].tolist() or \
+                dirs != data["mtimes"].tolist():
+            return False
+        self.set(data["folders"], data["labels"], data["names"],
+                 data["offsets"], data["n_per_label"])
+        return True
+
+    def build(self, cached=None):
+        r""" Scans the class folders, reuses the cached lists of folders
+        whose directories have the same mtimes, and saves the manifest
+        (atomic rename). """
+        root_mtimes = [os.stat(x).st_mtime_ns for x in self.roots]
+        all_folders = []
+        for root in self.roots:
+            with os.scandir(root) as entries:
+                all_folders += [os.path.join(root, x.name) for x in entries
+                                if x.is_dir()]
+        all_folders = sorted(all_folders)
+
+        reuse = {}
+        if cached is not None:
+            names = cached["names"].numpy()
+            offsets = cached["offsets"].numpy()
+            folder_offsets = cached["folder_offsets"].tolist()
+            dirs = [[] for _ in cached["all_folders"]]
+            for x, i, mtime in zip(cached["dirs"],
+                                   cached["dir_folders"].tolist(),
+                                   cached["mtimes"].tolist()):
+                dirs[i].append((x, mtime))
+            for i, folder in enumerate(cached["all_folders"]):
+                start, end = folder_offsets[i:i + 2]
+                reuse[folder] = (dirs[i], offsets[start:end + 1])
+
+        def scan(folder):
+            if folder in reuse:
+                dirs, offsets = reuse[folder]
+                try:
+                    same = all(os.stat(x).st_mtime_ns == mtime
+                               for x, mtime in dirs)
+                except OSError:
+                    same = False
+                if same:
+                    return [names[a:b].tobytes().decode() for a, b in
+                            zip(offsets[:-1], offsets[1:])], dirs
+            return scan_folder(folder, self.extensions, self.image_folder)
+
+        with ThreadPoolExecutor(max(1, self.cpus)) as executor:
+            scans = list(executor.map(scan, all_folders))
+
+        counts = np.array([len(x[0]) for x in scans], np.int64)
+        keep = np.ones(len(all_folders), bool) if self.image_folder else \
+            counts > 0
+        folders = [x for x, k in zip(all_folders, keep) if k]
+        n_per_label = counts[keep]
+        labels = np.repeat(np.arange(len(folders), dtype=np.int64),
+                           n_per_label)
+        blobs = [x.encode() for files, _ in scans for x in files]
+        lengths = np.array([len(x) for x in blobs], np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        names = np.frombuffer(b"".join(blobs), np.uint8)
+        dirs = [(x, i, mtime) for i, (_, folder_dirs) in enumerate(scans)
+                for x, mtime in folder_dirs]
+
+        data = {"roots": self.roots, "extensions": list(self.extensions),
+                "image_folder": self.image_folder,
+                "all_folders": all_folders, "folders": folders,
+                "folder_offsets": torch.from_numpy(np.concatenate((
+                    [0], np.cumsum(counts))).astype(np.int64)),
+                "dirs": [x[0] for x in dirs],
+                "dir_folders": torch.tensor([x[1] for x in dirs],
+                                            dtype=torch.int64),
+                "root_mtimes": torch.tensor(root_mtimes, dtype=torch.int64),
+                "mtimes": torch.tensor([x[2] for x in dirs],
+                                       dtype=torch.int64),
+                "labels": torch.from_numpy(labels),
+                "n_per_label": torch.from_numpy(n_per_label),
+                "names": torch.from_numpy(names.copy()),
+                "offsets": torch.from_numpy(offsets)}
+        folder = os.path.dirname(os.path.abspath(self.file_name))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp = self.file_name + ".tmp"
+        with open(temp, "wb") as f:
+            save_flat(data, f)
+        os.replace(temp, self.file_name)
+        self.set(folders, labels, names, offsets, n_per_label)
+
+    def set(self, folders, labels, names, offsets, n_per_label):
+        def numpy(x):
+            return x.numpy() if isinstance(x, torch.Tensor) else x
+        self.folders = folders
+        self.labels = numpy(labels)
+        self.n_per_label = numpy(n_per_label)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_per_label)))
+        self.files = FileTable(folders, self.labels, numpy(names),
+                               numpy(offsets))
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class ManifestFolder(ThreadedItems, Dataset):
+    r""" ImageFolder from a Manifest (samples are loaded on access). """
+    def __init__(self, manifest, transform=None, loader=default_loader,
+                 threads=1):
+        self.manifest = manifest
+        self.classes = [os.path.basename(x) for x in manifest.folders]
+        self.targets = manifest.labels
+        self.transform = transform
+        self.loader = loader
+        self.threads = threads
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, idx):
+        image = self.loader(self.manifest.files[idx])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.targets[idx])
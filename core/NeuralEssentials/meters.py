@@ -0,0 +1,307 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import sys
+import timeit
+import numpy as np
+import torch
+
+
+RECORD = np.dtype([("iteration", "<i8"), ("meter", "S16"), ("value", "<f8")])
+
+
+class MeterBuffer:
+    r"""Bounded meter -- retains the last size values in a numpy ring buffer
+    (float32), and running aggregates (count, total, minimum, maximum) of
+    all the values. Indexing and slicing are over the retained values,
+    oldest to latest (Ex: meter[-1], meter[-50:], meter[1::2]), hence, works
+    as a drop-in for the list meters of BaseModel.
+
+    Args:
+        size: number of values retained, default = 10000
+    """
+    def __init__(self, size: int = 10000):
+        self.size = max(1, int(size))
+        self.buffer = np.zeros(self.size, np.float32)
+        self.reset()
+
+    def reset(self):
+        self.position, self.length, self.count = 0, 0, 0
+        self.total, self.minimum, self.maximum = 0., float("inf"), \
+            - float("inf")
+
+    def append(self, value):
+        value = float(value)
+        self.buffer[self.position] = value
+        self.position = (self.position + 1) % self.size
+        self.length = min(self.length + 1, self.size)
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def extend(self, values):
+        values = np.asarray(values, np.float32).reshape(-1)
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.total += float(values.sum(dtype=np.float64))
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        if values.size >= self.size:
+            self.buffer[:] = values[-self.size:]
+            self.position = 0
+        else:
+            idx = (self.position + np.arange(values.size)) % self.size
+            self.buffer[idx] = values
+            self.position = (self.position + values.size) % self.size
+        self.length = min(self.length + values.size, self.size)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def values(self):
+        r""" Retained values, oldest to latest. """
+        if self.length < self.size:
+            return self.buffer[:self.length]
+        return np.concatenate((self.buffer[self.position:],
+                               self.buffer[:self.position]))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.values().tolist())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.values()[key]
+        n = len(self)
+        if not - n <= key < n:
+            raise IndexError("MeterBuffer index out of range")
+        start = 0 if self.length < self.size else self.position
+        return float(self.buffer[(start + key % n) % self.size])
+
+    def __repr__(self):
+        return "MeterBuffer(size={}, count={}, mean={:.4f})".format(
+            self.size, self.count, self.mean)
+
+    @property
+    def mean(self):
+        r""" Mean of all the values. """
+        return self.total / max(1, self.count)
+
+    def state_dict(self):
+        r""" Plain types and a tensor -- safe with torch.load(...,
+        weights_only=True). """
+        return {"size": self.size, "count": self.count, "total": self.total,
+                "minimum": self.minimum, "maximum": self.maximum,
+                "values": torch.from_numpy(self.values().copy())}
+
+    def load_state_dict(self, state):
+        r""" Accepts state_dict, or a list of values (older checkpoints). """
+        self.reset()
+        if not isinstance(state, dict):
+            self.extend(list(state))
+            return
+        values = state["values"]
+        values = values.numpy() if isinstance(values, torch.Tensor) else \
+            np.asarray(values)
+        self.extend(values)
+        self.count, self.total = int(state["count"]), float(state["total"])
+        self.minimum = float(state["minimum"])
+        self.maximum = float(state["maximum"])
+
+
+class MetricsLog:
+    r"""Append-only binary log of meters -- fixed size records of
+    (iteration, meter, value) in RECORD format, read with read_metrics
+    (memory-mapped). A resumed run appends again from the resumed iteration,
+    the last record of an iteration is the latest.
+
+    Args:
+        file_name: full path + name of the log, ".metrics" is added when
+            there is no extension
+        fresh: when True, an existing log (history of another run) is moved
+            to file_name + ".1" and a new log is started, default = False
+    """
+    def __init__(self, file_name: str, fresh: bool = False):
+        if not os.path.splitext(file_name)[1]:
+            file_name += ".metrics"
+        self.file_name = file_name
+        if fresh and os.path.isfile(file_name):
+            os.replace(file_name, file_name + ".1")
+
+    def write(self, name, iterations, values):
+        records = np.empty(len(values), RECORD)
+        records["iteration"] = iterations
+        records["meter"] = name.encode()[:16]
+        records["value"] = values
+        with open(self.file_name, "ab") as f:
+            f.write(records.tobytes())
+
+
+def read_metrics(file_name: str, meter: str = None):
+    r""" Memory-maps the records (numpy structured array of RECORD) in a
+    MetricsLog, optionally, of a meter.
+
+    Ex:
+        records = read_metrics("./models/simplenet", "loss")
+        records["iteration"], records["value"]
+    """
+    if not os.path.splitext(file_name)[1]:
+        file_name += ".metrics"
+    n = os.path.getsize(file_name) // RECORD.itemsize  # ignores partials
+    if n == 0:
+        return np.empty(0, RECORD)
+    records = np.memmap(file_name, RECORD, "r", shape=(n, ))
+    if meter is not None:
+        return records[records["meter"] == meter.encode()[:16]]
+    return records
+
+
+class Meters:
+    r"""Accumulates meters (loss, top1, top5, etc) as tensors on the device,
+    and syncs with the host once every sync_every updates -- avoids a device
+    sync per iteration. On every sync, values per iteration are appended to
+    Model.meter<Name> (Ex: loss -> Model.meterLoss, top1 -> Model.meterTop1),
+    when available, along with the speed (samples per second) of the
+    interval to Model.meterSpeed. All the synced values are also written to
+    Model.metrics (MetricsLog), when available. Values of the last sync are
+    available in synced (dict of lists) for custom logging. Console output
+    is limited to once every print_every seconds.
+
+    Args:
+        Model: BaseModel from MakeModel, default = None
+        names: list/tuple of meter names, default = ("loss", "top1", "top5")
+        sync_every: updates between syncs, default = 50
+        print_every: seconds between console outputs, 0 = never, default = 1
+        text: format of meters for console output, default = None
+            (Cost {loss:2.3f} :: Top1/Top5 - {top1:3.2f}/{top5:3.2f} for
+            default names, else, name value pairs)
+
+    Ex:
+        meters = Meters(Model)
+        for tensor, targets in data:
+            ...
+            meters.update(tensor.size(0), loss=loss, top1=top1, top5=top5)
+        meters.epoch()
+    """
+    def __init__(self,
+                 Model=None,
+                 names: tuple = ("loss", "top1", "top5"),
+                 sync_every: int = 50,
+                 print_every: float = 1.,
+                 text: str = None):
+        self.Model = Model
+        self.names = tuple(names)
+        self.sync_every = max(1, int(sync_every))
+        self.print_every = print_every
+        if text is None:
+            if self.names == ("loss", "top1", "top5"):
+                text = "Cost {loss:2.3f} :: " + \
+                    "Top1/Top5 - {top1:3.2f}/{top5:3.2f}"
+            else:
+                text = " :: ".join([x + " {" + x + ":2.3f}"
+                                    for x in self.names])
+        self.text = text
+
+        self.iterations = 0 if Model is None else Model.meterIterations
+        self.pending = {x: [] for x in self.names}
+        self.n_pending, self.n_samples = 0, 0
+        self.latest = {x: 0. for x in self.names + ("speed", )}
+        self.synced = {x: [] for x in self.names}
+        self.reset()
+        self.timer = self.printed = timeit.default_timer()
+
+    def reset(self):
+        r""" Resets the epoch averages. """
+        self.sums = {x: 0. for x in self.names + ("speed", )}
+        self.count = 0
+
+    def update(self, n_samples, **values):
+        r""" Adds values (tensors/floats) of an iteration. Returns True when
+        synced. """
+        for x in self.names:
+            value = values[x]
+            if isinstance(value, torch.Tensor):
+                value = value.detach().view(-1)[0]
+            self.pending[x].append(value)
+        self.n_pending += 1
+        self.n_samples += n_samples
+        self.iterations += 1
+        if self.n_pending >= self.sync_every:
+            self.sync()
+            return True
+        return False
+
+    def sync(self):
+        r""" Moves the pending values to host (single copy) and updates the
+        Model meters. """
+        if self.n_pending == 0:
+            return
+        tensors = [v for x in self.names for v in self.pending[x]
+                   if isinstance(v, torch.Tensor)]
+        device = tensors[0].device if len(tensors) else "cpu"
+        values = torch.stack([torch.as_tensor(v, dtype=torch.float32,
+                                              device=device)
+                              for x in self.names for v in self.pending[x]])
+        values = values.cpu().numpy().reshape(len(self.names), -1)
+
+        iterations = np.arange(self.iterations - self.n_pending + 1,
+                               self.iterations + 1)
+        now = timeit.default_timer()
+        speed = int(self.n_samples / max(now - self.timer, 1e-8))
+        self.timer = now
+
+        for x, v in zip(self.names, values):
+            self.latest[x] = float(v[-1])
+            self.synced[x] = v.tolist()
+            self.sums[x] += float(v.sum())
+            self.extend(x, self.synced[x], iterations)
+        self.latest["speed"] = speed
+        self.sums["speed"] += speed * self.n_pending
+        self.extend("speed", [speed] * self.n_pending, iterations)
+        self.count += self.n_pending
+
+        self.pending = {x: [] for x in self.names}
+        self.n_pending, self.n_samples = 0, 0
+        if self.print_every > 0 and now - self.printed >= self.print_every:
+            self.show(self.latest, end="\r")
+            self.printed = now
+
+    def extend(self, name, values, iterations):
+        if self.Model is None:
+            return
+        if getattr(self.Model, "metrics", None) is not None:
+            self.Model.metrics.write(name, iterations, values)
+        name = "meter" + name[0].upper() + name[1:]
+        if getattr(self.Model, name, None) is not None:
+            getattr(self.Model, name).extend(values)
+
+    def show(self, values, end="\n"):
+        print(("... {:6d} :: ".format(self.iterations) +
+               self.text.format(**values) +
+               " :: {:4d} I/S    ".format(int(values["speed"]))), end=end)
+        sys.stdout.flush()
+
+    def averages(self):
+        r""" Averages since the last reset. """
+        self.sync()
+        return {x: self.sums[x] / max(1, self.count) for x in self.sums}
+
+    def epoch(self, show=True):
+        r""" Syncs, prints the averages of the epoch and resets. """
+        averages = self.averages()
+        if show:
+            self.show(averages)
+        self.reset()
+        return averages
+
+
+# meters = Meters(None, sync_every=4, print_every=0.)
+# for _ in range(10):
+#     meters.update(32, loss=torch.rand(1), top1=torch.rand(1),
+#                   top5=torch.rand(1))
+# meters.epoch()
@@ -0,0 +1,165 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+import torchvision.datasets as DataSET
+from tqdm import tqdm
+from .decoding import read_image
+
+
+def packed_files(file_name):
+    r""" images (uint8 NHWC .npy), labels (int64 .npy) and index (.json)
+    files of a packed folder. """
+    return (file_name + ".images.npy", file_name + ".labels.npy",
+            file_name + ".json")
+
+
+def pack_chunk(args):
+    r""" Reads, resizes and writes a chunk of images to the (memory-mapped)
+    images file -- runs in the pool. """
+    images_file, start, file_names, tensor_size = args
+    images = np.load(images_file, mmap_mode="r+")
+    for i, file_name in enumerate(file_names):
+        # same pixels as FolderITTR (draft decoding and box resize)
+        image = read_image(file_name, tensor_size)
+        images[start + i] = np.asarray(image).reshape(images.shape[1:])
+    images.flush()
+    return len(file_names)
+
+
+def PackFolder(data_path, file_name, tensor_size=(6, 3, 224, 224),
+               cpus=multiprocessing.cpu_count(), chunk_size=256):
+    r"""Converts an image folder (each folder represents a class, labels are
+    same as FolderITTR) to a packed format for PackedFolderITTR -- all the
+    images resized to tensor_size in a uint8 NHWC array and labels in an
+    int64 array (both .npy, memory-mappable), and an index (.json) with
+    classes and tensor_size. Images are read by read_image (same pixels as
+    FolderITTR without functions) in a pool of cpus processes that write to
+    the memory-mapped array.
+
+    Args:
+        data_path: full path to the folder of class folders
+        file_name: full path + name of the output, Ex: ../data/train_224
+        tensor_size: BCHW of images, default = (6, 3, 224, 224)
+        cpus: number of processes, default = cpu_count
+        chunk_size: images per task, default = 256
+
+    Return:
+        file_name
+    """
+    data = DataSET.ImageFolder(data_path)
+    n_samples = len(data.samples)
+    h, w, c = tensor_size[2], tensor_size[3], tensor_size[1]
+    images_file, labels_file, index_file = packed_files(file_name)
+    folder = os.path.dirname(os.path.abspath(file_name))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    # index is written last, a partial pack is never used
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    images = np.lib.format.open_memmap(images_file, "w+", np.uint8,
+                                       (n_samples, h, w, c))
+    del images
+    np.save(labels_file, np.array([x[1] for x in data.samples], np.int64))
+
+    tasks = [(images_file, i,
+              [x[0] for x in data.samples[i:i + chunk_size]], tensor_size)
+             for i in range(0, n_samples, chunk_size)]
+    with tqdm(total=n_samples, desc="PackFolder") as progress:
+        if cpus > 1:
+            with multiprocessing.Pool(cpus) as pool:
+                for n in pool.imap_unordered(pack_chunk, tasks):
+                    progress.update(n)
+        else:
+            for task in tasks:
+                progress.update(pack_chunk(task))
+
+    with open(index_file, "w") as f:
+        json.dump({"classes": data.classes, "n_samples": n_samples,
+                   "tensor_size": [1, c, h, w]}, f)
+    return file_name
+
+
+class PackedFolderITTR(Dataset):
+    r"""Dataset of a packed folder (PackFolder). Images and labels are
+    memory-mapped, __getitem__ returns a zero-copy uint8 HWC tensor of the
+    image and its label. collate (used by loader and Trainer) stacks a batch
+    and converts it to float BCHW in the range [0, 1] (same as FolderITTR),
+    with random horizontal flips when random_flip is True. When uint8 is
+    True, batches are uint8 BHWC (normalized on the device by ImageNorm).
+
+    Args:
+        file_name: full path + name given to PackFolder
+        random_flip: random horizontal flip in collate, default = False
+        uint8: collate returns uint8 BHWC batches, default = False
+
+    Ex:
+        NeuralEssentials.PackFolder("../data/train", "../data/train_224",
+                                    (1, 3, 224, 224))
+        data = NeuralEssentials.PackedFolderITTR("../data/train_224", True)
+        loader = data.loader(batch_size=32, cpus=4)
+    """
+    def __init__(self, file_name, random_flip=False, uint8=False):
+        images_file, labels_file, index_file = packed_files(file_name)
+        assert os.path.isfile(index_file), \
+            "PackedFolderITTR: {} not found, use PackFolder".format(index_file)
+        with open(index_file) as f:
+            index = json.load(f)
+        self.classes = index["classes"]
+        self.n_labels = len(self.classes)
+        self.tensor_size = tuple(index["tensor_size"])
+        # copy-on-write, torch.from_numpy requires a writable array
+        self.images = np.load(images_file, mmap_mode="c")
+        self.labels = np.load(labels_file, mmap_mode="c")
+        self.random_flip = random_flip
+        self.uint8 = uint8
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.images[idx]), int(self.labels[idx])
+
+    def collate(self, batch):
+        tensor = torch.stack([x[0] for x in batch])
+        targets = torch.tensor([x[1] for x in batch], dtype=torch.int64)
+        if self.random_flip:
+            flip = torch.rand(tensor.size(0)) > .5
+            tensor[flip] = tensor[flip].flip(2)
+        if self.uint8:
+            return tensor, targets
+        tensor = tensor.permute(0, 3, 1, 2).float().div_(255)
+        return tensor.contiguous(), targets
+
+    def loader(self, batch_size, cpus=4, shuffle=True, sampler=None):
+        return torch.utils.data.DataLoader(
+            self, batch_size=batch_size, shuffle=sampler is None and shuffle,
+            sampler=sampler, num_workers=cpus, collate_fn=self.collate,
+            pin_memory=torch.cuda.is_available())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Packs an image folder for "
+                                     "PackedFolderITTR")
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("file_name", type=str)
+    parser.add_argument("--height", type=int, default=224)
+    parser.add_argument("--width", type=int, default=224)
+    parser.add_argument("--channels", type=int, default=3, choices=[1, 3])
+    parser.add_argument("--cpus", type=int,
+                        default=multiprocessing.cpu_count())
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # python -m core.NeuralEssentials.packedfolder ../data/train \
+    #     ../data/train_224 --height 224 --width 224
+    args = parse_args()
+    PackFolder(args.data_path, args.file_name,
+               (1, args.channels, args.height, args.width), args.cpus)
@@ -0,0 +1,129 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class PKBatchSampler(Sampler):
+    r"""Batch sampler that yields batches of P labels x K samples per label
+    (Ex: FewPerLabel for TripletLoss). Every epoch (seed + epoch), labels are
+    visited in random rounds -- every round is a permutation of labels split
+    into len(labels) // P batches of distinct labels, and the K samples of
+    every visit of a label are the next K of a random permutation of its
+    samples (without repetition till the label's samples are exhausted).
+    An epoch is computed at once with numpy index arrays.
+
+    Batches are composed in the main process, hence, safe with any number of
+    DataLoader workers. With torch.distributed (or num_replicas and rank),
+    every rank takes every num_replicas-th batch of the same sequence.
+    Resumable -- set_epoch, advance (Trainer), state_dict and load_state_dict
+    are same as ResumableSampler.
+
+    Args:
+        labels: dataset with labels (Ex: FewPerLabel) or an array of labels
+        n_labels_per_batch: P, number of labels per batch
+        n_consecutive: K, samples per label, default = dataset.n_consecutive
+        n_batches: batches per epoch (all ranks), default =
+            dataset.n_samples (or len(labels)) // (P*K)
+        seed: random seed, default = 0
+        num_replicas: default = world size when torch.distributed is
+            initialized, else 1
+        rank: default = rank when torch.distributed is initialized, else 0
+
+    Ex:
+        trData = FewPerLabel("../data/folders", (1, 3, 128, 128), 4)
+        sampler = PKBatchSampler(trData, 16)
+        loader = DataLoader(trData, batch_sampler=sampler, num_workers=4)
+    """
+    def __init__(self,
+                 labels,
+                 n_labels_per_batch: int,
+                 n_consecutive: int = None,
+                 n_batches: int = None,
+                 seed: int = 0,
+                 num_replicas: int = None,
+                 rank: int = None):
+        dataset = labels
+        if hasattr(dataset, "labels"):
+            labels = dataset.labels
+        labels = np.asarray(labels, np.int64)
+        # indices grouped by label, offsets[label] is the first of label
+        self.order = np.argsort(labels, kind="stable")
+        self.n_per_label = np.bincount(labels)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_per_label)))
+        self.labels = labels[self.order]
+        self.valid = np.nonzero(self.n_per_label)[0]
+
+        self.p = min(n_labels_per_batch, len(self.valid))
+        self.k = n_consecutive if n_consecutive is not None else \
+            dataset.n_consecutive
+        n_samples = getattr(dataset, "n_samples", len(labels))
+        self.n_batches = n_batches if n_batches is not None else \
+            max(1, n_samples // (self.p * self.k))
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and \
+                dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and \
+                dist.is_initialized() else 0
+        self.num_replicas, self.rank = num_replicas, rank
+        self.seed = seed
+        self.epoch, self.position = 0, 0
+
+    def __len__(self):
+        return self.n_batches // self.num_replicas - \
+            self.position // (self.p * self.k)
+
+    def batches(self, epoch):
+        r""" All the batches (n_batches x P*K of dataset indices) of an
+        epoch. """
+        rng = np.random.RandomState((self.seed + epoch) % (1 << 32))
+        # labels -- rounds of permutations, n_labels // P batches per round
+        per_round = len(self.valid) // self.p
+        n_rounds = -(- self.n_batches // per_round)
+        labels = np.stack([rng.permutation(self.valid)[:per_round * self.p]
+                           for _ in range(n_rounds)])
+        labels = labels.reshape(-1, self.p)[:self.n_batches].reshape(-1)
+
+        # visit of every label (0 for the first time a label is picked, ...)
+        ranks = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=len(self.n_per_label))
+        starts = np.concatenate(([0], np.cumsum(counts)))[:-1]
+        visits = np.empty_like(labels)
+        visits[ranks] = np.arange(len(labels)) - \
+            np.repeat(starts, counts)
+
+        # samples -- random permutation of samples within every label
+        shuffled = np.lexsort((rng.random_sample(len(self.labels)),
+                               self.labels))
+        n = self.n_per_label[labels].reshape(-1, 1)
+        picks = (visits.reshape(-1, 1) * self.k + np.arange(self.k)) % n
+        picks = shuffled[self.offsets[labels].reshape(-1, 1) + picks]
+        return self.order[picks].reshape(self.n_batches, self.p * self.k)
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        batches = batches[self.rank::self.num_replicas]
+        batches = batches[:self.n_batches // self.num_replicas]
+        for batch in batches[self.position // (self.p * self.k):]:
+            yield batch.tolist()
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch, self.position = epoch, 0
+
+    def advance(self, n_samples):
+        n = self.n_batches // self.num_replicas * self.p * self.k
+        self.position = min(n, self.position + n_samples)
+        if self.position == n:  # done with the epoch
+            self.epoch, self.position = self.epoch + 1, 0
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch,
+                "position": self.position}
+
+    def load_state_dict(self, state):
+        self.seed = int(state["seed"])
+        self.epoch = int(state["epoch"])
+        self.position = int(state["position"])
@@ -0,0 +1,129 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import random
+import signal
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def rng_state():
+    r""" States of python, numpy, torch and cuda random number generators
+    (plain types and tensors). """
+    np_state = np.random.get_state()
+    state = {"random": [list(x) if isinstance(x, tuple) else x
+                        for x in random.getstate()],
+             "numpy": {"keys": torch.from_numpy(np_state[1].astype(np.int64)),
+                       "pos": int(np_state[2]),
+                       "has_gauss": int(np_state[3]),
+                       "cached_gaussian": float(np_state[4])},
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state["cuda"] = {str(i): x for i, x in
+                         enumerate(torch.cuda.get_rng_state_all())}
+    return state
+
+
+def set_rng_state(state):
+    version, internal, gauss = state["random"]
+    random.setstate((version, tuple(internal), gauss))
+    np_state = state["numpy"]
+    keys = np_state["keys"]
+    keys = keys.numpy() if isinstance(keys, torch.Tensor) else \
+        np.asarray(keys)
+    np.random.set_state(("MT19937", keys.astype(np.uint32),
+                         int(np_state["pos"]), int(np_state["has_gauss"]),
+                         float(np_state["cached_gaussian"])))
+    torch.set_rng_state(state["torch"].cpu().to(torch.uint8))
+    if "cuda" in state and torch.cuda.is_available():
+        cuda = state["cuda"]
+        states = [cuda[str(i)].cpu().to(torch.uint8) for i in range(len(cuda))]
+        if len(states) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(states)
+
+
+class ResumableSampler(Sampler):
+    r"""Random (or sequential) sampler that can resume an epoch. The order of
+    an epoch is a permutation seeded with seed + epoch, and position is the
+    number of samples consumed in the epoch (advanced by the training loop,
+    Ex: Trainer, as workers prefetch ahead of it). state_dict and
+    load_state_dict save and restore (seed, epoch, position).
+
+    Args:
+        data_source: dataset or number of samples
+        shuffle: random order per epoch, default = True
+        seed: random seed, default = 0
+
+    Ex:
+        sampler = ResumableSampler(data)
+        loader = DataLoader(data, batch_size=32, sampler=sampler)
+        for tensor, targets in loader:
+            ...
+            sampler.advance(tensor.size(0))
+    """
+    def __init__(self, data_source, shuffle: bool = True, seed: int = 0):
+        self.n = data_source if isinstance(data_source, int) else \
+            len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch, self.position = 0, 0
+
+    def __len__(self):
+        return self.n - self.position
+
+    def __iter__(self):
+        return iter(self.indices().tolist())
+
+    def indices(self):
+        r""" Remaining indices of the epoch (torch.LongTensor). """
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.n, generator=generator)
+        else:
+            order = torch.arange(self.n)
+        return order[self.position:]
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch, self.position = epoch, 0
+
+    def advance(self, n_samples):
+        self.position = min(self.n, self.position + n_samples)
+        if self.position == self.n:  # done with the epoch
+            self.epoch, self.position = self.epoch + 1, 0
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch,
+                "position": self.position}
+
+    def load_state_dict(self, state):
+        self.seed = int(state["seed"])
+        self.epoch = int(state["epoch"])
+        self.position = int(state["position"])
+
+
+class Preemption:
+    r"""Signal (default = SIGTERM) handler that only sets a flag, the
+    training loop checks requested at an iteration boundary to save and exit
+    (Ex: Trainer). The previous handlers are restored by restore().
+
+    Args:
+        signals: list/tuple of signals, default = (signal.SIGTERM, )
+    """
+    def __init__(self, signals=(signal.SIGTERM, )):
+        self.requested = False
+        self.previous = {}
+        for x in signals:
+            try:
+                self.previous[x] = signal.signal(x, self.handler)
+            except ValueError:  # not in the main thread
+                pass
+
+    def handler(self, signum, frame):
+        self.requested = True
+
+    def restore(self):
+        for x, handler in self.previous.items():
+            signal.signal(x, handler)
+        self.previous = {}
@@ -0,0 +1,266 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import queue
+import random
+import signal
+import traceback
+import warnings
+from collections import deque
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from .resumable import ResumableSampler
+
+
+def as_tensor(x):
+    return x if isinstance(x, torch.Tensor) else torch.as_tensor(np.asarray(x))
+
+
+def ring_worker(dataset, images, targets, tasks, results, seed):
+    r""" Loads the samples of a batch directly into the shared buffer, and
+    returns (batch, buffer, n_samples, error). """
+    # handlers inherited from the parent (Ex: Preemption) must not keep the
+    # worker alive on terminate, interrupts are handled by the parent
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    torch.manual_seed(seed)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        k, b, indices = task
+        try:
+            if hasattr(dataset, "__getitems__"):
+                samples = dataset.__getitems__(indices)
+            else:
+                samples = [dataset[i] for i in indices]
+            for j, (x, y) in enumerate(samples):
+                images[b, j].copy_(as_tensor(x))
+                targets[b, j] = int(y)
+            results.put((k, b, len(indices), None))
+        except Exception:
+            results.put((k, b, 0, traceback.format_exc()))
+
+
+class RingLoader:
+    r"""Loader where workers write samples directly into a ring of
+    preallocated shared memory batch buffers (registered as pinned memory
+    when cuda is available), and the main process receives only the buffer
+    indices -- no per batch allocations, collation or pickling of tensors.
+    Batches are views of the buffers, a buffer is reused after hold more
+    batches are requested (hold = 1, reused once the next batch is
+    requested). Trainer raises hold to cover its prefetch depth. Copy the
+    batch to keep it longer. When pinned, a buffer is reused after the
+    non_blocking copies of its batch (issued on the current stream before
+    the next batch is requested, Ex: Prefetcher) are done.
+
+    Samples must be (tensor/array of a fixed shape, label). Buffers are
+    allocated and workers are started on the first iteration, and persist
+    till close().
+
+    Args:
+        dataset: Dataset (Ex: FolderITTR's ImageFolder), uses __getitems__
+            when available
+        batch_size: samples per batch (the largest batch of batch_sampler)
+        shuffle: random order every epoch (ResumableSampler), default = True
+            (a full pass moves to the next epoch)
+        workers: number of worker processes, default = 4
+        n_buffers: number of batch buffers, default = 2 x workers + hold
+        batch_sampler: yields lists of indices (Ex: PKBatchSampler),
+            default = None (batches of ResumableSampler)
+        drop_last: drops the last incomplete batch, default = False
+        pin_memory: registers buffers as pinned memory when cuda is
+            available, default = True
+        hold: batches held by the consumer, default = 1
+        seed: seeds of workers are seed + worker id, default = 0
+        context: multiprocessing context, default = None
+
+    Ex:
+        loader = RingLoader(data, 32, workers=4)
+        for tensor, targets in loader:
+            ...
+        loader.close()
+    """
+    def __init__(self,
+                 dataset,
+                 batch_size: int,
+                 shuffle: bool = True,
+                 workers: int = 4,
+                 n_buffers: int = None,
+                 batch_sampler=None,
+                 drop_last: bool = False,
+                 pin_memory: bool = True,
+                 hold: int = 1,
+                 seed: int = 0,
+                 context: str = None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.batch_sampler = batch_sampler
+        self.sampler = None if batch_sampler is not None else \
+            ResumableSampler(dataset, shuffle, seed)
+        self.drop_last = drop_last
+        self.n_workers = max(1, workers)
+        self.hold = hold
+        self.n_buffers = n_buffers
+        self.pin_memory = pin_memory
+        self.seed = seed
+        self.context = mp.get_context(context)
+        self.workers, self.pinned = [], False
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        n = len(self.sampler)
+        return n // self.batch_size if self.drop_last else \
+            - (- n // self.batch_size)
+
+    def set_epoch(self, epoch):
+        for x in (self.batch_sampler, self.sampler):
+            if hasattr(x, "set_epoch"):
+                x.set_epoch(epoch)
+
+    def batches(self):
+        if self.batch_sampler is not None:
+            for indices in self.batch_sampler:
+                yield list(indices)
+            return
+        indices = self.sampler.indices()
+        if self.drop_last:
+            indices = indices[:len(self) * self.batch_size]
+        for x in indices.split(self.batch_size):
+            yield x.tolist()
+
+    def start(self):
+        r""" Allocates the buffers (shape of dataset[0]) and starts the
+        workers. """
+        n_buffers = self.n_buffers if self.n_buffers is not None else \
+            2 * self.n_workers + self.hold
+        x = as_tensor(self.dataset[0][0])
+        self.images = torch.empty((n_buffers, self.batch_size) +
+                                  tuple(x.shape), dtype=x.dtype)
+        self.images = self.images.share_memory_()
+        self.targets = torch.zeros((n_buffers, self.batch_size),
+                                   dtype=torch.int64).share_memory_()
+        if self.pin_memory and torch.cuda.is_available():
+            self.pinned = self.register()
+
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        for i in range(self.n_workers):
+            worker = self.context.Process(
+                target=ring_worker,
+                args=(self.dataset, self.images, self.targets, self.tasks,
+                      self.results, self.seed + i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def register(self):
+        r""" Page-locks the buffers (cudaHostRegister), False on failure
+        (Ex: ulimit -l), batches are then pinned by the consumer. """
+        cudart, registered = torch.cuda.cudart(), []
+        for x in (self.images, self.targets):
+            error = cudart.cudaHostRegister(x.data_ptr(),
+                                            x.numel() * x.element_size(), 0)
+            if int(error) != 0:
+                for y in registered:
+                    cudart.cudaHostUnregister(y.data_ptr())
+                warnings.warn("RingLoader: cudaHostRegister failed ({}), "
+                              "buffers are not pinned".format(int(error)))
+                return False
+            registered.append(x)
+        return True
+
+    def __iter__(self):
+        if len(self.workers) == 0:
+            self.start()
+        assert self.images.size(0) > self.hold, \
+            "RingLoader: n_buffers must be > hold"
+        epoch = getattr(self.sampler, "epoch", None)
+        batches = self.batches()
+        free, in_use, ready = deque(range(self.images.size(0))), deque(), {}
+        events = {}  # buffer -> cuda event after the copies of its batch
+        submitted, outstanding, k = 0, 0, 0
+        try:
+            while True:
+                while len(free):
+                    indices = next(batches, None)
+                    if indices is None:
+                        break
+                    self.tasks.put((submitted, free.popleft(), indices))
+                    submitted, outstanding = submitted + 1, outstanding + 1
+                if k == submitted:
+                    # a full pass -- next iteration is the next epoch
+                    # (unless set_epoch or advance moved the sampler)
+                    if self.sampler is not None and \
+                            self.sampler.epoch == epoch:
+                        self.sampler.set_epoch(epoch + 1)
+                    break
+                while k not in ready:
+                    i, b, n, error = self.result()
+                    outstanding -= 1
+                    if error is not None:
+                        raise RuntimeError("RingLoader: worker failed\n" +
+                                           error)
+                    ready[i] = (b, n)
+                b, n = ready.pop(k)
+                k += 1
+                in_use.append(b)
+                while len(in_use) > self.hold:
+                    x = in_use.popleft()
+                    if x in events:  # copies reading the buffer are done
+                        events.pop(x).synchronize()
+                    free.append(x)
+                yield self.images[b, :n], self.targets[b, :n]
+                if self.pinned:
+                    # non_blocking copies of the batch are issued on the
+                    # current stream before the next batch is requested
+                    events[b] = torch.cuda.Event()
+                    events[b].record()
+        finally:  # results of the batches in flight
+            if self.pinned:  # copies of the batches held
+                torch.cuda.synchronize()
+            try:
+                if not all(x.is_alive() for x in self.workers):
+                    raise RuntimeError("RingLoader: worker died")
+                while outstanding > 0:
+                    self.result()
+                    outstanding -= 1
+            except RuntimeError:  # a worker died, restarted on next iter
+                self.close()
+
+    def result(self, interval: float = 5.):
+        r""" Next result of workers, checks if the workers are alive every
+        interval seconds (Ex: killed by the OOM killer). """
+        while True:
+            try:
+                return self.results.get(timeout=interval)
+            except queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            "RingLoader: worker (pid {}) exited "
+                            "unexpectedly, exitcode = {}".format(
+                                worker.pid, worker.exitcode))
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        if self.pinned:
+            cudart = torch.cuda.cudart()
+            for x in (self.images, self.targets):
+                cudart.cudaHostUnregister(x.data_ptr())
+            self.pinned = False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,225 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import os
+import io
+import json
+import random
+import tarfile
+import argparse
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+import torchvision.datasets as DataSET
+import torchvision.transforms as DataMods
+from PIL import Image as ImPIL
+from tqdm import tqdm
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def WriteShards(data_path, file_name, samples_per_shard=1000, seed=0):
+    r"""Writes an image folder (each folder represents a class, labels are
+    same as FolderITTR) to tar shards for TarShardITTR -- file_name-000000.tar,
+    file_name-000001.tar, ... with the original encoded image (key.ext) and
+    label (key.cls) of every sample, and an index (file_name.json) with
+    shards, samples per shard and classes. Samples are shuffled (seed) before
+    sharding, hence, every shard has a mix of labels.
+
+    Args:
+        data_path: full path to the folder of class folders
+        file_name: full path + name of the output, Ex: ../data/train_shards
+        samples_per_shard: default = 1000
+        seed: default = 0
+
+    Return:
+        file_name
+    """
+    data = DataSET.ImageFolder(data_path)
+    samples = list(data.samples)
+    random.Random(seed).shuffle(samples)
+    folder = os.path.dirname(os.path.abspath(file_name))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    shards = []
+    for i in tqdm(range(0, len(samples), samples_per_shard),
+                  desc="WriteShards"):
+        shard = "{}-{:06d}.tar".format(file_name, len(shards))
+        chunk = samples[i:i + samples_per_shard]
+        with tarfile.open(shard + ".tmp", "w") as tar:
+            for j, (path, label) in enumerate(chunk):
+                key = "{:09d}".format(i + j)
+                with open(path, "rb") as f:
+                    add_member(tar, key + os.path.splitext(path)[1].lower(),
+                               f.read())
+                add_member(tar, key + ".cls", str(label).encode())
+        os.replace(shard + ".tmp", shard)
+        shards.append({"file": os.path.basename(shard),
+                       "n_samples": len(chunk)})
+
+    with open(file_name + ".json", "w") as f:
+        json.dump({"classes": data.classes, "shards": shards}, f)
+    return file_name
+
+
+def read_shard(file_name):
+    r""" Streams (image bytes, label) from a tar shard (sequential reads). """
+    key, image, label = None, None, None
+    with tarfile.open(file_name, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name, ext = os.path.splitext(member.name)
+            if name != key:
+                if image is not None and label is not None:
+                    yield image, label
+                key, image, label = name, None, None
+            data = tar.extractfile(member).read()
+            if ext == ".cls":
+                label = int(data.decode())
+            else:
+                image = data
+    if image is not None and label is not None:
+        yield image, label
+
+
+class TarShardITTR(IterableDataset):
+    r"""Streams the tar shards of WriteShards. Every epoch, shards are
+    shuffled (seed + epoch) and split across distributed ranks and
+    DataLoader workers (shard i goes to consumer i % (ranks x workers)),
+    each consumer reads its shards sequentially and randomizes the samples
+    with a shuffle buffer of shuffle_buffer samples. Requires at least as
+    many shards as ranks x workers. Every rank yields n_samples // ranks
+    samples (same number of batches on every rank, like
+    DistributedSampler) -- a consumer with more samples than its share is
+    truncated, one with fewer repeats its shards. Images are decoded and
+    resized to tensor_size, returns a torch.Tensor image in the range
+    [0, 1] and label (same as FolderITTR).
+
+    Args:
+        file_name: full path + name given to WriteShards
+        tensor_size: BCHW, default = (6, 3, 224, 224)
+        shuffle_buffer: samples in the shuffle buffer, 0 = no shuffle,
+            default = 1000
+        functions: list of functions applied on pil images before resize,
+            default = []
+        random_flip: random horizontal flip, default = False
+        seed: default = 0
+
+    Ex:
+        data = NeuralEssentials.TarShardITTR("../data/train_shards",
+                                             (1, 3, 224, 224), 2000)
+        loader = DataLoader(data, batch_size=32, num_workers=4)
+        for epoch in range(epochs):
+            data.set_epoch(epoch)
+            for tensor, targets in loader:
+                ...
+    """
+    def __init__(self, file_name, tensor_size=(6, 3, 224, 224),
+                 shuffle_buffer=1000, functions=[], random_flip=False,
+                 seed=0):
+        with open(file_name + ".json") as f:
+            index = json.load(f)
+        folder = os.path.dirname(os.path.abspath(file_name))
+        self.shards = [os.path.join(folder, x["file"])
+                       for x in index["shards"]]
+        self.n_samples = sum(x["n_samples"] for x in index["shards"])
+        self.classes = index["classes"]
+        self.n_labels = len(self.classes)
+        self.tensor_size = tensor_size
+        self.shuffle_buffer = shuffle_buffer
+        self.functions = list(functions)
+        self.random_flip = random_flip
+        self.seed = seed
+        self.epoch = 0
+        self.to_tensor = DataMods.ToTensor()
+
+    def __len__(self):
+        return self.n_samples // max(1, self.consumer()[1][0])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def consumer():
+        r""" (rank, worker id) and (ranks, workers). """
+        rank, ranks = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, ranks = dist.get_rank(), dist.get_world_size()
+        worker = get_worker_info()
+        worker_id, workers = (0, 1) if worker is None else \
+            (worker.id, worker.num_workers)
+        return (rank, worker_id), (ranks, workers)
+
+    def decode(self, data, rng):
+        image = ImPIL.open(io.BytesIO(data))
+        image = image.convert("L" if self.tensor_size[1] == 1 else "RGB")
+        for fn in self.functions:
+            image = fn(image)
+        image = image.resize((self.tensor_size[3], self.tensor_size[2]),
+                             ImPIL.BILINEAR)
+        if self.random_flip and rng.random() > .5:
+            image = image.transpose(ImPIL.FLIP_LEFT_RIGHT)
+        return self.to_tensor(image)
+
+    @staticmethod
+    def stream(shards):
+        r""" Samples of shards, repeated till closed. """
+        while True:
+            for shard in shards:
+                for sample in read_shard(shard):
+                    yield sample
+
+    def __iter__(self):
+        (rank, worker_id), (ranks, workers) = self.consumer()
+        assert len(self.shards) >= ranks * workers, \
+            "TarShardITTR: shards ({}) must be >= ranks x workers " \
+            "({})".format(len(self.shards), ranks * workers)
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        consumer = rank * workers + worker_id
+        shards = shards[consumer::ranks * workers]
+        rng = random.Random((self.seed + self.epoch) * 1000003 + consumer)
+        # share of the consumer in the samples of its rank
+        per_rank = self.n_samples // ranks
+        remaining = per_rank // workers + \
+            int(worker_id < per_rank % workers)
+
+        buffer, stream = [], self.stream(shards)
+        try:
+            while remaining > len(buffer):
+                image, label = next(stream)
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((image, label))
+                    continue
+                if self.shuffle_buffer > 0:
+                    i = rng.randrange(len(buffer))
+                    buffer[i], (image, label) = (image, label), buffer[i]
+                remaining -= 1
+                yield self.decode(image, rng), label
+        finally:
+            stream.close()
+        rng.shuffle(buffer)
+        for image, label in buffer:
+            yield self.decode(image, rng), label
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Writes an image folder to "
+                                     "tar shards for TarShardITTR")
+    parser.add_argument("data_path", type=str)
+    parser.add_argument("file_name", type=str)
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # python -m core.NeuralEssentials.tarshards ../data/train \
+    #     ../data/train_shards --samples_per_shard 1000
+    args = parse_args()
+    WriteShards(args.data_path, args.file_name, args.samples_per_shard,
+                args.seed)
@@ -0,0 +1,369 @@
+""" TensorMONK's :: NeuralEssentials                                        """
+
+import queue
+import signal
+import threading
+from functools import partial
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+from .makemodel import SaveModel
+from .meters import Meters
+from .resumable import ResumableSampler, Preemption
+
+
+def to_device(data, device, non_blocking=True):
+    r""" Moves tensors in (nested) list/tuple to device. """
+    if isinstance(data, torch.Tensor):
+        if device.type == "cuda" and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(x, device, non_blocking) for x in data)
+    return data
+
+
+def reset_signals(worker_id):
+    r""" worker_init_fn of DataLoader -- workers forked in fit inherit the
+    handler of Preemption, SIGTERM must terminate them. """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def record_stream(data, stream):
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for x in data:
+            record_stream(x, stream)
+
+
+class Prefetcher:
+    r"""Iterates a loader in a background thread and copies the batches to
+    device ahead of their use. On cuda, batches are pinned and copied
+    (non_blocking) on a side stream, hence, the copy of the next batch
+    overlaps with the compute of the current batch.
+
+    Args:
+        loader: any iterable of batches (Ex: DataLoader)
+        device: torch.device, default = cpu
+        depth: number of batches prepared in advance, default = 2
+    """
+    def __init__(self, loader, device=torch.device("cpu"), depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def put(batches, stop, item):
+        r""" Waits for space in batches, False when the consumer stopped. """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) \
+            if self.device.type == "cuda" else None
+        try:
+            # the loader is iterated on stream -- loaders that reuse pinned
+            # buffers (RingLoader) wait for the copies on the current stream
+            with torch.cuda.stream(stream):
+                for batch in self.loader:
+                    batch = to_device(batch, self.device)
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    if not self.put(batches, stop, (batch, event)):
+                        return
+        except Exception as exception:
+            self.put(batches, stop, (exception, None))
+            return
+        self.put(batches, stop, (StopIteration(), None))
+
+    def __iter__(self):
+        batches, stop = queue.Queue(self.depth), threading.Event()
+        thread = threading.Thread(target=self.producer, args=(batches, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event = batches.get()
+                if isinstance(batch, StopIteration):
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    record_stream(batch, current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def default_loss(Model, tensor, targets):
+    r""" netEmbedding followed by netLoss. Returns loss and (top1, top5). """
+    features = Model.netEmbedding(tensor)
+    return Model.netLoss((features, targets))
+
+
+class Trainer:
+    r"""Training loop for Model from MakeModel (netEmbedding + netLoss) with
+    background prefetching of batches, non blocking transfers to gpu from
+    pinned memory, gradient accumulation, meters synced at an interval
+    (Meters), evaluation and checkpoint at the end of every eval_every and
+    save_every epochs.
+
+    Training is resumable -- optimizer, scheduler, sampler (ResumableSampler
+    or any batch sampler/sampler with state_dict) and the epoch are
+    registered to Model (saved by SaveModel and restored from the loaded
+    checkpoint). On SIGTERM, the current iteration is completed, checkpoint
+    is saved and the process exits (code 143).
+
+    Args:
+        Model: BaseModel from MakeModel
+        optimizer: torch.optim.Optimizer of all the parameters
+        train_data: DataLoader or Dataset (wrapped in a DataLoader with
+            batch_size, ResumableSampler, pinned memory, cpus workers and
+            the collate of the dataset when available, Ex: PackedFolderITTR)
+        test_data: DataLoader or Dataset for evaluation, default = None
+        epochs: total number of epochs (including the resumed), default = 6
+        batch_size: used when the data is a Dataset, default = 32
+        cpus: workers used when the data is a Dataset, default = 4
+        accumulate: number of batches per parameter update, default = 1
+        set_to_none: gradients are set to None instead of zeros,
+            default = True
+        prefetch: batches prepared in advance, default = 2
+        sync_every: iterations between host syncs of meters, default = 50
+        eval_every: epochs between evaluations, 0 = never, default = 1
+        save_every: epochs between checkpoints, 0 = never, default = 1
+        loss_fn: callable(Model, tensor, targets) that returns
+            loss, (top1, top5), default = netLoss((netEmbedding(tensor),
+            targets))
+        on_iteration: callable(Trainer) after every iteration, default = None
+        on_epoch: callable(Trainer) after every epoch, default = None
+        save_fn: callable(Model) to save, default = SaveModel
+        async_save: checkpoints are written in background (SaveModel),
+            default = False
+        keep: number of checkpoints retained (SaveModel), default = 1
+        scheduler: learning rate scheduler, stepped every epoch,
+            default = None
+        preemption: saves and exits on SIGTERM (handler is installed during
+            fit), default = True
+        show: prints meters, default = True
+
+    Ex:
+        Model = MakeModel(...)
+        optimizer = torch.optim.SGD(params, lr=0.06)
+        Trainer(Model, optimizer, trData, teData, epochs=6).fit()
+    """
+    def __init__(self,
+                 Model,
+                 optimizer,
+                 train_data,
+                 test_data=None,
+                 epochs: int = 6,
+                 batch_size: int = 32,
+                 cpus: int = 4,
+                 accumulate: int = 1,
+                 set_to_none: bool = True,
+                 prefetch: int = 2,
+                 sync_every: int = 50,
+                 eval_every: int = 1,
+                 save_every: int = 1,
+                 loss_fn=None,
+                 on_iteration=None,
+                 on_epoch=None,
+                 save_fn=None,
+                 async_save: bool = False,
+                 keep: int = 1,
+                 scheduler=None,
+                 preemption: bool = True,
+                 show: bool = True):
+
+        self.Model = Model
+        self.optimizer = optimizer
+        self.is_cuda = bool(getattr(Model, "is_cuda", False))
+        self.device = torch.device("cuda", torch.cuda.current_device()) \
+            if self.is_cuda else torch.device("cpu")
+        self.train_data = self.loader(train_data, batch_size, cpus, True)
+        self.test_data = None if test_data is None else \
+            self.loader(test_data, batch_size, cpus, False)
+        self.epochs = epochs
+        self.accumulate = max(1, accumulate)
+        self.set_to_none = set_to_none
+        self.prefetch = prefetch
+        self.sync_every = sync_every
+        self.eval_every = eval_every
+        self.save_every = save_every
+        self.loss_fn = default_loss if loss_fn is None else loss_fn
+        self.on_iteration = on_iteration
+        self.on_epoch = on_epoch
+        self.save_fn = partial(SaveModel, async_save=async_save, keep=keep) \
+            if save_fn is None else save_fn
+        self.scheduler = scheduler
+        self.use_preemption = preemption
+        self.preemption = None  # installed by fit
+        self.show = show
+
+        for loader in (self.train_data, self.test_data):
+            if hasattr(loader, "hold"):  # RingLoader -- batches in prefetch
+                loader.hold = max(loader.hold, prefetch + 2)
+
+        self.epoch = 0
+        self.sampler = None
+        for x in ("batch_sampler", "sampler"):
+            sampler = getattr(self.train_data, x, None)
+            if hasattr(sampler, "state_dict"):
+                self.sampler = sampler
+                break
+        if hasattr(Model, "register"):
+            for name, obj in (("optimizer", optimizer),
+                              ("scheduler", scheduler),
+                              ("sampler", self.sampler), ("trainer", self)):
+                if obj is not None:
+                    Model.register(name, obj)
+        self.meters = Meters(Model, sync_every=sync_every,
+                             print_every=1. if show else 0.)
+
+    def loader(self, data, batch_size, cpus, shuffle):
+        if isinstance(data, DataLoader) or not hasattr(data, "__getitem__"):
+            return data
+        if isinstance(data, IterableDataset):  # Ex: TarShardITTR
+            return DataLoader(data, batch_size=batch_size, num_workers=cpus,
+                              pin_memory=self.is_cuda, drop_last=shuffle,
+                              worker_init_fn=reset_signals)
+        return DataLoader(data, batch_size=batch_size,
+                          sampler=ResumableSampler(data, shuffle),
+                          num_workers=cpus, pin_memory=self.is_cuda,
+                          drop_last=shuffle, persistent_workers=cpus > 0,
+                          collate_fn=getattr(data, "collate", None),
+                          worker_init_fn=reset_signals)
+
+    def state_dict(self):
+        return {"epoch": self.epoch}
+
+    def load_state_dict(self, state):
+        self.epoch = int(state["epoch"])
+
+    def networks(self):
+        return [getattr(self.Model, x) for x in ("netEmbedding", "netLoss")
+                if getattr(self.Model, x) is not None]
+
+    def train_epoch(self):
+        for net in self.networks():
+            net.train()
+        for x in ("batch_sampler", "sampler", "dataset"):
+            sampler = getattr(self.train_data, x, None)
+            # Ex: DistributedSampler, TarShardITTR
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(self.epoch)
+
+        self.optimizer.zero_grad(set_to_none=self.set_to_none)
+        n_batches = 0
+        for i, (tensor, targets) in enumerate(
+                Prefetcher(self.train_data, self.device, self.prefetch)):
+            self.Model.meterIterations += 1
+            self.tensor, self.targets = tensor, targets
+            loss, (top1, top5) = self.loss_fn(self.Model, tensor, targets)
+            (loss / self.accumulate if self.accumulate > 1 else
+             loss).backward()
+            n_batches += 1
+            if n_batches % self.accumulate == 0:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=self.set_to_none)
+                if hasattr(self.sampler, "snapshot"):
+                    # Ex: HardNegativeSampler -- weights at a step boundary
+                    self.sampler.snapshot()
+
+            self.meters.update(tensor.size(0), loss=loss, top1=top1,
+                               top5=top5)
+            if hasattr(self.sampler, "advance"):
+                self.sampler.advance(tensor.size(0))
+            if self.on_iteration is not None:
+                self.on_iteration(self)
+            if self.preemption is not None and self.preemption.requested:
+                self.preempt()
+        if n_batches % self.accumulate != 0:  # left over gradients
+            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=self.set_to_none)
+        self.epoch += 1
+        if self.scheduler is not None:
+            self.scheduler.step()
+        return self.meters.epoch(self.show)
+
+    def preempt(self):
+        r""" Saves the checkpoint (mid epoch) and exits. """
+        if self.show:
+            print("\n... preempted at iteration {}, saving".format(
+                self.Model.meterIterations))
+        self.meters.sync()
+        self.save_fn(self.Model)
+        if getattr(self.Model, "checkpoint", None) is not None:
+            self.Model.checkpoint.wait()
+        raise SystemExit(143)
+
+    def evaluate(self, data=None):
+        r""" Returns the averages of loss, top1, top5 on data (default =
+        test_data). """
+        data = self.test_data if data is None else data
+        for net in self.networks():
+            net.eval()
+        # synced once, at the end
+        meters = Meters(None, sync_every=1 << 30, print_every=0.)
+        with torch.no_grad():
+            for tensor, targets in Prefetcher(data, self.device,
+                                              self.prefetch):
+                loss, (top1, top5) = self.loss_fn(self.Model, tensor, targets)
+                meters.update(tensor.size(0), loss=loss, top1=top1,
+                              top5=top5)
+        for net in self.networks():
+            net.train()
+        averages = meters.averages()
+        if self.show:
+            print("... Test accuracy - {:3.2f}/{:3.2f}".format(
+                averages["top1"], averages["top5"]))
+        return averages
+
+    def fit(self, epochs=None):
+        r""" Trains till epochs (total, including the resumed epochs). """
+        epochs = self.epochs if epochs is None else epochs
+        if self.use_preemption:
+            self.preemption = Preemption()
+        try:
+            while self.epoch < epochs:
+                self.train_epoch()
+                if self.save_every > 0 and \
+                        self.epoch % self.save_every == 0:
+                    self.save_fn(self.Model)
+                if self.test_data is not None and self.eval_every > 0 and \
+                        self.epoch % self.eval_every == 0:
+                    self.evaluate()
+                if self.on_epoch is not None:
+                    self.on_epoch(self)
+            if getattr(self.Model, "checkpoint", None) is not None:
+                self.Model.checkpoint.wait()  # write in flight
+        finally:
+            if self.preemption is not None:
+                self.preemption.restore()
+                self.preemption = None
+        return self.Model
+
+
+# import core
+# trData, vaData, teData, n_labels, tensor_size = \
+#     core.NeuralEssentials.DataSets("mnist", data_path="../data")
+# Model = core.NeuralEssentials.MakeModel(
+#     "./models/test", tensor_size, n_labels,
+#     embedding_net=core.NeuralArchitectures.SimpleNet,
+#     loss_net=core.NeuralLayers.CategoricalLoss)
+# optimizer = torch.optim.SGD(list(Model.netEmbedding.parameters()) +
+#                             list(Model.netLoss.parameters()), lr=0.06)
+# Trainer(Model, optimizer, trData, teData, epochs=1, accumulate=2).fit()
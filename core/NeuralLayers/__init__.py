@@ -8,7 +8,8 @@ __all__ = ["Linear", "Convolution", "ConvolutionTranspose",
            "ReductionB", "ContextNet_Bottleneck",
            "PrimaryCapsule", "RoutingCapsule",
            "ConvolutionalSAE", "DetailPooling",
-           "CapsuleLoss", "CategoricalLoss", "TripletLoss", "DiceLoss",
+           "CapsuleLoss", "CategoricalLoss", "ShardedCategoricalLoss",
+           "TripletLoss", "DiceLoss", "CrossBatchMemory",
            "ObfuscateDecolor", "Activations", "Normalizations"]
 
 
@@ -24,7 +25,8 @@ from .routingcapsule import RoutingCapsule
 from .sae import ConvolutionalSAE
 
 from .detailpooling import DetailPooling
-from .lossfunctions import CapsuleLoss, CategoricalLoss, TripletLoss, DiceLoss
+from .lossfunctions import CapsuleLoss, CategoricalLoss, \
+    ShardedCategoricalLoss, TripletLoss, DiceLoss, CrossBatchMemory
 from .obfuscatedecolor import ObfuscateDecolor
 
 from .activations import Activations
@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from torch.autograd.function import Function
+import torch.distributed as dist
+from torch.autograd.function import Function, once_differentiable
 # =========================================================================== #
 
 
@@ -18,12 +19,13 @@ def compute_n_embedding(tensor_size):
 
 
 def compute_top15(responses, targets):
-    predicted = responses.topk(5, 1, True, True)[1]
-    predicted = predicted.t()
-    correct = predicted.eq(targets.view(1, -1).expand_as(predicted))
-    top1 = correct[:1].view(-1).float().sum().mul_(100.0 / responses.size(0))
-    top5 = correct[:5].view(-1).float().sum().mul_(100.0 / responses.size(0))
-    return top1, top5
+    r""" top1 and top5 (in percentage) as tensors on the device -- a single
+    topk, and the matches are counted for all k at once. """
+    k = min(5, responses.size(1))
+    predicted = responses.topk(k, 1, True, True)[1]
+    correct = predicted.eq(targets.view(-1, 1).to(predicted.device))
+    counts = correct.float().sum(0).cumsum(0).mul_(100.0 / responses.size(0))
+    return counts[0], counts[-1]
 
 
 def one_hot(targets, n_labels):
@@ -41,53 +43,269 @@ def one_hot_idx(targets, n_labels):
 
 def nlog_likelihood(tensor, targets):
     return F.nll_loss(tensor.log_softmax(1), targets)
+
+
+def labels_per_chunk(tensor, n_labels, memory_budget):
+    r""" Number of labels per chunk, such that a few n_samples x n_labels
+    intermediates fit in memory_budget (bytes). """
+    if memory_budget is None or memory_budget <= 0:
+        return n_labels
+    per_label = 4 * tensor.size(0) * tensor.element_size()
+    return int(max(1, min(n_labels, memory_budget // per_label)))
+
+
+class EuclideanDistance(Function):
+    r""" Euclidean distance between every row of tensor and weight, computed
+    in chunks of n labels. Only tensor and weight are saved, backward
+    recomputes the squared distances of a chunk -- the n_samples x n
+    intermediates of a single chunk are alive at a time (besides the output
+    and its gradient). Does not support double backward.
+    """
+
+    @staticmethod
+    def squares(tensor, weight, sum_squares):
+        return torch.addmm(sum_squares + weight.pow(2).sum(1).view(1, -1),
+                           tensor, weight.t(), beta=1, alpha=-2)
+
+    @staticmethod
+    def forward(ctx, tensor, weight, n):
+        ctx.n = n
+        ctx.save_for_backward(tensor, weight)
+        sum_squares = tensor.pow(2).sum(1, True)
+        responses = tensor.new_empty(tensor.size(0), weight.size(0))
+        for i in range(0, weight.size(0), n):
+            squares = EuclideanDistance.squares(tensor, weight[i:i + n],
+                                                sum_squares)
+            # clamp -- rounding errors and stable gradients at zero distance
+            torch.sqrt(squares.clamp_(1e-12), out=responses[:, i:i + n])
+        return responses
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        tensor, weight = ctx.saved_tensors
+        n = ctx.n
+        sum_squares = tensor.pow(2).sum(1, True)
+        grad_tensor = torch.zeros_like(tensor)
+        grad_weight = torch.empty_like(weight)
+        for i in range(0, weight.size(0), n):
+            w = weight[i:i + n]
+            squares = EuclideanDistance.squares(tensor, w, sum_squares)
+            # d sqrt(clamp(x)) / dx = 0.5 / sqrt(x), zero when clamped
+            grad = grad_output[:, i:i + n].mul(squares.ge(1e-12))
+            grad = grad.div_(squares.clamp_(1e-12).sqrt_().mul_(2))
+            del squares
+            # x = ||a||^2 + ||w||^2 - 2aw
+            grad_tensor.addmm_(grad, w, alpha=-2)
+            grad_tensor.add_(tensor * grad.sum(1, True), alpha=2)
+            grad_weight[i:i + n] = torch.addmm(
+                w * grad.sum(0).view(-1, 1), grad.t(), tensor,
+                beta=2, alpha=-2)
+        return grad_tensor, grad_weight, None
+
+
+def euclidean_distance(tensor, weight, memory_budget=None):
+    r""" Euclidean distance between every row of tensor and weight computed
+    with ||a||^2 + ||b||^2 - 2ab (no n_samples x n_labels x n_embedding
+    intermediate). With memory_budget (bytes), the distances are computed in
+    chunks of labels by EuclideanDistance (recomputed in backward). """
+    if memory_budget is None or memory_budget <= 0:
+        responses = EuclideanDistance.squares(tensor, weight,
+                                              tensor.pow(2).sum(1, True))
+        # clamp -- rounding errors and stable gradients at zero distance
+        return responses.clamp(1e-12).pow(0.5)
+    n = labels_per_chunk(tensor, weight.size(0), memory_budget)
+    return EuclideanDistance.apply(tensor, weight, n)
 # =========================================================================== #
 
 
-def hardest_negative(lossValues, margin):
-    return lossValues.max(2)[0].max(1)[0].mean()
+class CrossBatchMemory(nn.Module):
+    r""" Cross batch memory -- a fixed size FIFO of recent embeddings and
+    labels (detached) on the training device. Metric learning losses mine
+    against the memory along with the batch, giving the negatives of a large
+    batch at the cost of a small batch.
+    Implemented -- https://arxiv.org/pdf/1912.06798.pdf
 
+    Args:
+        size (int): number of embeddings in memory
+        normalize (bool): l2-normalizes embeddings on enqueue, default = False
 
-def semihard_negative(lossValues, margin):
-    lossValues = torch.where((torch.ByteTensor(lossValues > 0.) &
-                              torch.ByteTensor(lossValues < margin)),
-                             lossValues, torch.zeros(lossValues.size()))
-    return lossValues.max(2)[0].max(1)[0].mean()
+    Return:
+        enqueue(embeddings, labels) -- adds the batch to memory, written on
+            the next get(), so, the memory used by a step is not modified
+            before its backward
+        get() -- embeddings (n x n_embedding) and labels (n) in memory
+    """
+    def __init__(self, size: int, normalize: bool = False):
+        super(CrossBatchMemory, self).__init__()
+        assert size > 0, "CrossBatchMemory :: size must be > 0"
+        self.size = size
+        self.normalize = normalize
+        # allocated on first write (n_embedding/device of the embeddings)
+        # and not saved in checkpoints
+        self.register_buffer("embeddings", None, persistent=False)
+        self.register_buffer("labels", None, persistent=False)
+        self.pointer, self.n = 0, 0
+        self.pending = []
+
+    def __len__(self):
+        return min(self.size, self.n + sum(x.size(0) for x, _ in
+                                           self.pending))
+
+    def enqueue(self, embeddings, labels):
+        embeddings = embeddings.detach().view(embeddings.size(0), -1)
+        self.pending.append((embeddings, labels.detach().view(-1).long()))
+
+    @torch.no_grad()
+    def write(self, embeddings, labels):
+        if self.normalize:
+            embeddings = F.normalize(embeddings, p=2, dim=1)
+        if self.embeddings is None:
+            self.embeddings = embeddings.new_zeros(self.size,
+                                                   embeddings.size(1))
+            self.labels = labels.new_full((self.size, ), -1)
+        embeddings, labels = embeddings[-self.size:], labels[-self.size:]
+
+        n = embeddings.size(0)
+        end = min(self.pointer + n, self.size)
+        self.embeddings[self.pointer:end] = embeddings[:end-self.pointer]
+        self.labels[self.pointer:end] = labels[:end-self.pointer]
+        if end - self.pointer < n:  # wrap around
+            rest = n - (end - self.pointer)
+            self.embeddings[:rest] = embeddings[-rest:]
+            self.labels[:rest] = labels[-rest:]
+        self.pointer = (self.pointer + n) % self.size
+        self.n = min(self.n + n, self.size)
+
+    def get(self):
+        while len(self.pending):
+            self.write(*self.pending.pop(0))
+        return self.embeddings[:self.n], self.labels[:self.n]
+
+
+def squared_euclidean(tensor, others=None):
+    r""" Pairwise squared euclidean distance (divided by n_embedding) between
+    rows of tensor and others (default = tensor) with a single matmul. """
+    others = tensor if others is None else others
+    distances = torch.addmm(tensor.pow(2).sum(1, True) +
+                            others.pow(2).sum(1).view(1, -1),
+                            tensor, others.t(), beta=1, alpha=-2)
+    return distances.clamp(0).div(tensor.size(1))
+
+
+def sorted_negatives(distances, negatives):
+    r""" Sorts the distances of negatives per anchor (ascending). Returns
+    sorted distances (non negatives are inf), cumulative sum of sorted
+    distances (prefixed with zero) and number of negatives per anchor. """
+    inf = torch.full_like(distances, float("inf"))
+    values = torch.where(negatives, distances, inf).sort(1)[0]
+    n_negatives = negatives.sum(1)
+    valid = torch.arange(values.size(1), device=values.device).view(1, -1) \
+        < n_negatives.view(-1, 1)
+    cumsum = torch.where(valid, values, torch.zeros_like(values)).cumsum(1)
+    cumsum = torch.cat((cumsum.new_zeros(cumsum.size(0), 1), cumsum), 1)
+    return values, cumsum, n_negatives
+
+
+def hardest_negative(distances, positives, negatives, margin):
+    r""" Batch hard -- per anchor, hardest positive and hardest negative. """
+    hardest_positive = torch.where(positives, distances,
+                                   torch.full_like(distances, -1.)).max(1)[0]
+    hardest_negative = torch.where(negatives, distances,
+                                   torch.full_like(distances,
+                                                   float("inf"))).min(1)[0]
+    valid = positives.any(1) & negatives.any(1)
+    loss = (hardest_positive - hardest_negative + margin).clamp(0.)
+    return loss[valid].mean() if valid.any() else loss.sum() * 0.
+
+
+def semihard_negative(distances, positives, negatives, margin):
+    r""" Semi hard -- for every anchor-positive pair, the closest negative
+    that is farther than the positive and within the margin. Max over
+    positives and mean over anchors. """
+    values, _, n_negatives = sorted_negatives(distances, negatives)
+    # smallest negative distance > positive distance of every pair
+    idx = torch.searchsorted(values.contiguous(), distances.contiguous(),
+                             right=True)
+    semihard = values.gather(1, idx.clamp(max=values.size(1)-1))
+    loss = distances - semihard + margin
+    valid = positives & (idx < n_negatives.view(-1, 1)) & (loss > 0)
+    loss = torch.where(valid, loss, torch.zeros_like(loss))
+    return loss.max(1)[0].mean()
+
+
+def batch_all(distances, positives, negatives, margin):
+    r""" Batch all -- mean over all the triplets with a loss > 0. Computed
+    per anchor with sorted negatives and cumulative sums, for positive pair
+    (a, p) sum_n max(0, d_ap - d_an + margin) = count * (d_ap + margin) -
+    sum of the count negatives with d_an < d_ap + margin. """
+    values, cumsum, n_negatives = sorted_negatives(distances, negatives)
+    counts = torch.searchsorted(values.contiguous(),
+                                (distances + margin).contiguous())
+    counts = torch.min(counts, n_negatives.view(-1, 1))
+    counts = torch.where(positives, counts, torch.zeros_like(counts))
+    loss = counts.to(distances.dtype) * (distances + margin) - \
+        cumsum.gather(1, counts)
+    return loss.sum() / counts.sum().clamp(min=1).to(loss.dtype)
 
 
 class TripletLoss(nn.Module):
+    r""" Triplet loss with online mining. Pairwise distances (squared
+    euclidean divided by n_embedding) are computed with a single matmul,
+    positives and negatives are from labels, and mining is on the device.
+    Use along with FewPerLabel and PKBatchSampler (P labels x K samples per
+    label) to have K samples for each of the P labels in a batch.
+
+    Args:
+        margin (float): triplet margin
+        negative_selection_fn (str): hardest_negative (batch hard) /
+            semihard_negative / batch_all, default = hardest_negative
+        samples_per_class: not required (labels are used), retained for
+            backward compatibility
+        memory_size (int): when > 0, anchors of the batch are mined against
+            the batch and a CrossBatchMemory of memory_size recent
+            embeddings, default = 0
+
+    Return:
+        loss, positive pair distances, negative pair distances
+    """
     def __init__(self, margin, negative_selection_fn='hardest_negative',
-                 samples_per_class=2, *args, **kwargs):
+                 samples_per_class=2, memory_size=0, *args, **kwargs):
         super(TripletLoss, self).__init__()
         self.tensor_size = (1,)
         self.margin = margin
+        assert negative_selection_fn in ("hardest_negative",
+                                         "semihard_negative", "batch_all"), \
+            "TripletLoss :: negative_selection_fn != " + \
+            "hardest_negative/semihard_negative/batch_all"
         self.negative_selection_fn = negative_selection_fn
-        self.sqrEuc = lambda x: (x.unsqueeze(0) -
-                                 x.unsqueeze(1)).pow(2).sum(2).div(x.size(1))
-        self.perclass = samples_per_class
+        self.memory = CrossBatchMemory(memory_size) if memory_size > 0 \
+            else None
 
     def forward(self, embeddings, labels):
-        labels = torch.from_numpy(np.array([1, 1, 0, 1, 1], dtype='float32'))
-        InClass = labels.reshape(-1, 1) == labels.reshape(1, -1)
-        Consider = torch.eye(labels.size(0)).mul(-1).add(1) \
-                        .type(InClass.type())
-        Scores = self.sqrEuc(embeddings)
-
-        Gs = Scores.view(-1, 1)[(InClass*Consider).view(-1, 1)] \
-            .reshape(-1, self.perclass-1)
-        Is = Scores.view(-1, 1)[(InClass == 0).view(-1, 1)] \
-            .reshape(-1, embeddings.size(0)-self.perclass)
-
-        lossValues = Gs.view(embeddings.size(0), -1, 1) - \
-            Is.view(embeddings.size(0), 1, -1) + self.margin
-        lossValues = lossValues.clamp(0.)
+        embeddings = embeddings.view(embeddings.size(0), -1)
+        labels = labels.view(-1)
+        candidates, candidate_labels = embeddings, labels
+        if self.memory is not None and len(self.memory) > 0:
+            memory, memory_labels = self.memory.get()
+            candidates = torch.cat((embeddings, memory), 0)
+            candidate_labels = torch.cat((labels, memory_labels), 0)
+        distances = squared_euclidean(embeddings, candidates)
+        positives = labels.view(-1, 1) == candidate_labels.view(1, -1)
+        negatives = ~positives
+        positives[:, :labels.numel()].fill_diagonal_(False)
+        if self.memory is not None and self.training:
+            self.memory.enqueue(embeddings, labels)
 
         if self.negative_selection_fn == "hardest_negative":
-            return hardest_negative(lossValues, self.margin), Gs, Is
+            loss = hardest_negative(distances, positives, negatives,
+                                    self.margin)
         elif self.negative_selection_fn == "semihard_negative":
-            return semihard_negative(lossValues, self.margin), Gs, Is
+            loss = semihard_negative(distances, positives, negatives,
+                                     self.margin)
         else:
-            raise NotImplementedError
+            loss = batch_all(distances, positives, negatives, self.margin)
+        return loss, distances.data[positives], distances.data[negatives]
 # =========================================================================== #
 
 
@@ -195,6 +413,16 @@ class CategoricalLoss(nn.Module):
         margin (float): margin for lcml, default = 0.3
         alpha (float): center or lmgm, default = 0.5
         defaults (float): deafults center, lcml, & lmgm parameters
+        memory_budget (int): bytes available for the intermediate responses
+            of lmgm (euclidean), responses are computed in chunks of labels
+            and recomputed in backward (None = single autograd graph),
+            default = 2**28
+        sparse_centers (bool): when True, gradient of centers is sparse (only
+            rows of labels in the batch), default = False
+        memory_size (int): when > 0 (requires measure = cosine or lmcl), the
+            embeddings of a CrossBatchMemory with memory_size recent
+            embeddings are used as additional negatives (embeddings of other
+            labels) in softmax, default = 0
 
     Return:
         loss, (top1, top5)
@@ -209,6 +437,9 @@ class CategoricalLoss(nn.Module):
                  margin: float = 0.3,
                  alpha: float = 0.5,
                  defaults: bool = False,
+                 memory_budget: int = 2**28,
+                 sparse_centers: bool = False,
+                 memory_size: int = 0,
                  *args, **kwargs):
         super(CategoricalLoss, self).__init__()
 
@@ -236,29 +467,47 @@ class CategoricalLoss(nn.Module):
             self.centers = nn.Parameter(
                 F.normalize(torch.randn(n_labels, n_embedding), p=2, dim=1))
             self.center_function = CenterFunction.apply
+            self.sparse_centers = sparse_centers
 
         self.scale = scale
         self.margin = margin
         self.alpha = alpha
         self.n_labels = n_labels
+        self.memory_budget = memory_budget
+
+        self.memory = None
+        if memory_size > 0:
+            assert self.type != "lmgm" and (self.measure == "cosine" or
+                                            self.type == "lmcl"), \
+                "CategoricalLoss :: memory requires cosine/lmcl (not lmgm)"
+            self.memory = CrossBatchMemory(memory_size)
 
         self.weight = nn.Parameter(torch.randn(n_labels, n_embedding))
+        self._normalized = None
         self.tensor_size = (1, )
 
+    def normalize_weight(self):
+        r""" l2-normalizes the weight (in place). Skipped when the weight is
+        unchanged since the last normalization -- any update (optimizer step,
+        load_state_dict, etc) bumps the parameter's version. """
+        state = (self.weight._version, self.weight.data_ptr())
+        if self._normalized != state:
+            self.weight.data = F.normalize(self.weight.data, p=2, dim=1)
+            self._normalized = (self.weight._version,
+                                self.weight.data_ptr())
+
     def forward(self, tensor, targets):
 
         if self.type == "lmgm":
-            # TODO euclidean computation is not scalable to larger n_labels
             # mahalanobis with identity covariance per paper = squared
             # euclidean -- does euclidean for stability
-            # Switch to measure="cosine" if you have out of memory issues
             if self.measure == "cosine":
-                self.weight.data = F.normalize(self.weight.data, p=2, dim=1)
+                self.normalize_weight()
                 tensor = F.normalize(tensor, p=2, dim=1)
                 responses = 1 - tensor.mm(self.weight.t())
             else:
-                responses = (tensor.unsqueeze(1) - self.weight.unsqueeze(0))
-                responses = responses.pow(2).sum(2).pow(0.5)
+                responses = euclidean_distance(tensor, self.weight,
+                                               self.memory_budget)
             (top1, top5) = compute_top15(- responses.data, targets.data)
 
             true_idx = one_hot_idx(targets, self.n_labels)
@@ -270,21 +519,40 @@ class CategoricalLoss(nn.Module):
             return loss, (top1, top5)
 
         if self.measure == "cosine" or self.type == "lmcl":
-            self.weight.data = F.normalize(self.weight.data, p=2, dim=1)
+            self.normalize_weight()
             tensor = F.normalize(tensor, p=2, dim=1)
         responses = tensor.mm(self.weight.t())
         if self.measure == "cosine" or self.type == "lmcl":
             responses = responses.clamp(-1., 1.)
         (top1, top5) = compute_top15(responses.data, targets.data)
 
+        # cosine similarity with memory embeddings of other labels are
+        # additional negatives (ignored in top1 and top5)
+        memory = None
+        if self.memory is not None and len(self.memory) > 0:
+            embeddings, labels = self.memory.get()
+            memory = tensor.mm(embeddings.t()).clamp(-1., 1.)
+            same = targets.view(-1, 1) == labels.view(1, -1)
+        if self.memory is not None and self.training:
+            self.memory.enqueue(tensor, targets)
+
+        def with_memory(responses, memory):
+            if memory is None:
+                return responses
+            memory = memory.masked_fill(same, float("-inf"))
+            return torch.cat((responses, memory), 1)
+
         if self.type == "tsmax":  # Taylor series
             responses = 1 + responses + 0.5*(responses**2)
+            if memory is not None:
+                memory = 1 + memory + 0.5*(memory**2)
 
         if self.type == "entr":
-            loss = F.cross_entropy(responses, targets.view(-1))
+            loss = F.cross_entropy(with_memory(responses, memory),
+                                   targets.view(-1))
 
         elif self.type in ("smax", "tsmax"):
-            loss = nlog_likelihood(responses, targets)
+            loss = nlog_likelihood(with_memory(responses, memory), targets)
 
         elif self.type == "lmcl":
             m, s = min(0.5, self.margin), max(self.scale, 1.)
@@ -292,21 +560,31 @@ class CategoricalLoss(nn.Module):
             responses = responses.view(-1)
             responses[true_idx] = responses[true_idx] - m
             responses = (responses * s).view(tensor.size(0), -1)
-            loss = nlog_likelihood(responses, targets)
+            loss = nlog_likelihood(with_memory(responses, None if memory is
+                                               None else memory * s), targets)
         else:
             raise NotImplementedError
 
         if self.center:
             loss = loss + self.center_function(tensor, targets.long(),
-                                               self.centers, self.center_alpha)
+                                               self.centers, self.center_alpha,
+                                               self.sparse_centers)
 
         return loss, (top1, top5)
 
 
 class CenterFunction(Function):
+    r""" Center loss with the per label center update in backward. The
+    gradient of centers (only for labels in the batch) is computed with
+    index_add_ -- no loop over labels and no host sync (except unique when
+    sparse). When sparse is True, the gradient of centers is a sparse tensor
+    with rows of labels in the batch (use with optimizers that support
+    sparse gradients, Ex: SGD/SparseAdam).
+    """
 
     @staticmethod
-    def forward(ctx, tensor, targets, centers, alpha):
+    def forward(ctx, tensor, targets, centers, alpha, sparse=False):
+        ctx.sparse = sparse
         ctx.save_for_backward(tensor, targets, centers, alpha)
         target_centers = centers.index_select(0, targets)
         return 0.5 * (tensor - target_centers).pow(2).sum()
@@ -314,18 +592,250 @@ class CenterFunction(Function):
     @staticmethod
     def backward(ctx, grad_output):
 
-        tensor, targets, centers, alpha = ctx.saved_variables
-        grad_tensor = grad_centers = None
-        grad_centers = torch.zeros(centers.size()).to(tensor.device)
-        grad_tensor = tensor - centers.index_select(0, targets.long())
+        tensor, targets, centers, alpha = ctx.saved_tensors
+        targets = targets.long()
+        grad_tensor = tensor - centers.index_select(0, targets)
+
+        if ctx.sparse:
+            # labels in the batch
+            labels, targets = torch.unique(targets, return_inverse=True)
+            n_labels = labels.numel()
+        else:
+            n_labels = centers.size(0)
+        sums = tensor.new_zeros(n_labels, tensor.size(1))
+        sums.index_add_(0, targets, tensor.detach())
+        # index_add_ (bincount syncs with the host to size its output)
+        counts = sums.new_zeros(n_labels).index_add_(
+            0, targets, sums.new_ones(targets.size(0)))
+
+        if ctx.sparse:
+            values = centers.index_select(0, labels) - \
+                sums.div(counts.unsqueeze(1)).mul(alpha)
+            grad_centers = torch.sparse_coo_tensor(labels.view(1, -1), values,
+                                                   centers.size())
+        else:
+            present = (counts > 0).to(sums.dtype).unsqueeze(1)
+            means = sums.div(counts.clamp(min=1).unsqueeze(1))
+            grad_centers = (centers - means.mul(alpha)) * present
+
+        return grad_tensor * grad_output, None, grad_centers, None, None
+
+
+def distributed(group=None):
+    r""" Returns (rank, world_size) of the group, (0, 1) when
+    torch.distributed is not initialized. """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(group), dist.get_world_size(group)
+    return 0, 1
+
 
-        unique = torch.unique(targets.long())
-        for j in unique:
-            grad_centers[j] += centers[j] - \
-                tensor.data[targets == j].mean(0).mul(alpha)
+class AllGather(Function):
+    r""" Gathers equal sized tensors from all the ranks (along dim-0). The
+    gradients of all ranks are summed and each rank receives its slice. """
 
-        return grad_tensor * grad_output, None, grad_centers, None
+    @staticmethod
+    def forward(ctx, tensor, group):
+        ctx.group = group
+        ctx.rank, world_size = distributed(group)
+        if world_size == 1:
+            return tensor.clone()
+        tensors = [torch.empty_like(tensor) for _ in range(world_size)]
+        dist.all_gather(tensors, tensor.contiguous(), group=group)
+        ctx.n = tensor.size(0)
+        return torch.cat(tensors, 0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if not hasattr(ctx, "n"):
+            return grad_output, None
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output, dist.ReduceOp.SUM, group=ctx.group)
+        return grad_output[ctx.rank*ctx.n:(ctx.rank+1)*ctx.n], None
+
+
+class AllReduceSum(Function):
+    r""" Sum across ranks. Every rank computes the same loss from the sum,
+    hence, the gradient w.r.t each rank's input is the incoming gradient. """
+
+    @staticmethod
+    def forward(ctx, tensor, group):
+        tensor = tensor.clone()
+        if distributed(group)[1] > 1:
+            dist.all_reduce(tensor, dist.ReduceOp.SUM, group=group)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output, None
+
+
+class ShardedCategoricalLoss(nn.Module):
+    r""" Model parallel CategoricalLoss for millions of labels. The weight
+    (n_labels x n_embedding) is split across the ranks of torch.distributed
+    group -- each rank holds a contiguous shard of labels (and its gradients
+    and optimizer state). Embeddings and targets of all ranks are gathered,
+    every rank computes the responses of its labels, and the softmax is
+    computed with an all-reduce of max and sum of exponentials. Works with
+    gloo (cpu) and nccl backends, and without torch.distributed (single
+    shard).
+
+    Partial-FC -- when sample_rate < 1, each rank uses the labels present in
+    the gathered targets and randomly samples the remaining negative labels,
+    such that ceil(sample_rate * labels in shard) labels are used per step.
+
+    The loss is the mean over the global batch, and is identical on every
+    rank. Every rank must save/load its own shard (state_dict). The
+    gradients of the embeddings are of the global loss -- when the embedding
+    network is wrapped with DistributedDataParallel (averages the gradients),
+    scale the learning rate of the embedding network by world size.
+
+    Args:
+        tensor_size (int/list/tuple): shape of tensor in
+            (None/any integer >0, in_features) or in_features
+        n_labels (int): total number of labels (across all the ranks)
+        type (str): loss function, options = entr/smax/tsmax/lmcl,
+            default = entr (see CategoricalLoss)
+        measure (str): cosine/dot, default = dot
+        scale (float): s in lcml, default = 0.5
+        margin (float): margin for lcml, default = 0.3
+        defaults (bool): defaults lcml parameters
+        sample_rate (float): fraction of labels per shard used per step,
+            default = 1.
+        group: torch.distributed process group, default = None (WORLD)
+
+    Return:
+        loss, (top1, top5) -- top1 and top5 are over the global batch
+    """
+    def __init__(self,
+                 tensor_size,
+                 n_labels,
+                 type: str = "entr",
+                 measure: str = "dot",
+                 scale: float = 0.5,
+                 margin: float = 0.3,
+                 defaults: bool = False,
+                 sample_rate: float = 1.,
+                 group=None,
+                 *args, **kwargs):
+        super(ShardedCategoricalLoss, self).__init__()
+
+        n_embedding = compute_n_embedding(tensor_size)
+        self.type = type.lower()
+        self.measure = measure.lower()
+        assert self.type in ("entr", "smax", "tsmax", "lmcl"), \
+            "ShardedCategoricalLoss :: type != entr/smax/tsmax/lmcl"
+        assert self.measure in ("dot", "cosine"), \
+            "ShardedCategoricalLoss :: measure != dot/cosine"
+        assert 0. < sample_rate <= 1., \
+            "ShardedCategoricalLoss :: sample_rate must be > 0 and <= 1"
+        if defaults and self.type == "lmcl":
+            margin, scale = 0.35, 10
+
+        self.group = group
+        self.rank, self.world_size = distributed(group)
+        # labels [offset, offset + n_shard) are in this rank
+        sizes = [n_labels // self.world_size +
+                 (1 if r < n_labels % self.world_size else 0)
+                 for r in range(self.world_size)]
+        self.offset = sum(sizes[:self.rank])
+        self.n_shard = sizes[self.rank]
+
+        self.scale = scale
+        self.margin = margin
+        self.sample_rate = sample_rate
+        self.n_labels = n_labels
+
+        self.weight = nn.Parameter(torch.randn(self.n_shard, n_embedding))
+        self._normalized = None
+        self.tensor_size = (1, )
+
+    normalize_weight = CategoricalLoss.normalize_weight
+
+    def sample(self, targets):
+        r""" Returns the indices of labels used from the shard and targets
+        mapped to the indices (-1 when the target is not in the shard). """
+        targets = targets - self.offset
+        in_shard = (targets >= 0) & (targets < self.n_shard)
+        targets = targets.clamp(0, self.n_shard-1)
+        if self.sample_rate >= 1.:
+            return None, torch.where(in_shard, targets,
+                                     torch.full_like(targets, -1))
+
+        # positives are always picked, and the rest are random negatives
+        priority = torch.rand(self.n_shard, device=targets.device)
+        priority[targets[in_shard]] = 2.
+        n = max(int(np.ceil(self.sample_rate * self.n_shard)),
+                int((priority == 2.).sum()))
+        index = priority.topk(n)[1].sort()[0]
+        mapping = torch.full((self.n_shard, ), -1, dtype=torch.long,
+                             device=targets.device)
+        mapping[index] = torch.arange(n, device=targets.device)
+        return index, torch.where(in_shard, mapping[targets],
+                                  torch.full_like(targets, -1))
+
+    def forward(self, tensor, targets):
+        tensor = AllGather.apply(tensor.view(tensor.size(0), -1), self.group)
+        targets = AllGather.apply(targets.view(-1).long(), self.group)
+        index, local_targets = self.sample(targets)
+        if self.measure == "cosine" or self.type == "lmcl":
+            self.normalize_weight()
+            tensor = F.normalize(tensor, p=2, dim=1)
+        weight = self.weight if index is None else self.weight[index]
+        responses = tensor.mm(weight.t())
+        if self.measure == "cosine" or self.type == "lmcl":
+            responses = responses.clamp(-1., 1.)
+        (top1, top5) = self.compute_top15(responses.data, targets, index)
+
+        if self.type == "tsmax":  # Taylor series
+            responses = 1 + responses + 0.5*(responses**2)
+        elif self.type == "lmcl":
+            m, s = min(0.5, self.margin), max(self.scale, 1.)
+            margins = torch.zeros_like(responses)
+            rows = (local_targets >= 0).nonzero().view(-1)
+            margins[rows, local_targets[rows]] = m
+            responses = (responses - margins) * s
+
+        # log of softmax -- the max is a constant (no gradient)
+        maximum = responses.data.max(1)[0]
+        if self.world_size > 1:
+            dist.all_reduce(maximum, dist.ReduceOp.MAX, group=self.group)
+        total = AllReduceSum.apply(
+            (responses - maximum.view(-1, 1)).exp().sum(1), self.group)
+
+        true_responses = responses.gather(
+            1, local_targets.clamp(0).view(-1, 1)).view(-1)
+        true_responses = AllReduceSum.apply(
+            true_responses * (local_targets >= 0).to(responses.dtype),
+            self.group)
+        loss = (total.log() + maximum - true_responses).mean()
+        return loss, (top1, top5)
 
+    def compute_top15(self, responses, targets, index):
+        r""" top1 and top5 of the global batch -- topk of every shard is
+        gathered to find the global topk. """
+        k = min(5, responses.size(1))
+        values, indices = responses.topk(k, 1, True, True)
+        indices = indices if index is None else index[indices]
+        indices = indices + self.offset
+        if k < 5:  # same shape on every shard (shards of < 5 labels)
+            values = F.pad(values, (0, 5 - k), value=- float("inf"))
+            indices = F.pad(indices, (0, 5 - k), value=-1)
+        if self.world_size > 1:
+            values = AllGather.apply(values.t().contiguous(), self.group)
+            indices = AllGather.apply(indices.t().contiguous(), self.group)
+            values, indices = values.t(), indices.t()
+        predicted = indices.gather(1, values.topk(min(5, values.size(1)),
+                                                  1, True, True)[1])
+        correct = predicted.eq(targets.view(-1, 1)).float()
+        top1 = correct[:, :1].sum().mul_(100.0 / responses.size(0))
+        top5 = correct.sum().mul_(100.0 / responses.size(0))
+        return top1, top5
+
+
+# embeddings = torch.randn(1024, 128)
+# labels = torch.arange(256).repeat_interleave(4)  # P x K = 256 x 4
+# test = TripletLoss(0.5, "batch_all")
+# test(embeddings, labels)[0]
 
 # tensor = torch.rand(3, 256)
 # test = CategoricalLoss(256, 10, "smax", center=True)
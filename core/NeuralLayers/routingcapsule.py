@@ -2,7 +2,167 @@
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from torch.autograd.function import Function
+
+
+def squash(tensor, dim):
+    sum_squares = tensor.pow(2).sum(dim, True)
+    return (sum_squares/(1+sum_squares)) * tensor / (sum_squares**0.5)
+
+
+def chunk_slices(n, chunks):
+    r""" Splits range(n) into (at most) chunks contiguous slices. """
+    chunks = max(1, min(int(chunks), n))
+    size = (n + chunks - 1) // chunks
+    return [slice(i, min(i + size, n)) for i in range(0, n, size)]
+
+
+def predictions(tensor, weight, n_capsules):
+    r""" Projects primary capsules to routing capsules.
+        tensor (B x N x P) and weight (N x P x n_capsules*capsule_length)
+        returns u (B x N x n_capsules x capsule_length)
+    """
+    u = torch.einsum("bnp,npd->bnd", tensor, weight)
+    return u.view(u.size(0), u.size(1), n_capsules, -1)
+
+
+class RoutingFunction(Function):
+    r""" Dynamic routing with a custom backward.
+
+    Autograd on the plain loop stores u (B x N x n_capsules x capsule_length)
+    and, per iteration, c*u and u*v of the same size. Here, only the biases
+    (B x N x n_capsules) and s (B x n_capsules x capsule_length) of every
+    iteration are saved, and u is recomputed (per chunk of primary capsules
+    when chunks > 1) during backward. The gradients are exact.
+    """
+
+    @staticmethod
+    def forward(ctx, tensor, weight, n_capsules, iterations, chunks):
+        batch_size, n_primary = tensor.size(0), tensor.size(1)
+        slices = chunk_slices(n_primary, chunks)
+        if len(slices) == 1:
+            u = [predictions(tensor, weight, n_capsules)]
+        else:
+            u = None
+
+        bias = tensor.new_zeros(batch_size, n_primary, n_capsules)
+        biases, ss = [], []
+        for i in range(iterations):
+            c = bias.softmax(2)
+            s = 0.
+            for j, sl in enumerate(slices):
+                _u = u[j] if u is not None else \
+                    predictions(tensor[:, sl], weight[sl], n_capsules)
+                s = s + torch.einsum("bnk,bnkl->bkl", c[:, sl], _u)
+            v = squash(s, 2)
+            biases.append(bias)
+            ss.append(s)
+            if i < iterations-1:
+                bias = bias.clone()
+                for j, sl in enumerate(slices):
+                    _u = u[j] if u is not None else \
+                        predictions(tensor[:, sl], weight[sl], n_capsules)
+                    bias[:, sl] += torch.einsum("bnkl,bkl->bnk", _u, v)
+
+        ctx.n_capsules, ctx.chunks = n_capsules, chunks
+        ctx.save_for_backward(tensor, weight, torch.stack(biases),
+                              torch.stack(ss))
+        return v
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        tensor, weight, biases, ss = ctx.saved_tensors
+        n_capsules, iterations = ctx.n_capsules, biases.size(0)
+        slices = chunk_slices(tensor.size(1), ctx.chunks)
+        if len(slices) == 1:
+            u = [predictions(tensor, weight, n_capsules)]
+        else:
+            u = None
+
+        grad_tensor = torch.zeros_like(tensor)
+        grad_weight = torch.zeros_like(weight)
+        grad_bias = None  # gradient w.r.t bias of next iteration
+        for i in reversed(range(iterations)):
+            c = biases[i].softmax(2)
+            with torch.enable_grad():
+                s = ss[i].detach().requires_grad_()
+                v = squash(s, 2)
+            if grad_bias is None:
+                grad_v = grad_output
+            else:
+                # bias_(i+1) = bias_i + (u * v_i).sum(-1)
+                grad_v = 0.
+                for j, sl in enumerate(slices):
+                    _u = u[j] if u is not None else \
+                        predictions(tensor[:, sl], weight[sl], n_capsules)
+                    grad_v = grad_v + torch.einsum("bnk,bnkl->bkl",
+                                                   grad_bias[:, sl], _u)
+            grad_s = torch.autograd.grad(v, s, grad_v)[0]
+            v = v.detach()
+
+            new_grad_bias = torch.zeros_like(c)
+            for j, sl in enumerate(slices):
+                _u = u[j] if u is not None else \
+                    predictions(tensor[:, sl], weight[sl], n_capsules)
+                # s_i = (c_i * u).sum over primary capsules
+                grad_c = torch.einsum("bkl,bnkl->bnk", grad_s, _u)
+                _c = c[:, sl]
+                new_grad_bias[:, sl] = _c * (grad_c -
+                                             (_c * grad_c).sum(2, True))
+                grad_u = torch.einsum("bnk,bkl->bnkl", _c, grad_s)
+                if grad_bias is not None:
+                    grad_u = grad_u + torch.einsum("bnk,bkl->bnkl",
+                                                   grad_bias[:, sl], v)
+                grad_u = grad_u.reshape(grad_u.size(0), grad_u.size(1), -1)
+                grad_tensor[:, sl] += torch.einsum("bnd,npd->bnp", grad_u,
+                                                   weight[sl])
+                grad_weight[sl] += torch.einsum("bnp,bnd->npd",
+                                                tensor[:, sl], grad_u)
+            if grad_bias is not None:
+                new_grad_bias = new_grad_bias + grad_bias
+            grad_bias = new_grad_bias
+
+        return grad_tensor, grad_weight, None, None, None
+
+
+def adaptive_routing(tensor, weight, n_capsules, iterations, tolerance,
+                     per_sample=True):
+    r""" Dynamic routing that stops once the maximum change in coupling
+    coefficients is below tolerance. When per_sample is True, converged
+    samples are dropped from the remaining iterations, else, routing stops
+    when all the samples in the batch have converged.
+
+    Return:
+        v (B x n_capsules x capsule_length) and the routing iterations used
+        per sample
+    """
+    u = predictions(tensor, weight, n_capsules)
+    batch_size, n_primary = u.size(0), u.size(1)
+    v = u.new_zeros(batch_size, n_capsules, u.size(3))
+    n_iterations = u.new_zeros(batch_size)
+    active = torch.arange(batch_size, device=u.device)
+
+    bias = u.new_zeros(batch_size, n_primary, n_capsules)
+    c = bias.softmax(2)
+    for i in range(iterations):
+        _v = squash(torch.einsum("bnk,bnkl->bkl", c, u), 2)
+        v = v.index_copy(0, active, _v)
+        n_iterations = n_iterations.index_add(0, active,
+                                              n_iterations.new_ones(
+                                                  active.numel()))
+        if i == iterations-1:
+            break
+        bias = bias + torch.einsum("bnkl,bkl->bnk", u, _v)
+        new_c = bias.softmax(2)
+        keep = (new_c - c).abs().view(active.numel(), -1).max(1)[0] >= \
+            tolerance
+        if not bool(keep.any()):
+            break
+        if per_sample and not bool(keep.all()):
+            active, u, bias, new_c = \
+                active[keep], u[keep], bias[keep], new_c[keep]
+        c = new_c
+    return v, n_iterations
 
 
 class RoutingCapsule(nn.Module):
@@ -16,6 +176,9 @@ class RoutingCapsule(nn.Module):
             labels per paper
         capsule_length (int, required): length of capsules
         iterations (int, required): routing iterations, default = 3
+        chunks (int, optional): splits the primary capsules into chunks to
+            compute the routing, reduces the peak memory for larger primary
+            grids at the cost of recomputing predictions, default = 1
 
     Return:
         3D torch.Tensor of shape
@@ -26,10 +189,17 @@ class RoutingCapsule(nn.Module):
                  n_capsules: int = 10,
                  capsule_length: int = 32,
                  iterations: int = 3,
+                 chunks: int = 1,
+                 tolerance: float = 0.,
+                 per_sample: bool = True,
                  *args, **kwargs):
         super(RoutingCapsule, self).__init__()
         import numpy as np
         self.iterations = iterations
+        self.chunks = chunks
+        self.tolerance = tolerance
+        self.per_sample = per_sample
+        self.reset_iterations()
         # Ex from paper
         #   For tensor_size=(1,32,6,6,8), n_capsules=10 and capsule_length=16
         #   weight_size = (tensor_size[1]*tensor_size[2]*tensor_size[3], \
@@ -43,52 +213,47 @@ class RoutingCapsule(nn.Module):
         self.tensor_size = (6, n_capsules, capsule_length)
 
     def forward(self, tensor):
-        batch_size, primary_capsule_length, h, w, n_primary_capsules = \
-            tensor.size()
+        batch_size, n_primary_capsules = tensor.size(0), tensor.size(-1)
         # Initial squash
-        tensor = tensor.view(batch_size, -1, n_primary_capsules)
-        sum_squares = tensor.view(batch_size, -1, n_primary_capsules
-                                  ).pow(2).sum(2).unsqueeze(2)
-        tensor = (sum_squares/(1+sum_squares)) * tensor / (sum_squares**0.5)
+        tensor = squash(tensor.view(batch_size, -1, n_primary_capsules), 2)
 
         # from the given example:
-        #   tensor is of size _ x 32 x 6 x 6 x 8
-        #   after matrix mulitplication the size of u is _x32x6x6x10x16
-        #   essentially, each of the pixel from 8 primary capsules is project
-        #   to a dimension of n_capsules x capsule_length
-        u = tensor.view(batch_size, -1, 1,
-                        n_primary_capsules).matmul(self.weight)
-        u = u.view(*((batch_size, primary_capsule_length, h, w) +
-                     self.tensor_size[1:]))
-
-        bias = torch.zeros(batch_size, primary_capsule_length, h, w,
-                           self.tensor_size[1])
-        if tensor.is_cuda:
-            bias = bias.to(tensor.device)
-
-        # routing
-        for i in range(self.iterations):
-            # softmax
-            #   initial softmax gives equal probabilities (since bias is
-            #   initialized with zeros), eventually, bias updates will change
-            #   the probabilities
-            c = F.softmax(bias, 4)  # size = _ x 32 x 6 x 6 x 10
-            # could be done with a single sum after reorganizing the tensor's,
-            #   however, retaining dimensions can explain better
-            # s size without sum's = _ x 32 x 6 x 6 x 10 x 16
-            # s size = _ x 10 x 16
-            s = (c.unsqueeze(5)*u).sum(3).sum(2).sum(1)
-            # squash -- v size = _ x 10 x 16
-            sum_squares = (s**2).sum(2).unsqueeze(2)
-            v = (sum_squares/(1+sum_squares)) * s / (sum_squares**0.5)
-            # bias update -- size = _ x 32 x 6 x 6 x 10
-            if i < self.iterations-1:
-                bias = bias + (u * v.view(batch_size, 1, 1, 1,
-                                          self.tensor_size[1],
-                                          self.tensor_size[2])).sum(5)
-        return v
+        #   tensor is of size _ x 32 x 6 x 6 x 8 -> _ x 1152 x 8
+        #   each of the pixel from 8 primary capsules is projected to a
+        #   dimension of n_capsules x capsule_length (u = _ x 1152 x 10 x 16)
+        #   c = softmax(bias) (_ x 1152 x 10), s = sum(c*u) (_ x 10 x 16)
+        #   v = squash(s) and bias = bias + sum(u*v) are computed with
+        #   einsum contractions, without the _ x 1152 x 10 x 16 products
+        if not self.training and self.tolerance > 0:
+            v, n_iterations = adaptive_routing(tensor, self.weight,
+                                               self.tensor_size[1],
+                                               self.iterations,
+                                               self.tolerance,
+                                               self.per_sample)
+            # accumulated on the device, average_iterations syncs
+            self.routed_samples += n_iterations.numel()
+            self.routed_iterations = self.routed_iterations + \
+                n_iterations.detach().sum()
+            return v
+        return RoutingFunction.apply(tensor, self.weight, self.tensor_size[1],
+                                     self.iterations, self.chunks)
+
+    @property
+    def average_iterations(self):
+        r""" Average routing iterations per sample since the last
+        reset_iterations (only counts early stopping inference). """
+        if self.routed_samples == 0:
+            return float(self.iterations)
+        return float(self.routed_iterations) / self.routed_samples
+
+    def reset_iterations(self):
+        self.routed_samples = 0
+        self.routed_iterations = 0.
 
 
 # x = torch.rand(3,32,10,10,8)
 # test = RoutingCapsule((3,32,10,10,8), 10, 16, 3,)
 # test(x).size()
+# test.tolerance = 1e-3
+# test.eval()
+# test(x).size(), test.average_iterations
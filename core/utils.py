@@ -360,16 +360,62 @@ def xcorr_1d(tensor: torch.Tensor):
     return num / den.add(1e-8)
 
 
-class ImageNetNorm(nn.Module):
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class ImageNorm(nn.Module):
+    r"""Converts images to normalized float NCHW on the device of the
+    model with a single fused op (addcmul) -- uint8 images (0-255, NHWC or
+    NCHW) are cast, permuted, scaled to [0, 1] and normalized
+    ((x - mean) / std) in one pass, float images (NCHW, 0-1) are only
+    normalized. Grey images are broadcast to len(mean) channels. No device
+    sync, and the input is not modified.
+
+    Loaders can return uint8 batches (4x fewer bytes to copy than float)
+    with ImageNorm as the first module of the network.
+
+    Args:
+        tensor_size: shape of tensor in BCHW, uint8 tensors of shape
+            (B, H, W, C) are NHWC
+        mean: per channel mean, default = ImageNet mean
+        std: per channel standard deviation, default = ImageNet std
+    """
+    def __init__(self, tensor_size=(1, 3, 224, 224), mean=IMAGENET_MEAN,
+                 std=IMAGENET_STD):
+        super(ImageNorm, self).__init__()
+        assert len(mean) == len(std), \
+            "ImageNorm: mean and std must have same length"
+        assert tensor_size[1] in (1, len(mean)), \
+            "ImageNorm: tensor_size[1] must be 1 or len(mean)"
+        self.channels = tensor_size[1]
+        self.tensor_size = (tensor_size[0], len(mean)) + \
+            tuple(tensor_size[2:])
+        mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        # not in state_dict -- keeps the keys of pretrained networks
+        self.register_buffer("scale", 1 / std, persistent=False)
+        self.register_buffer("scale_uint8", 1 / (std * 255),
+                             persistent=False)
+        self.register_buffer("bias", - mean / std, persistent=False)
 
     def forward(self, tensor):
-        if tensor.size(1) == 1:  # convert to rgb
-            tensor = torch.cat((tensor, tensor, tensor), 1)
-        if tensor.min() >= 0:  # do imagenet normalization
-            tensor[:, 0].add_(-0.485).div_(0.229)
-            tensor[:, 1].add_(-0.456).div_(0.224)
-            tensor[:, 2].add_(-0.406).div_(0.225)
-        return tensor
+        if tensor.dtype != torch.uint8:
+            return torch.addcmul(self.bias, tensor, self.scale)
+        if tensor.dim() == 4 and tensor.size(3) == self.channels and \
+                tensor.size(1) != self.channels:  # NHWC
+            tensor = tensor.permute(0, 3, 1, 2)
+        # out is NCHW contiguous (a permuted input gives channels last)
+        out = torch.empty(torch.broadcast_shapes(tensor.shape,
+                                                 self.bias.shape),
+                          dtype=self.bias.dtype, device=tensor.device)
+        return torch.addcmul(self.bias, tensor, self.scale_uint8, out=out)
+
+
+class ImageNetNorm(ImageNorm):
+    r"""ImageNorm with ImageNet mean and std (rgb or grey input). """
+    def __init__(self, tensor_size=(1, 3, 224, 224)):
+        super(ImageNetNorm, self).__init__(tensor_size)
 
 
 class utils:
@@ -381,4 +427,5 @@ class utils:
     DoG = DoG
     DoGBlob = DoGBlob
     roc = roc
+    ImageNorm = ImageNorm
     ImageNetNorm = ImageNetNorm
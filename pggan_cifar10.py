@@ -2,14 +2,12 @@
 
 from __future__ import print_function, division
 import os
-import sys
-import timeit
 import argparse
 import numpy as np
 import core
 import torch
 from core.NeuralEssentials import DataSets, MakeModel, VisPlots, SaveModel,\
-    MakeGIF
+    MakeGIF, Meters
 from torch.optim import Adam
 
 
@@ -28,13 +26,15 @@ def parse_args():
     parser.add_argument("--n_embedding", type=int,  default=256)
     parser.add_argument("--l1_iterations", type=int,  default=100000)
     parser.add_argument("-I", "--ignore_trained", action="store_true")
+    parser.add_argument("--sync_every", type=int,  default=50)
     return parser.parse_args()
 
 
 def train():
     args = parse_args()
     trData, vaData, teData, n_labels, tensor_size = \
-        DataSets("cifar10", data_path="../data", n_samples=args.BSZ)
+        DataSets("cifar10", data_path="../data", n_samples=args.BSZ,
+                 in_memory=True)
 
     # noise
     noisy_latent = lambda: torch.randn(args.BSZ, args.n_embedding)
@@ -70,9 +70,11 @@ def train():
     print("")
 
     png_count = 0
+    # meters are accumulated on the device, and synced every sync_every
+    meters = Meters(Model, ("g_loss", "d_loss"), args.sync_every,
+                    text="Cost d/g {d_loss:2.3f}/{g_loss:2.3f}")
     # Usual training
     while True:
-        Timer = timeit.default_timer()
         Model.netEmbedding.train()
         if Model.meterIterations >= Model.netEmbedding.NET46.max_iterations:
             print(" ... done with training!")
@@ -124,16 +126,12 @@ def train():
                 png_count += 1
                 visplots.show_images(tensor.data.cpu(), "real")
 
-            # updating all meters
-            Model.meterLoss.append(float(g_loss.cpu().data.numpy()))
-            Model.meterLoss.append(float(d_loss.cpu().data.numpy()))
-            Model.meterSpeed.append(int(float(args.BSZ) /
-                                        (timeit.default_timer()-Timer)))
-            Timer = timeit.default_timer()
-            print("... {:6d} :: Cost d/g {:2.3f}/{:2.3f} :: {:4d} I/S      ".format(
-                Model.meterIterations, Model.meterLoss[-1],
-                Model.meterLoss[-2], Model.meterSpeed[-1]), end="\r")
-            sys.stdout.flush()
+            # updating all meters -- meterLoss has g_loss and d_loss
+            # interleaved
+            if meters.update(args.BSZ, g_loss=g_loss, d_loss=d_loss):
+                for g, d in zip(meters.synced["g_loss"],
+                                meters.synced["d_loss"]):
+                    Model.meterLoss += [g, d]
 
             # save and track
             if Model.meterIterations % 2000 == 0:
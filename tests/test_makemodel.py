@@ -0,0 +1,36 @@
+import pytest
+import torch
+from core.NeuralEssentials.makemodel import BaseModel, SaveModel, LoadModel
+
+
+def make(file_name, device):
+    Model = BaseModel()
+    Model.file_name = file_name
+    Model.netEmbedding = torch.nn.Linear(4, 3).to(device)
+    return Model
+
+
+def test_flat_loads_on_cpu(tmp_path):
+    file_name = str(tmp_path / "model.t7")
+    saved = make(file_name, "cpu")
+    SaveModel(saved, flat=True)
+    Model = LoadModel(make(file_name, "cpu"))
+    for p, q in zip(Model.netEmbedding.parameters(),
+                    saved.netEmbedding.parameters()):
+        assert p.device.type == "cpu"
+        assert torch.equal(p, q)
+
+
+@pytest.mark.filterwarnings("ignore:.*meta parameter")
+def test_flat_keeps_device_of_parameters(tmp_path):
+    # meta stands in for cuda -- parameters must not be replaced by the
+    # memory-mapped cpu tensors
+    file_name = str(tmp_path / "model.t7")
+    saved = make(file_name, "cpu")
+    SaveModel(saved, flat=True)
+    Model = make(file_name, "meta")
+    parameters = [id(p) for p in Model.netEmbedding.parameters()]
+    Model = LoadModel(Model)
+    assert all(p.device.type == "meta"
+               for p in Model.netEmbedding.parameters())
+    assert parameters == [id(p) for p in Model.netEmbedding.parameters()]
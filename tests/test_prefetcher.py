@@ -0,0 +1,47 @@
+import threading
+import time
+import pytest
+import torch
+from core.NeuralEssentials import Prefetcher
+
+
+def consume(loader, depth, fail_at):
+    for i, batch in enumerate(Prefetcher(loader, depth=depth)):
+        if i == fail_at:
+            time.sleep(0.5)  # producer fills the queue and waits
+            raise RuntimeError("step failed")
+
+
+@pytest.mark.parametrize("fail_at", [0, 1, 2])
+def test_early_exit_does_not_hang(fail_at):
+    # producer is blocked on the end of data sentinel (queue is full)
+    loader = [torch.zeros(2) for _ in range(3)]
+    errors = []
+
+    def run():
+        try:
+            consume(loader, 2, fail_at)
+        except RuntimeError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "Prefetcher: join hangs on early exit"
+    assert len(errors) == 1
+
+
+def test_loader_error_after_early_exit():
+    def loader():
+        yield torch.zeros(2)
+        yield torch.zeros(2)
+        raise ValueError("bad sample")
+
+    with pytest.raises(RuntimeError):
+        consume(loader(), 1, 0)
+
+
+def test_all_batches():
+    loader = [torch.full((2, ), i) for i in range(5)]
+    batches = list(Prefetcher(loader, depth=2))
+    assert [int(x[0]) for x in batches] == list(range(5))